@@ -1,7 +1,9 @@
 import os
-import unittest
+import sys
 import logging
 import argparse
+import time
+import numpy as np
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
@@ -67,8 +69,391 @@ class DICOM2OBJLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
-  def ProceduralSegmentation(self, inputDir, outputDir):
- 
+  # Parameters only used once the closed surface exists, and parameters only used to extract the
+  # closed surface from the labelmap. Intermediates are cached without them, so a rerun that changes
+  # only these starts from the cached surface or labelmap.
+  MESH_PARAMETERS = ["decimationMethod", "decimationTargetReduction", "decimationTargetTriangles", "decimationTargetBytes",
+    "levelsOfDetail", "meshSmoothingIterations", "meshSmoothingFactor", "outputFormats", "glbPositionType"]
+  SURFACE_PARAMETERS = ["surfaceExtractor", "oversamplingFactor", "jointSmoothing", "surfaceSmoothingFactor"]
+  # Parameters that only choose other parameters; intermediates are cached under the chosen ones
+  PLANNING_PARAMETERS = ["quality", "timeBudgetSeconds"]
+
+  def __init__(self, parent=None):
+    ScriptedLoadableModuleLogic.__init__(self, parent)
+    self.parameters = self.DefaultParameters()
+    # Optional DICOM2OBJLib.ResultCache.ResultCache serving repeated conversions of the same series
+    self.resultCache = None
+    # Also cache the labelmap and raw closed surfaces in the result cache
+    self.cacheIntermediates = True
+    # VTK threads and SMP backend ("sequential", "stdthread", "tbb" or "openmp") of every job, None restores
+    # VTK's defaults. They do not change the result, so they are not part of the parameters (or cache keys).
+    self.threads = None
+    self.smpBackend = None
+    self.threadingSettings = {}
+    # Per-stage timings of the last conversion, written next to the output if profileEnabled
+    from DICOM2OBJLib import StageProfiler
+    self.profiler = StageProfiler.StageProfiler()
+    self.profileEnabled = False
+    # Optional DICOM2OBJLib.StartupProfile.StartupProfile of the command line run, added to the profile
+    self.startupProfile = None
+    # Nodes added to the scene by a conversion are removed when it ends, unless kept (e.g. to display them)
+    self.keepSceneNodes = False
+    # Hold the VTK data objects of every conversion until it ends and report those other objects still hold.
+    # Keeps them alive for the whole conversion, so only used to find leaks (see DICOM2OBJLib.JobContext).
+    self.trackObjects = False
+    self.jobContext = None
+
+  @staticmethod
+  def DefaultParameters():
+    import copy
+    from DICOM2OBJLib import SegmentSpec
+    return {
+      # "scanner" loads the files found by the parallel header scanner, "database" imports into a temporary DICOM database
+      "dicomImport": "scanner",
+      # Series to segment, one of DICOM2OBJLib.DicomScanner.SERIES_SELECTION_POLICIES
+      "seriesSelection": "largest",
+      "seriesInstanceUID": None,
+      # "editor" runs the Segment Editor effects, "headless" runs the same filters without any widget
+      "engine": "editor",
+      # Segments to extract, see DICOM2OBJLib.SegmentSpec
+      "segments": copy.deepcopy(SegmentSpec.PRESETS["spine"]),
+      # Crop the volume to the voxels inside any segment range (plus a smoothing margin) before segmenting
+      "cropToThresholdRange": True,
+      # Find the crop region on every n-th voxel along each axis, faster but may miss structures thinner than n voxels
+      "cropSampling": 1,
+      # Memory-bounded mode: release volumes, labelmaps and surfaces as soon as they are consumed and
+      # downsample the volume if the estimated peak memory (MB) of the conversion exceeds this limit
+      "maxMemoryMB": None,
+      # Slab streaming: threshold, smooth and extract surfaces in slabs of this many slices read from a memory-mapped
+      # volume file, so memory scales with the slab instead of the study (headless filters, no oversampling)
+      "slabSlices": None,
+      # Labelmap to closed surface: "segmentation" uses the segmentation's conversion rule (joint for shared
+      # labelmaps), "flyingEdges" (multi-threaded) or "marchingCubes" extract every segment separately
+      "surfaceExtractor": "segmentation",
+      # One of DICOM2OBJLib.QualityPlanner.QUALITY_NAMES, or with a time budget (seconds) the best level up to
+      # quality whose estimated time fits; replaces oversampling, smoothing kernels, smoothing factors and iterations
+      "quality": None,
+      "timeBudgetSeconds": None,
+      "oversamplingFactor": 1.0,
+      "jointSmoothing": 0.5,
+      "surfaceSmoothingFactor": 0.5,
+      # "pro" (vtkDecimatePro, preserves topology), "quadric" (vtkQuadricDecimation) or "clustering" (vtkQuadricClustering, fastest)
+      "decimationMethod": "pro",
+      "decimationTargetReduction": 0.95,
+      # Maximum triangles, or bytes of each output file, per segment mesh; replaces decimationTargetReduction when set
+      "decimationTargetTriangles": None,
+      "decimationTargetBytes": None,
+      # Target reductions of the levels of detail written as segmentation_lod<n>, e.g. [0.8, 0.95, 0.99]
+      # (empty writes a single mesh decimated by decimationTargetReduction)
+      "levelsOfDetail": [],
+      "meshSmoothingIterations": 50,
+      "meshSmoothingFactor": 0.5,
+      # Any of DICOM2OBJLib.MeshWriters.OUTPUT_FORMATS, written as segmentation.<format>
+      "outputFormats": ["obj"],
+      # GLB vertex positions, "float32" or quantized "int16"
+      "glbPositionType": "float32",
+    }
+
+  def ProceduralSegmentation(self, inputDir, outputDir, cancelFile=None):
+    """Convert the DICOM study in inputDir into meshes in outputDir.
+    cancelFile replaces the cancel file of the progress reporter for this conversion.
+    """
+    from DICOM2OBJLib import JobContext, ProgressEvents
+    self.profiler.reset()
+    self.threadingSettings = self.ConfigureThreading()
+    # A quality plan replaces parameters for this conversion only
+    parameters = self.parameters
+    self.jobContext = JobContext.SceneJobContext(slicer.mrmlScene, self.trackObjects).begin()
+    try:
+      # Profiler observers (e.g. a ProgressEvents.ProgressReporter) also get the start and end of the conversion
+      conversion = {"input": inputDir, "output": outputDir}
+      if cancelFile:
+        conversion["cancelFile"] = cancelFile
+      self.profiler.notify("conversionStart", conversion)
+      self.ConvertStudy(inputDir, outputDir)
+      self.profiler.notify("conversionEnd", {"input": inputDir, "output": outputDir, "status": "ok"})
+    except ProgressEvents.ConversionCancelled:
+      self.profiler.notify("conversionEnd", {"input": inputDir, "output": outputDir, "status": "cancelled"})
+      raise
+    except Exception as e:
+      self.profiler.notify("conversionEnd", {"input": inputDir, "output": outputDir, "status": "error", "error": str(e)})
+      raise
+    finally:
+      if not self.keepSceneNodes:
+        self.jobContext.release()
+      # Also written for failed conversions, the failing stage is marked with its error
+      if self.profileEnabled:
+        self.WriteProfile(inputDir, outputDir)
+      self.parameters = parameters
+
+  def ConvertStudy(self, inputDir, outputDir):
+    # Header-only scan of the input, used to select the series and as the cache key
+    from DICOM2OBJLib import DicomArchive, DicomScanner
+    with self.profiler.stage("scan") as stage:
+      if DicomArchive.isArchive(inputDir):
+        seriesList = DicomArchive.scanArchive(inputDir)
+      else:
+        seriesList = DicomScanner.scanDirectory(inputDir)
+      stage["series"] = len(seriesList)
+      stage["files"] = sum(len(series.instances) for series in seriesList)
+
+    series = self.SelectSeries(seriesList)
+    # Only the selected series is converted, other series of the study (dose reports, scouts, ...) do not change the result
+    instanceUIDs = DicomScanner.instanceUIDs([series])
+    cacheKey = None
+    if self.resultCache:
+      with self.profiler.stage("cacheLookup") as stage:
+        cacheKey = self.resultCache.key(instanceUIDs, self.parameters)
+        stage["hit"] = bool(cacheKey and self.resultCache.fetch(cacheKey, outputDir))
+      if stage["hit"]:
+        logging.info("Served {0} from result cache".format(inputDir))
+        return
+
+    qualityPlan = None
+    if self.parameters["quality"] or self.parameters["timeBudgetSeconds"]:
+      qualityPlan = self.PlanQuality(series)
+    labelmapKey = surfaceKey = None
+    if self.resultCache and self.cacheIntermediates:
+      labelmapKey = self.IntermediateKey(instanceUIDs, "labelmap")
+      surfaceKey = self.IntermediateKey(instanceUIDs, "surface")
+
+    # Start from the latest cached intermediate
+    surfaces = self.LoadCachedSurfaces(surfaceKey) if surfaceKey else None
+    if surfaces is None and self.parameters["slabSlices"]:
+      # Straight from the DICOM files to surfaces, there is no labelmap of the whole volume
+      surfaces = self.CreateSurfacesBySlabs(inputDir, series)
+      if surfaceKey:
+        self.StoreSurfaces(surfaceKey, surfaces)
+    elif surfaces is None:
+      segmentationNode = self.LoadCachedLabelmap(labelmapKey) if labelmapKey else None
+      if segmentationNode is None:
+        segmentationNode = self.SegmentSeries(inputDir, series)
+        if labelmapKey:
+          self.StoreLabelmap(labelmapKey, segmentationNode)
+      surfaces = self.CreateSurfaces(segmentationNode)
+      if surfaceKey:
+        self.StoreSurfaces(surfaceKey, surfaces)
+      if self.parameters["maxMemoryMB"]:
+        # The surfaces list keeps the only reference to the raw surfaces
+        slicer.mrmlScene.RemoveNode(segmentationNode)
+        segmentationNode = None
+    for segmentName, surfaceMesh in surfaces:
+      self.TrackObject(surfaceMesh)
+    if qualityPlan and self.parameters["timeBudgetSeconds"]:
+      self.FitMeshSmoothingToBudget(qualityPlan, surfaces)
+    outputFiles = []
+    levelsOfDetail = []
+    while surfaces:
+      # Each raw surface is released once its meshes are written
+      segmentName, surfaceMesh = surfaces.pop(0)
+      if self.parameters["levelsOfDetail"]:
+        for level, (targetReduction, levelMesh) in enumerate(self.ProcessLevelsOfDetail(surfaceMesh, segmentName)):
+          self.TrackObject(levelMesh)
+          levelFiles = self.WriteSurface(levelMesh, outputDir, "{0}_lod{1}".format(self.OutputFileBaseName(segmentName), level))
+          outputFiles.extend(levelFiles)
+          levelsOfDetail.append({"segment": segmentName, "level": level, "targetReduction": targetReduction,
+            "triangles": levelMesh.GetNumberOfPolys(), "files": [os.path.basename(fileName) for fileName in levelFiles]})
+      else:
+        surfaceMesh = self.TrackObject(self.ProcessSurface(surfaceMesh, segmentName))
+        outputFiles.extend(self.WriteSurface(surfaceMesh, outputDir, self.OutputFileBaseName(segmentName)))
+    if levelsOfDetail:
+      outputFiles.append(self.WriteLevelsOfDetailManifest(outputDir, levelsOfDetail))
+    if qualityPlan:
+      from DICOM2OBJLib import QualityPlanner
+      outputFiles.append(QualityPlanner.writePlan(outputDir, qualityPlan))
+
+    if cacheKey:
+      with self.profiler.stage("cacheStore"):
+        self.resultCache.store(cacheKey, outputFiles)
+
+  def SegmentSeries(self, inputDir, series):
+    """Load the series and return its segmentation node."""
+    downsampling = 1
+    if self.parameters["maxMemoryMB"]:
+      downsampling = self.WorkingDownsampling(series)
+    with self.profiler.stage("load", files=len(series.instances)) as stage:
+      seriesVolumeNode = self.LoadDicomVolume(inputDir, series)
+      stage["voxels"] = self.TrackObject(seriesVolumeNode.GetImageData()).GetNumberOfPoints()
+    if downsampling > 1:
+      seriesVolumeNode = self.DownsampleVolume(seriesVolumeNode, downsampling)
+    if self.parameters["cropToThresholdRange"]:
+      seriesVolumeNode = self.CropToThresholdRange(seriesVolumeNode)
+    segmentationNode = self.SegmentVolume(seriesVolumeNode)
+    if self.parameters["maxMemoryMB"]:
+      self.ReleaseVolume(seriesVolumeNode)
+    return segmentationNode
+
+  def TrackObject(self, vtkObject):
+    # Reported by the job context if other objects still hold it when the conversion ends
+    if self.jobContext:
+      self.jobContext.track(vtkObject)
+    return vtkObject
+
+  def PlanQuality(self, series):
+    """Replace the parameters by the ones of the quality level picked for series and return the plan."""
+    from DICOM2OBJLib import QualityPlanner
+    voxels = (series.rows or 0) * (series.columns or 0) * len(series.instances)
+    with self.profiler.stage("qualityPlan", voxels=voxels) as stage:
+      plan = QualityPlanner.planQuality(voxels, series.spacing(), self.parameters["segments"], self.parameters["quality"],
+        self.parameters["timeBudgetSeconds"], self.parameters["decimationTargetReduction"], self.parameters["surfaceExtractor"],
+        # Oversampling multiplies the labelmap size
+        maximumOversamplingFactor=1.0 if self.parameters["maxMemoryMB"] else None)
+      stage["quality"] = plan["quality"]
+      stage["estimatedTotalSeconds"] = plan["estimatedTotalSeconds"]
+    if not plan["withinBudget"]:
+      logging.warning("Estimated {0}s of the {1} quality exceed the time budget of {2}s".format(
+        plan["estimatedTotalSeconds"], plan["quality"], plan["timeBudgetSeconds"]))
+    logging.info("Converting at {0} quality: {1}".format(plan["quality"], plan["settings"]))
+    self.parameters = QualityPlanner.applyPlan(self.parameters, plan)
+    return plan
+
+  def FitMeshSmoothingToBudget(self, plan, surfaces):
+    """Lower the mesh smoothing iterations to the time left of the budget, from the real triangle count."""
+    from DICOM2OBJLib import QualityPlanner
+    triangles = sum(surfaceMesh.GetNumberOfPolys() for segmentName, surfaceMesh in surfaces)
+    remainingSeconds = plan["timeBudgetSeconds"] - (time.perf_counter() - self.profiler.startWallTime)
+    iterations = QualityPlanner.meshSmoothingIterations(remainingSeconds, triangles,
+      self.parameters["decimationTargetReduction"], self.parameters["meshSmoothingIterations"])
+    if iterations < self.parameters["meshSmoothingIterations"]:
+      logging.info("Smoothing meshes with {0} instead of {1} iterations to stay in the time budget".format(
+        iterations, self.parameters["meshSmoothingIterations"]))
+    plan["triangles"] = triangles
+    plan["settings"]["meshSmoothingIterations"] = self.parameters["meshSmoothingIterations"] = iterations
+
+  def IntermediateKey(self, instanceUIDs, intermediate):
+    excluded = self.PLANNING_PARAMETERS + self.MESH_PARAMETERS + (self.SURFACE_PARAMETERS if intermediate == "labelmap" else [])
+    parameters = dict((name, value) for name, value in self.parameters.items() if name not in excluded)
+    return self.resultCache.key(instanceUIDs, parameters, intermediate)
+
+  def LoadCachedLabelmap(self, key):
+    entryDir = self.resultCache.lookup(key)
+    if entryDir is None:
+      return None
+    with self.profiler.stage("intermediateLoad", intermediate="labelmap"):
+      segmentationNode = slicer.util.loadSegmentation(os.path.join(entryDir, "labelmap.seg.nrrd"))
+      self.SetConversionParameters(segmentationNode)
+    logging.info("Starting from cached labelmap " + entryDir)
+    return segmentationNode
+
+  def StoreLabelmap(self, key, segmentationNode):
+    import tempfile
+    with self.profiler.stage("intermediateStore", intermediate="labelmap"):
+      with tempfile.TemporaryDirectory() as temporaryDir:
+        fileName = os.path.join(temporaryDir, "labelmap.seg.nrrd")
+        if slicer.util.saveNode(segmentationNode, fileName):
+          self.resultCache.store(key, [fileName])
+
+  def LoadCachedSurfaces(self, key):
+    """Return the (segment name, closed surface) list cached under key, or None."""
+    entryDir = self.resultCache.lookup(key)
+    if entryDir is None:
+      return None
+    fileNames = [os.path.join(entryDir, "surface_{0}.vtp".format(index)) for index in range(len(self.parameters["segments"]))]
+    if not all(os.path.isfile(fileName) for fileName in fileNames):
+      return None
+    surfaces = []
+    with self.profiler.stage("intermediateLoad", intermediate="surface"):
+      for segment, fileName in zip(self.parameters["segments"], fileNames):
+        reader = vtk.vtkXMLPolyDataReader()
+        reader.SetFileName(fileName)
+        reader.Update()
+        surfaces.append((segment["name"], reader.GetOutput()))
+    logging.info("Starting from cached closed surfaces " + entryDir)
+    return surfaces
+
+  def StoreSurfaces(self, key, surfaces):
+    import tempfile
+    with self.profiler.stage("intermediateStore", intermediate="surface"):
+      with tempfile.TemporaryDirectory() as temporaryDir:
+        fileNames = []
+        # Segment names can contain any character, files are numbered in segment order instead
+        for index, (segmentName, surfaceMesh) in enumerate(surfaces):
+          writer = vtk.vtkXMLPolyDataWriter()
+          writer.SetFileName(os.path.join(temporaryDir, "surface_{0}.vtp".format(index)))
+          writer.SetInputData(surfaceMesh)
+          writer.Write()
+          fileNames.append(writer.GetFileName())
+        self.resultCache.store(key, fileNames)
+
+  # VTK's SMP backend before any job changed it, recorded by the first ConfigureThreading call of the process
+  defaultSmpBackend = None
+
+  def ConfigureThreading(self):
+    """Apply threads and smpBackend to VTK and return the settings in effect.
+    The settings are global to the process, so where a job does not set them VTK's defaults are restored
+    instead of keeping those of an earlier job (e.g. in a conversion server).
+    """
+    canSwitchBackend = hasattr(vtk.vtkSMPTools, "SetBackend")
+    if canSwitchBackend and DICOM2OBJLogic.defaultSmpBackend is None:
+      DICOM2OBJLogic.defaultSmpBackend = vtk.vtkSMPTools.GetBackend()
+    if self.smpBackend:
+      if canSwitchBackend:
+        if not vtk.vtkSMPTools.SetBackend(self.smpBackend.upper()):
+          logging.warning("VTK SMP backend {0} is not available".format(self.smpBackend))
+      else:
+        # Before VTK 9.1 the backend is chosen when VTK is built
+        logging.warning("This VTK version cannot switch its SMP backend at run time")
+    elif canSwitchBackend and vtk.vtkSMPTools.GetBackend() != DICOM2OBJLogic.defaultSmpBackend:
+      vtk.vtkSMPTools.SetBackend(DICOM2OBJLogic.defaultSmpBackend)
+    # 0 selects the default number of threads of both
+    vtk.vtkSMPTools.Initialize(self.threads or 0)
+    vtk.vtkMultiThreader.SetGlobalMaximumNumberOfThreads(self.threads or 0)
+    return {
+      "threads": self.threads,
+      "smpBackend": vtk.vtkSMPTools.GetBackend() if hasattr(vtk.vtkSMPTools, "GetBackend") else None,
+      "smpThreads": vtk.vtkSMPTools.GetEstimatedNumberOfThreads(),
+      "multiThreaderThreads": vtk.vtkMultiThreader.GetGlobalMaximumNumberOfThreads() or vtk.vtkMultiThreader.GetGlobalDefaultNumberOfThreads(),
+      }
+
+  def WriteProfile(self, inputDir, outputDir):
+    profileFileName = os.path.join(outputDir, "DICOM2OBJ_profile.json")
+    try:
+      os.makedirs(outputDir, exist_ok=True)
+      self.profiler.write(profileFileName, input=inputDir, output=outputDir, parameters=self.parameters,
+        slicerVersion=slicer.app.applicationVersion, vtkVersion=vtk.vtkVersion.GetVTKVersion(), threading=self.threadingSettings,
+        startup=self.startupProfile.summary() if self.startupProfile else None,
+        release=self.jobContext.releaseSummary if self.jobContext else None)
+    except OSError as e:
+      logging.error("Could not write profile {0}: {1}".format(profileFileName, e))
+
+  def SelectSeries(self, seriesList):
+    from DICOM2OBJLib import DicomScanner
+    series = DicomScanner.selectSeries(seriesList, self.parameters["seriesSelection"], self.parameters["seriesInstanceUID"])
+    logging.info("Selected {0} of {1} DICOM series: {2}".format(series.seriesInstanceUID, len(seriesList), series.description))
+    return series
+
+  def LoadDicomVolume(self, inputDir, series):
+    from DICOM2OBJLib import DicomArchive
+    if DicomArchive.isArchive(inputDir):
+      return self.LoadArchiveVolume(inputDir, series)
+    if self.parameters["dicomImport"] == "scanner":
+      return self.LoadScannedVolume(series)
+    elif self.parameters["dicomImport"] == "database":
+      return self.LoadDatabaseVolume(inputDir, series)
+    raise ValueError("Unknown DICOM import method: " + str(self.parameters["dicomImport"]))
+
+  def LoadArchiveVolume(self, archivePath, series):
+    # Only the files of the selected series are extracted, and only until the volume is loaded
+    import tempfile
+    from DICOM2OBJLib import DicomArchive
+    with tempfile.TemporaryDirectory(prefix="DICOM2OBJ-") as spoolDir:
+      with self.profiler.stage("spool", files=len(series.instances)) as stage:
+        spooledSeries = DicomArchive.spoolSeries(archivePath, series, spoolDir)
+        stage["bytes"] = sum(os.path.getsize(fileName) for fileName in spooledSeries.files)
+      return self.LoadDicomVolume(spoolDir, spooledSeries)
+
+  def LoadScannedVolume(self, series):
+    # Load the series file list found by the header scanner directly, without a DICOM database
+    fileList = vtk.vtkStringArray()
+    for fileName in series.files:
+      fileList.InsertNextValue(fileName)
+    volumesLogic = slicer.modules.volumes.logic()
+    seriesVolumeNode = volumesLogic.AddArchetypeScalarVolume(series.files[0], series.description or series.seriesInstanceUID, 0, fileList)
+    if seriesVolumeNode is None:
+      raise ValueError("Could not load DICOM series " + series.seriesInstanceUID)
+    return seriesVolumeNode
+
+  def LoadDatabaseVolume(self, inputDir, series):
     # Importing Dicom into temporary database
     dicomDataDir = inputDir
     from DICOMLib import DICOMUtils
@@ -76,31 +461,143 @@ class DICOM2OBJLogic(ScriptedLoadableModuleLogic):
     
     with DICOMUtils.TemporaryDICOMDatabase() as db:
       DICOMUtils.importDicom(dicomDataDir, db)
-      patientUIDs = db.patients()
-      for patientUID in patientUIDs:
-        loadedNodeIDs.extend(DICOMUtils.loadPatientByUID(patientUID))
+      # Only load the selected series, not every series of every patient
+      loadedNodeIDs.extend(DICOMUtils.loadSeriesByUID([series.seriesInstanceUID]))
+    if not loadedNodeIDs:
+      raise ValueError("Could not load DICOM series " + series.seriesInstanceUID)
 
-	# Loading Dicom into scene
+    # Loading Dicom into scene
     seriesVolumeNode = slicer.util.getNode(loadedNodeIDs[0])
     storageVolumeNode = seriesVolumeNode.CreateDefaultStorageNode()
     slicer.mrmlScene.AddNode(storageVolumeNode)
     storageVolumeNode.UnRegister(slicer.mrmlScene)
     seriesVolumeNode.SetAndObserveStorageNodeID(storageVolumeNode.GetID())
+    return seriesVolumeNode
 
-    # Access segmentation module
-    slicer.util.selectModule('Segment Editor')
+  def WorkingDownsampling(self, series):
+    """Downsampling factor of the series that keeps the estimated peak memory below maxMemoryMB."""
+    from DICOM2OBJLib import MemoryBudget, StageProfiler
+    voxels = (series.rows or 0) * (series.columns or 0) * len(series.instances)
+    with self.profiler.stage("memoryBudget", voxels=voxels, maxMemoryMB=self.parameters["maxMemoryMB"]) as stage:
+      baselineMB = StageProfiler.memoryUsageMB()[0] or 0.0
+      downsampling = MemoryBudget.workingDownsampling(voxels, self.parameters["maxMemoryMB"], baselineMB)
+      stage["baselineMB"] = round(baselineMB, 1)
+      stage["estimatedPeakMemoryMB"] = round(MemoryBudget.estimatePeakMemoryMB(voxels, downsampling, baselineMB), 1)
+      stage["downsampling"] = downsampling
+    if downsampling > 1:
+      logging.warning("Converting at 1/{0} resolution to stay below {1} MB".format(downsampling, self.parameters["maxMemoryMB"]))
+    return downsampling
+
+  def DownsampleVolume(self, seriesVolumeNode, factor):
+    """Return a volume node averaging blocks of factor x factor x factor voxels of seriesVolumeNode."""
+    from DICOM2OBJLib import MemoryBudget
+    with self.profiler.stage("downsample", factor=factor, voxels=seriesVolumeNode.GetImageData().GetNumberOfPoints()) as stage:
+      downsampledVoxels = MemoryBudget.downsampleVolume(slicer.util.arrayFromVolume(seriesVolumeNode), factor)
+      # Voxel axes scaled by the factor, the first voxel centered on the first block
+      ijkToRas = vtk.vtkMatrix4x4()
+      seriesVolumeNode.GetIJKToRASMatrix(ijkToRas)
+      origin = ijkToRas.MultiplyPoint([(factor - 1) / 2.0] * 3 + [1.0])
+      for row in range(3):
+        for column in range(3):
+          ijkToRas.SetElement(row, column, ijkToRas.GetElement(row, column) * factor)
+        ijkToRas.SetElement(row, 3, origin[row])
+      downsampledVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", seriesVolumeNode.GetName() + " downsampled")
+      downsampledVolumeNode.SetIJKToRASMatrix(ijkToRas)
+      slicer.util.updateVolumeFromArray(downsampledVolumeNode, downsampledVoxels)
+      stage["downsampledVoxels"] = downsampledVoxels.size
+    if self.parameters["maxMemoryMB"]:
+      self.ReleaseVolume(seriesVolumeNode)
+    return downsampledVolumeNode
+
+  def ReleaseVolume(self, volumeNode):
+    # Drop the voxels right away, Python may still hold a reference to the node itself
+    volumeNode.SetAndObserveImageData(None)
+    if volumeNode.GetScene():
+      slicer.mrmlScene.RemoveNode(volumeNode)
+
+  def CropToThresholdRange(self, seriesVolumeNode):
+    """Return a volume node of the box containing all voxels inside any segment range,
+    or seriesVolumeNode itself if cropping would not remove anything.
+    """
+    with self.profiler.stage("crop", voxels=seriesVolumeNode.GetImageData().GetNumberOfPoints()) as stage:
+      voxels = slicer.util.arrayFromVolume(seriesVolumeNode)
+      box = self.ThresholdRangeBox(voxels, seriesVolumeNode.GetSpacing())
+      if box is None:
+        # Nothing to segment, keep the full volume so the result is the same as without cropping
+        stage["croppedVoxels"] = voxels.size
+        return seriesVolumeNode
+      lower, upper = box
+      stage["box"] = [lower, upper]
+      if lower == [0, 0, 0] and upper == [size - 1 for size in voxels.shape]:
+        stage["croppedVoxels"] = voxels.size
+        return seriesVolumeNode
+
+      croppedVoxels = np.ascontiguousarray(voxels[lower[0]:upper[0] + 1, lower[1]:upper[1] + 1, lower[2]:upper[2] + 1])
+      # Same axes and spacing, origin moved to the first voxel of the box
+      ijkToRas = vtk.vtkMatrix4x4()
+      seriesVolumeNode.GetIJKToRASMatrix(ijkToRas)
+      origin = ijkToRas.MultiplyPoint([lower[2], lower[1], lower[0], 1.0])
+      for row in range(3):
+        ijkToRas.SetElement(row, 3, origin[row])
+      croppedVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", seriesVolumeNode.GetName() + " cropped")
+      croppedVolumeNode.SetIJKToRASMatrix(ijkToRas)
+      slicer.util.updateVolumeFromArray(croppedVolumeNode, croppedVoxels)
+      stage["croppedVoxels"] = croppedVoxels.size
+    del voxels, croppedVoxels
+    # Only the cropped copy is segmented, keeping both would raise the peak memory instead of lowering it
+    if not self.keepSceneNodes:
+      self.ReleaseVolume(seriesVolumeNode)
+    return croppedVolumeNode
+
+  def ThresholdRangeBox(self, voxels, spacing):
+    """Inclusive [lower, upper] array indices (K, J, I) of the box containing all voxels inside any segment range
+    plus a smoothing margin, or None if there are none.
+    """
+    from DICOM2OBJLib import SegmentSpec
+    bounds = SegmentSpec.thresholdBoundingBox(voxels, self.parameters["segments"], self.parameters["cropSampling"])
+    if bounds is None:
+      return None
+    # Keep a margin of half the largest median kernel (plus one background voxel) around the box,
+    # so smoothing and surface extraction see the same neighborhood as in the full volume
+    kernelSizeMm = max(segment["smoothingKernelSizeMm"] for segment in self.parameters["segments"])
+    kernelSize = self.KernelSizeInVoxels(spacing, kernelSizeMm)
+    # Array axes are K, J, I
+    margin = [max(kernelSize[2 - axis], 1) // 2 + 1 for axis in range(3)]
+    lower = [max(bounds[axis][0] - margin[axis], 0) for axis in range(3)]
+    upper = [min(bounds[axis][1] + margin[axis], voxels.shape[axis] - 1) for axis in range(3)]
+    return lower, upper
+
+  def SegmentVolume(self, seriesVolumeNode):
     segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
-    slicer.mrmlScene.AddNode(segmentationNode)
     segmentationNode.CreateDefaultDisplayNodes() # only needed for display
     segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(seriesVolumeNode)
-    
-    # TODO Automate creation of different segments in the future (using some form of -type argument)
-    # Create spine segment
-    segmentTypeID = "Spine"
-    newSegment = slicer.vtkSegment()
-    newSegment.SetName(segmentTypeID)
-    newSegment.SetColor([0.89, 0.85, 0.78])
-    segmentationNode.GetSegmentation().AddSegment(newSegment,segmentTypeID)
+
+    # Create segments of the segment specification (Spine by default), segment IDs are the segment names
+    for segment in self.parameters["segments"]:
+      newSegment = slicer.vtkSegment()
+      newSegment.SetName(segment["name"])
+      newSegment.SetColor(segment["color"])
+      segmentationNode.GetSegmentation().AddSegment(newSegment, segment["name"])
+
+    self.SetConversionParameters(segmentationNode)
+
+    if self.parameters["engine"] == "headless":
+      self.ThresholdAndSmoothHeadless(seriesVolumeNode, segmentationNode)
+    elif self.parameters["engine"] == "editor":
+      self.ThresholdAndSmoothWithEditor(seriesVolumeNode, segmentationNode)
+    else:
+      raise ValueError("Unknown segmentation engine: " + str(self.parameters["engine"]))
+    return segmentationNode
+
+  def SetConversionParameters(self, segmentationNode):
+    # Setting Closed Surface Representation Values
+    segmentationNode.GetSegmentation().SetConversionParameter("Oversampling factor", str(self.parameters["oversamplingFactor"]))
+    segmentationNode.GetSegmentation().SetConversionParameter("Joint smoothing", str(self.parameters["jointSmoothing"]))
+    segmentationNode.GetSegmentation().SetConversionParameter("Smoothing factor", str(self.parameters["surfaceSmoothingFactor"]))
+
+  def ThresholdAndSmoothWithEditor(self, seriesVolumeNode, segmentationNode):
+    # Access segmentation module
+    slicer.util.selectModule('Segment Editor')
 
     # Create segment editor widget to get access to effects
     segmentEditorWidget = slicer.qMRMLSegmentEditorWidget()
@@ -108,92 +605,519 @@ class DICOM2OBJLogic(ScriptedLoadableModuleLogic):
 
     # Access segment editor node
     segmentEditorNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentEditorNode")
-    slicer.mrmlScene.AddNode(segmentEditorNode)
     segmentEditorWidget.setMRMLSegmentEditorNode(segmentEditorNode)
     segmentEditorWidget.setSegmentationNode(segmentationNode)
     segmentEditorWidget.setMasterVolumeNode(seriesVolumeNode)
+    # Segments listed first keep voxels that are also in the range of later segments
+    segmentEditorNode.SetOverwriteMode(slicer.vtkMRMLSegmentEditorNode.OverwriteNone)
 
-    # Segment Editor Effect: Thresholding
-    segmentEditorWidget.setActiveEffectByName("Threshold")
-    effect = segmentEditorWidget.activeEffect()
-    effect.setParameter("MinimumThreshold","90")
-    effect.setParameter("MaximumThreshold","1600")
-    effect.self().onApply()
+    for segment in self.parameters["segments"]:
+      segmentEditorNode.SetSelectedSegmentID(segment["name"])
 
-    # Setting Closed Surface Representation Values
-    segmentationNode.GetSegmentation().SetConversionParameter("Oversampling factor", "1.0")
-    segmentationNode.GetSegmentation().SetConversionParameter("Joint smoothing", "0.50")
-    segmentationNode.GetSegmentation().SetConversionParameter("Smoothing factor", "0.50")
-
-    # Segment Editor Effect: Smoothing
-    segmentEditorWidget.setActiveEffectByName("Smoothing")
-    effect = segmentEditorWidget.activeEffect()
-    # 2mm MEDIAN Smoothing
-    effect.setParameter("SmoothingMethod", "MEDIAN")
-    effect.setParameter("KernelSizeMm", 2.5)
-    effect.self().onApply()
-    # 2mm OPEN Smoothing
-    #effect.setParameter("SmoothingMethod", "MORPHOLOGICAL_OPENING")
-    #effect.setParameter("KernelSizeMm", 2)
-    #effect.self().onApply
-    # 1.5mm CLOSED Smoothing
-    #effect.setParameter("SmoothingMethod", "MORPHOLOGICAL_CLOSING")
-    #effect.setParameter("KernelSizeMm", 1.5)
-    #effect.self().onApply
+      # Segment Editor Effect: Thresholding
+      segmentEditorWidget.setActiveEffectByName("Threshold")
+      effect = segmentEditorWidget.activeEffect()
+      effect.setParameter("MinimumThreshold", str(segment["minimumThreshold"]))
+      effect.setParameter("MaximumThreshold", str(segment["maximumThreshold"]))
+      with self.profiler.stage("threshold", segment=segment["name"], voxels=seriesVolumeNode.GetImageData().GetNumberOfPoints()):
+        effect.self().onApply()
 
+      # Segment Editor Effect: Smoothing
+      if segment["smoothingKernelSizeMm"] > 0:
+        segmentEditorWidget.setActiveEffectByName("Smoothing")
+        effect = segmentEditorWidget.activeEffect()
+        # 2.5mm MEDIAN Smoothing
+        effect.setParameter("SmoothingMethod", "MEDIAN")
+        effect.setParameter("KernelSizeMm", segment["smoothingKernelSizeMm"])
+        with self.profiler.stage("median", segment=segment["name"], voxels=seriesVolumeNode.GetImageData().GetNumberOfPoints()):
+          effect.self().onApply()
+      # 2mm OPEN Smoothing
+      #effect.setParameter("SmoothingMethod", "MORPHOLOGICAL_OPENING")
+      #effect.setParameter("KernelSizeMm", 2)
+      #effect.self().onApply
+      # 1.5mm CLOSED Smoothing
+      #effect.setParameter("SmoothingMethod", "MORPHOLOGICAL_CLOSING")
+      #effect.setParameter("KernelSizeMm", 1.5)
+      #effect.self().onApply
+
+    # Clean up
+    segmentEditorWidget = None
+    slicer.mrmlScene.RemoveNode(segmentEditorNode)
+
+  def ThresholdAndSmoothHeadless(self, seriesVolumeNode, segmentationNode):
+    # Same filters as the Threshold and MEDIAN Smoothing effects, run directly on the
+    # volume's image data so no Segment Editor widget (or Qt GUI) is needed
+    from DICOM2OBJLib import SegmentSpec
+    from vtk.util import numpy_support
+    segments = self.parameters["segments"]
+
+    # Thresholding: a single sweep over the volume labels the voxels of all segments
+    with self.profiler.stage("threshold", voxels=seriesVolumeNode.GetImageData().GetNumberOfPoints()) as stage:
+      labels = SegmentSpec.thresholdLabelmap(slicer.util.arrayFromVolume(seriesVolumeNode), segments)
+      stage["segmentVoxels"] = dict(zip([segment["name"] for segment in segments], np.bincount(labels.ravel(), minlength=len(segments) + 1)[1:].tolist()))
+    labelImage = vtk.vtkImageData()
+    labelImage.SetDimensions(seriesVolumeNode.GetImageData().GetDimensions())
+    labelImage.GetPointData().SetScalars(numpy_support.numpy_to_vtk(labels.ravel(), deep=False, array_type=vtk.VTK_UNSIGNED_CHAR))
+    self.TrackObject(labelImage)
+    ijkToRas = vtk.vtkMatrix4x4()
+    seriesVolumeNode.GetIJKToRASMatrix(ijkToRas)
+    spacing = seriesVolumeNode.GetSpacing()
+    if self.parameters["maxMemoryMB"]:
+      # Only the uint8 labels are needed from here on
+      self.ReleaseVolume(seriesVolumeNode)
+
+    for labelValue, segment in enumerate(segments, 1):
+      with self.profiler.stage("segmentMask", segment=segment["name"]):
+        segmentMask = vtk.vtkImageThreshold()
+        segmentMask.SetInputData(labelImage)
+        segmentMask.ThresholdBetween(labelValue, labelValue)
+        segmentMask.SetInValue(1)
+        segmentMask.SetOutValue(0)
+        segmentMask.SetOutputScalarTypeToUnsignedChar()
+        segmentMask.Update()
+        segmentImage = segmentMask.GetOutput()
+
+      # MEDIAN Smoothing, kernel size rounded to an odd number of voxels like the Smoothing effect
+      if segment["smoothingKernelSizeMm"] > 0:
+        kernelSize = self.KernelSizeInVoxels(spacing, segment["smoothingKernelSizeMm"])
+        with self.profiler.stage("median", segment=segment["name"], voxels=segmentImage.GetNumberOfPoints(), kernelSize=kernelSize):
+          median = vtk.vtkImageMedian3D()
+          median.SetInputData(segmentImage)
+          median.SetKernelSize(*kernelSize)
+          median.Update()
+          segmentImage = median.GetOutput()
+
+      # Store result as the segment's binary labelmap in patient coordinates
+      labelmap = slicer.vtkOrientedImageData()
+      labelmap.ShallowCopy(segmentImage)
+      labelmap.SetImageToWorldMatrix(ijkToRas)
+      slicer.vtkSlicerSegmentationsModuleLogic.SetBinaryLabelmapToSegment(labelmap, segmentationNode, segment["name"])
+      # The segment holds its own copy, release the filter outputs before the next segment
+      segmentMask = median = segmentImage = labelmap = None
+
+    # Share one labelmap layer between non-overlapping segments, so their surfaces are extracted together
+    segmentationNode.GetSegmentation().CollapseBinaryLabelmaps(False)
+
+  @staticmethod
+  def KernelSizeInVoxels(spacing, kernelSizeMm):
+    return [int(round((kernelSizeMm / spacing[axis] + 1) / 2)) * 2 - 1 for axis in range(3)]
+
+  def CreateSurfaces(self, segmentationNode):
+    """Return (segment name, closed surface) of every segment."""
     # Create Closed Surface Representation
-    segmentationNode.CreateClosedSurfaceRepresentation()
+    with self.profiler.stage("closedSurface", extractor=self.parameters["surfaceExtractor"]) as stage:
+      if self.parameters["surfaceExtractor"] == "segmentation":
+        segmentationNode.CreateClosedSurfaceRepresentation()
+        surfaces = [(segment["name"], segmentationNode.GetClosedSurfaceInternalRepresentation(segment["name"]))
+          for segment in self.parameters["segments"]]
+      else:
+        surfaces = []
+        for segment in self.parameters["segments"]:
+          surfaceMesh = self.ExtractSurface(segmentationNode, segment["name"])
+          # Stored like a converted representation, so exporting models does not convert again
+          segmentationNode.GetSegmentation().GetSegment(segment["name"]).AddRepresentation(
+            slicer.vtkSegmentationConverter.GetSegmentationClosedSurfaceRepresentationName(), surfaceMesh)
+          surfaces.append((segment["name"], surfaceMesh))
+      stage["triangles"] = dict((segmentName, surfaceMesh.GetNumberOfPolys()) for segmentName, surfaceMesh in surfaces)
+
+    # Export Segmentation to Model Node (only needed for display, skipped in memory-bounded mode)
+    if self.parameters["maxMemoryMB"]:
+      return surfaces
+    with self.profiler.stage("exportModels"):
+      shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
+      exportFolderItemId = shNode.CreateFolderItem(shNode.GetSceneItemID(), "Segments")
+      slicer.modules.segmentations.logic().ExportAllSegmentsToModels(segmentationNode, exportFolderItemId)
+
+    return surfaces
+
+  def ExtractSurface(self, segmentationNode, segmentID):
+    """Closed surface of one segment's binary labelmap in patient coordinates, extracted with
+    discrete flying edges or marching cubes and smoothed like the segmentation conversion rule.
+    """
+    labelmap = slicer.vtkOrientedImageData()
+    segmentationNode.GetBinaryLabelmapRepresentation(segmentID, labelmap)
+    imageToWorld = vtk.vtkMatrix4x4()
+    labelmap.GetImageToWorldMatrix(imageToWorld)
+
+    # Voxels of this segment as 1, in IJK coordinates
+    mask = vtk.vtkImageThreshold()
+    mask.SetInputData(labelmap)
+    mask.ThresholdByUpper(1)
+    mask.SetInValue(1)
+    mask.SetOutValue(0)
+    mask.SetOutputScalarTypeToUnsignedChar()
+    identityGeometry = vtk.vtkImageChangeInformation()
+    identityGeometry.SetInputConnection(mask.GetOutputPort())
+    identityGeometry.SetOutputOrigin(0, 0, 0)
+    identityGeometry.SetOutputSpacing(1, 1, 1)
+    # Background border, so surfaces touching the image boundary are closed
+    extent = labelmap.GetExtent()
+    padder = vtk.vtkImageConstantPad()
+    padder.SetInputConnection(identityGeometry.GetOutputPort())
+    padder.SetOutputWholeExtent(extent[0] - 1, extent[1] + 1, extent[2] - 1, extent[3] + 1, extent[4] - 1, extent[5] + 1)
+    padder.SetConstant(0)
+
+    extractor = self.CreateSurfaceExtractor(self.parameters["surfaceExtractor"])
+    extractor.SetInputConnection(padder.GetOutputPort())
+    extractor.Update()
+    return self.SmoothExtractedSurface(extractor.GetOutput(), imageToWorld)
+
+  @staticmethod
+  def CreateSurfaceExtractor(extractorName):
+    if extractorName == "flyingEdges":
+      extractor = vtk.vtkDiscreteFlyingEdges3D()
+    elif extractorName == "marchingCubes":
+      extractor = vtk.vtkDiscreteMarchingCubes()
+    else:
+      raise ValueError("Unknown surface extractor: " + str(extractorName))
+    extractor.SetValue(0, 1)
+    extractor.ComputeNormalsOff()
+    extractor.ComputeGradientsOff()
+    extractor.ComputeScalarsOff()
+    return extractor
+
+  def SmoothExtractedSurface(self, rawSurface, imageToWorld):
+    """Smooth a surface extracted in IJK coordinates like the segmentation conversion rule
+    and return it in patient coordinates with outward normals.
+    """
+    surface = vtk.vtkTrivialProducer()
+    surface.SetOutput(rawSurface)
+
+    smoothingFactor = self.parameters["surfaceSmoothingFactor"]
+    if smoothingFactor > 0:
+      smoother = vtk.vtkWindowedSincPolyDataFilter()
+      smoother.SetInputConnection(surface.GetOutputPort())
+      smoother.SetNumberOfIterations(20)
+      smoother.SetPassBand(pow(10.0, -4.0 * smoothingFactor))
+      smoother.BoundarySmoothingOff()
+      smoother.FeatureEdgeSmoothingOff()
+      smoother.NonManifoldSmoothingOn()
+      smoother.NormalizeCoordinatesOn()
+      surface = smoother
+
+    # IJK to patient coordinates
+    transform = vtk.vtkTransform()
+    transform.SetMatrix(imageToWorld)
+    transformFilter = vtk.vtkTransformPolyDataFilter()
+    transformFilter.SetInputConnection(surface.GetOutputPort())
+    transformFilter.SetTransform(transform)
+    # Outward normals, also where the IJK to RAS matrix mirrors the surface
+    normals = vtk.vtkPolyDataNormals()
+    normals.SetInputConnection(transformFilter.GetOutputPort())
+    normals.ConsistencyOn()
+    normals.SplittingOff()
+    normals.AutoOrientNormalsOn()
+    normals.Update()
+    return normals.GetOutput()
+
+  def CreateSurfacesBySlabs(self, inputDir, series):
+    """Return (segment name, closed surface) of every segment, segmenting the series in slabs of
+    slabSlices slices read from a memory-mapped volume file instead of loading the whole volume.
+    """
+    import shutil
+    import tempfile
+    from DICOM2OBJLib import DicomArchive, SegmentSpec, SlabStreaming
+    segments = self.parameters["segments"]
+    # The segmentation conversion rule is discrete marching cubes
+    extractorName = "marchingCubes" if self.parameters["surfaceExtractor"] == "segmentation" else self.parameters["surfaceExtractor"]
+    with tempfile.TemporaryDirectory(prefix="DICOM2OBJ-") as workDir:
+      with self.profiler.stage("load", files=len(series.instances)) as stage:
+        if DicomArchive.isArchive(inputDir):
+          spoolDir = os.path.join(workDir, "spool")
+          os.makedirs(spoolDir)
+          series = DicomArchive.spoolSeries(inputDir, series, spoolDir)
+        volume, ijkToRasArray = SlabStreaming.writeVolumeFile(series, os.path.join(workDir, "volume.raw"))
+        if DicomArchive.isArchive(inputDir):
+          shutil.rmtree(spoolDir)
+        stage["voxels"] = volume.size
+      ijkToRas = vtk.vtkMatrix4x4()
+      for row in range(4):
+        for column in range(4):
+          ijkToRas.SetElement(row, column, ijkToRasArray[row][column])
+      spacing = [np.linalg.norm([ijkToRasArray[row][axis] for row in range(3)]) for axis in range(3)]
+      kernelSizes = [self.KernelSizeInVoxels(spacing, segment["smoothingKernelSizeMm"]) if segment["smoothingKernelSizeMm"] > 0 else None
+        for segment in segments]
+      # Overlap of half the largest median kernel along K
+      margin = max([kernelSize[2] // 2 for kernelSize in kernelSizes if kernelSize] + [0])
+      slabs = SlabStreaming.slabRanges(volume.shape[0], self.parameters["slabSlices"])
+      logging.info("Segmenting {0} slices in {1} slabs, about {2:.0f} MB each".format(volume.shape[0], len(slabs),
+        SlabStreaming.estimateSlabMemoryMB(volume.shape[1] * volume.shape[2], self.parameters["slabSlices"], margin)))
+
+      pieces = [[] for segment in segments]
+      for first, last in slabs:
+        with self.profiler.stage("slab", first=first, last=last) as stage:
+          voxels, firstIndex = SlabStreaming.readSlab(volume, first, last, margin)
+          labels = SegmentSpec.thresholdLabelmap(voxels, segments)
+          del voxels
+          stage["voxels"] = labels.size
+          stage["triangles"] = 0
+          for labelValue, (segment, kernelSize) in enumerate(zip(segments, kernelSizes), 1):
+            piece = self.ExtractSlabSurface(labels == labelValue, firstIndex, last - first, kernelSize, extractorName,
+              first == 0, last == volume.shape[0] - 1, first)
+            if piece is not None:
+              pieces[labelValue - 1].append(piece)
+              stage["triangles"] += piece.GetNumberOfPolys()
+          del labels
+      del volume
+
+    surfaces = []
+    with self.profiler.stage("closedSurface", extractor=extractorName, slabs=len(slabs)) as stage:
+      for segmentIndex, segment in enumerate(segments):
+        surfaces.append((segment["name"], self.StitchSlabSurfaces(pieces[segmentIndex], ijkToRas)))
+        # Each segment's pieces are released once stitched
+        pieces[segmentIndex] = None
+      stage["triangles"] = dict((segmentName, surfaceMesh.GetNumberOfPolys()) for segmentName, surfaceMesh in surfaces)
+    return surfaces
+
+  def ExtractSlabSurface(self, mask, firstIndex, planes, kernelSize, extractorName, closeBelow, closeAbove, firstPlane):
+    """Raw surface in IJK coordinates of the planes firstIndex..firstIndex+planes of a segment's slab mask
+    (array axes K, J, I), or None if the segment has no voxels in the slab.
+    """
+    from vtk.util import numpy_support
+    if not mask.any():
+      return None
+    # Booleans are stored as bytes, VTK reads the mask as unsigned char without a copy
+    mask = np.ascontiguousarray(mask).view(np.uint8)
+    maskImage = vtk.vtkImageData()
+    # IJK coordinates of the full volume, so shared planes of neighboring slabs give identical points
+    firstSlabPlane = firstPlane - firstIndex
+    maskImage.SetExtent(0, mask.shape[2] - 1, 0, mask.shape[1] - 1, firstSlabPlane, firstSlabPlane + mask.shape[0] - 1)
+    maskImage.GetPointData().SetScalars(numpy_support.numpy_to_vtk(mask.ravel(), deep=False, array_type=vtk.VTK_UNSIGNED_CHAR))
+    image = vtk.vtkTrivialProducer()
+    image.SetOutput(maskImage)
+    if kernelSize:
+      # MEDIAN Smoothing, the overlap makes the result on the slab's planes the same as on the full volume
+      median = vtk.vtkImageMedian3D()
+      median.SetInputConnection(image.GetOutputPort())
+      median.SetKernelSize(*kernelSize)
+      image = median
+    # Crop to the slab's planes with a background border around the sides, and below and above only where
+    # the volume ends, so the surface is closed there and open towards the neighboring slabs
+    pad = vtk.vtkImageConstantPad()
+    pad.SetInputConnection(image.GetOutputPort())
+    pad.SetConstant(0)
+    pad.SetOutputWholeExtent(-1, mask.shape[2], -1, mask.shape[1], firstPlane - int(closeBelow), firstPlane + planes + int(closeAbove))
+    extractor = self.CreateSurfaceExtractor(extractorName)
+    extractor.SetInputConnection(pad.GetOutputPort())
+    extractor.Update()
+    piece = vtk.vtkPolyData()
+    piece.ShallowCopy(extractor.GetOutput())
+    return piece
 
-    # Export Segmentation to Model Node
-    shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-    exportFolderItemId = shNode.CreateFolderItem(shNode.GetSceneItemID(), "Segments")
-    slicer.modules.segmentations.logic().ExportAllSegmentsToModels(segmentationNode, exportFolderItemId)
+  def StitchSlabSurfaces(self, pieces, ijkToRas):
+    """Merge the raw slab surfaces of one segment into a single mesh and smooth it."""
+    if not pieces:
+      return vtk.vtkPolyData()
+    append = vtk.vtkAppendPolyData()
+    for piece in pieces:
+      append.AddInputData(piece)
+    # Points on shared planes are identical, merging them closes the seams
+    merge = vtk.vtkCleanPolyData()
+    merge.SetInputConnection(append.GetOutputPort())
+    merge.ToleranceIsAbsoluteOn()
+    merge.SetAbsoluteTolerance(0.0)
+    merge.PointMergingOn()
+    merge.ConvertLinesToPointsOff()
+    merge.ConvertPolysToLinesOff()
+    merge.ConvertStripsToPolysOff()
+    merge.Update()
+    return self.SmoothExtractedSurface(merge.GetOutput(), ijkToRas)
+
+  def ConvertArray(self, voxels, spacing=(1.0, 1.0, 1.0), origin=(0.0, 0.0, 0.0), direction=None):
+    """Segment a volume array indexed [k, j, i] (like slicer.util.arrayFromVolume) in memory and return
+    (segment name, vertices, faces) of every segment: vertices an N x 3 array of RAS coordinates and faces
+    an M x 3 array of vertex indices, both sharing the memory of the final VTK meshes.
+    spacing is along i, j, k; origin is the RAS position of voxel (0, 0, 0); direction is a 3 x 3 matrix whose
+    columns are the RAS directions of the i, j and k axes (identity by default).
+    Uses the headless filters on views of voxels, without scene nodes, files or a DICOM database;
+    the segmentation conversion rule is replaced by discrete marching cubes and there is no oversampling.
+    """
+    from DICOM2OBJLib import SegmentSpec
+    voxels = np.asarray(voxels)
+    if voxels.ndim != 3:
+      raise ValueError("Volume array must have 3 dimensions, not {0}".format(voxels.ndim))
+    segments = self.parameters["segments"]
+    ijkToRasArray = np.identity(4)
+    ijkToRasArray[:3, :3] = (np.identity(3) if direction is None else np.asarray(direction, dtype=float)) * np.asarray(spacing, dtype=float)
+    ijkToRasArray[:3, 3] = origin
+    extractorName = "marchingCubes" if self.parameters["surfaceExtractor"] == "segmentation" else self.parameters["surfaceExtractor"]
+    self.profiler.reset()
+
+    emptyResult = [(segment["name"], np.zeros((0, 3), dtype=np.float32), np.zeros((0, 3), dtype=np.int64)) for segment in segments]
+    if self.parameters["cropToThresholdRange"]:
+      with self.profiler.stage("crop", voxels=voxels.size) as stage:
+        box = self.ThresholdRangeBox(voxels, spacing)
+        if box is None:
+          return emptyResult
+        lower, upper = box
+        # A view, the origin moves to the first voxel of the box
+        voxels = voxels[lower[0]:upper[0] + 1, lower[1]:upper[1] + 1, lower[2]:upper[2] + 1]
+        ijkToRasArray[:3, 3] = np.dot(ijkToRasArray, [lower[2], lower[1], lower[0], 1.0])[:3]
+        stage["croppedVoxels"] = voxels.size
+    ijkToRas = vtk.vtkMatrix4x4()
+    for row in range(4):
+      for column in range(4):
+        ijkToRas.SetElement(row, column, ijkToRasArray[row][column])
+
+    with self.profiler.stage("threshold", voxels=voxels.size):
+      labels = SegmentSpec.thresholdLabelmap(voxels, segments)
+    results = []
+    for labelValue, segment in enumerate(segments, 1):
+      kernelSize = self.KernelSizeInVoxels(spacing, segment["smoothingKernelSizeMm"]) if segment["smoothingKernelSizeMm"] > 0 else None
+      with self.profiler.stage("closedSurface", segment=segment["name"], extractor=extractorName) as stage:
+        rawSurface = self.ExtractSlabSurface(labels == labelValue, 0, labels.shape[0] - 1, kernelSize, extractorName, True, True, 0)
+        surfaceMesh = self.SmoothExtractedSurface(rawSurface, ijkToRas) if rawSurface is not None else None
+        stage["triangles"] = surfaceMesh.GetNumberOfPolys() if surfaceMesh is not None else 0
+      if surfaceMesh is None or surfaceMesh.GetNumberOfPolys() == 0:
+        results.append(emptyResult[labelValue - 1])
+        continue
+      surfaceMesh = self.ProcessSurface(surfaceMesh, segment["name"])
+      results.append((segment["name"],) + self.SurfaceArrays(surfaceMesh))
+    return results
+
+  @staticmethod
+  def SurfaceArrays(surfaceMesh):
+    """Points (N x 3) and triangle point ids (M x 3) of a triangle mesh, as arrays sharing its memory."""
+    from vtk.util import numpy_support
+    # The arrays keep the VTK arrays they view alive through the buffer protocol
+    vertices = numpy_support.vtk_to_numpy(surfaceMesh.GetPoints().GetData())
+    polys = surfaceMesh.GetPolys()
+    if hasattr(polys, "GetConnectivityArray"):
+      faces = numpy_support.vtk_to_numpy(polys.GetConnectivityArray()).reshape(-1, 3)
+    else:
+      # Before VTK 9 every cell is stored as its point count followed by its point ids
+      faces = numpy_support.vtk_to_numpy(polys.GetData()).reshape(-1, 4)[:, 1:]
+    return vertices, faces
+
+  def ProcessSurface(self, surfaceMesh, segmentName=None):
+    # A triangle or byte budget replaces the fixed reduction
+    budget = self.parameters["decimationTargetTriangles"] or self.parameters["decimationTargetBytes"]
+    surfaceMesh = self.DecimateSurface(surfaceMesh, 0.0 if budget else self.parameters["decimationTargetReduction"], segmentName)
+    return self.SmoothSurface(surfaceMesh, segmentName)
+
+  def ProcessLevelsOfDetail(self, surfaceMesh, segmentName=None):
+    """Return (target reduction, processed surface) of every level of detail, most detailed first.
+    Each level is decimated further from the previous level's decimated surface, not from the full surface.
+    """
+    levels = []
+    fullTriangles = surfaceMesh.GetNumberOfPolys()
+    for targetReduction in sorted(self.parameters["levelsOfDetail"]):
+      # Targets are fractions of the full surface, reached from the triangles the previous level actually kept
+      # (vtkDecimatePro may stop above its target)
+      inputTriangles = surfaceMesh.GetNumberOfPolys()
+      levelReduction = max(0.0, 1.0 - fullTriangles * (1.0 - targetReduction) / inputTriangles) if inputTriangles else 0.0
+      surfaceMesh = self.DecimateSurface(surfaceMesh, levelReduction, segmentName)
+      levels.append((targetReduction, self.SmoothSurface(surfaceMesh, segmentName)))
+    return levels
 
-    segmentID = segmentationNode.GetSegmentation().GetNthSegmentID(0)
-    surfaceMesh = segmentationNode.GetClosedSurfaceInternalRepresentation(segmentID)
+  def TargetTriangles(self, inputTriangles, targetReduction):
+    """Triangle count of decimating by targetReduction, capped by the triangle and byte budgets."""
+    from DICOM2OBJLib import MeshWriters
+    targetTriangles = int(round(inputTriangles * (1.0 - targetReduction)))
+    if self.parameters["decimationTargetTriangles"]:
+      targetTriangles = min(targetTriangles, int(self.parameters["decimationTargetTriangles"]))
+    if self.parameters["decimationTargetBytes"]:
+      targetTriangles = min(targetTriangles, MeshWriters.trianglesWithinBytes(self.parameters["decimationTargetBytes"],
+        self.parameters["outputFormats"], self.parameters["glbPositionType"]))
+    return max(targetTriangles, 1)
 
+  def DecimateSurface(self, surfaceMesh, targetReduction, segmentName=None):
     # Decimate Model
-    decimator = vtk.vtkDecimatePro()
-    decimator.SplittingOff()
-    decimator.PreserveTopologyOn()
-    decimator.SetTargetReduction(0.95)
-    decimator.SetInputData(surfaceMesh)
-    decimator.Update()
-    surfaceMesh = decimator.GetOutput()
+    inputTriangles = surfaceMesh.GetNumberOfPolys()
+    targetTriangles = self.TargetTriangles(inputTriangles, targetReduction)
+    method = self.parameters["decimationMethod"]
+    with self.profiler.stage("decimate", segment=segmentName, method=method, inputTriangles=inputTriangles, targetTriangles=targetTriangles) as stage:
+      if targetTriangles < inputTriangles:
+        if method == "pro":
+          decimator = vtk.vtkDecimatePro()
+          decimator.SplittingOff()
+          decimator.PreserveTopologyOn()
+          decimator.SetTargetReduction(1.0 - float(targetTriangles) / inputTriangles)
+          decimator.SetInputData(surfaceMesh)
+          decimator.Update()
+          surfaceMesh = decimator.GetOutput()
+        elif method == "quadric":
+          decimator = vtk.vtkQuadricDecimation()
+          decimator.VolumePreservationOn()
+          decimator.SetTargetReduction(1.0 - float(targetTriangles) / inputTriangles)
+          decimator.SetInputData(surfaceMesh)
+          decimator.Update()
+          surfaceMesh = decimator.GetOutput()
+        elif method == "clustering":
+          surfaceMesh = self.ClusterSurface(surfaceMesh, targetTriangles)
+        else:
+          raise ValueError("Unknown decimation method: " + str(method))
+      stage["triangles"] = surfaceMesh.GetNumberOfPolys()
+    logging.info("Decimated {0} with {1} from {2} to {3} triangles (target {4}) in {5}s".format(
+      segmentName, method, inputTriangles, stage["triangles"], targetTriangles, stage["wallSeconds"]))
+    if stage["triangles"] > targetTriangles:
+      # vtkDecimatePro stops early where it cannot remove more triangles without changing the topology
+      logging.warning("Decimation of {0} did not reach the target of {1} triangles".format(segmentName, targetTriangles))
+    return surfaceMesh
 
+  def ClusterSurface(self, surfaceMesh, targetTriangles):
+    # Quadric clustering is controlled by its number of bins, not by the output size. The triangle count
+    # of a surface grows with the square of the divisions per axis, so they are corrected a few times.
+    results = []
+    divisions = max(int(np.sqrt(targetTriangles)), 2)
+    for attempt in range(4):
+      clustering = vtk.vtkQuadricClustering()
+      clustering.SetNumberOfDivisions(divisions, divisions, divisions)
+      clustering.SetInputData(surfaceMesh)
+      clustering.Update()
+      output = clustering.GetOutput()
+      triangles = output.GetNumberOfPolys()
+      results.append((triangles, output))
+      if 0.9 * targetTriangles <= triangles <= targetTriangles:
+        break
+      divisions = max(int(divisions * 0.98 * np.sqrt(float(targetTriangles) / max(triangles, 1))), 2)
+    # Largest result within the target, otherwise the smallest one
+    return max(results, key=lambda result: (result[0] <= targetTriangles, result[0] if result[0] <= targetTriangles else -result[0]))[1]
+
+  def SmoothSurface(self, surfaceMesh, segmentName=None):
     # Smooth the Model
-    smoothingFactor = 0.5
-    smoother = vtk.vtkWindowedSincPolyDataFilter()
-    smoother.SetInputData(surfaceMesh)
-    smoother.SetNumberOfIterations(50)
-    smoother.SetPassBand(pow(10.0, -4.0 * smoothingFactor))
-    smoother.BoundarySmoothingOff()
-    smoother.FeatureEdgeSmoothingOff()
-    smoother.NonManifoldSmoothingOn()
-    smoother.NormalizeCoordinatesOn()
-    smoother.Update()
-    surfaceMesh = smoother.GetOutput()
+    with self.profiler.stage("meshSmoothing", segment=segmentName, triangles=surfaceMesh.GetNumberOfPolys()):
+      smoothingFactor = self.parameters["meshSmoothingFactor"]
+      smoother = vtk.vtkWindowedSincPolyDataFilter()
+      smoother.SetInputData(surfaceMesh)
+      smoother.SetNumberOfIterations(self.parameters["meshSmoothingIterations"])
+      smoother.SetPassBand(pow(10.0, -4.0 * smoothingFactor))
+      smoother.BoundarySmoothingOff()
+      smoother.FeatureEdgeSmoothingOff()
+      smoother.NonManifoldSmoothingOn()
+      smoother.NormalizeCoordinatesOn()
+      smoother.Update()
+      surfaceMesh = smoother.GetOutput()
 
     # Clean up Model
-    cleaner = vtk.vtkCleanPolyData()
-    #cleaner.PointMergingOff()
-    #cleaner.ConvertLinesToPointsOn()
-    #cleaner.ConvertPolysToLinesOn()
-    #cleaner.ConvertStripsToPolysOn()
-    cleaner.SetInputData(surfaceMesh)
-    cleaner.Update()
-    surfaceMesh = cleaner.GetOutput()
-
-    # Write to OBJ File
-    outputFileName = outputDir + "segmentation.obj"
-    writer = vtk.vtkOBJWriter()
-    writer.SetFileName(outputFileName)
-    writer.SetInputData(surfaceMesh)
-    writer.Update()
+    with self.profiler.stage("clean", segment=segmentName, inputTriangles=surfaceMesh.GetNumberOfPolys()) as stage:
+      cleaner = vtk.vtkCleanPolyData()
+      #cleaner.PointMergingOff()
+      #cleaner.ConvertLinesToPointsOn()
+      #cleaner.ConvertPolysToLinesOn()
+      #cleaner.ConvertStripsToPolysOn()
+      cleaner.SetInputData(surfaceMesh)
+      cleaner.Update()
+      stage["triangles"] = cleaner.GetOutput().GetNumberOfPolys()
+    return cleaner.GetOutput()
 
-    # Clean up
-    segmentEditorWidget = None
-    slicer.mrmlScene.RemoveNode(segmentEditorNode)
+  def OutputFileBaseName(self, segmentName):
+    # A single segment is written as segmentation.<format>, several as segmentation_<segment name>.<format>
+    if len(self.parameters["segments"]) == 1:
+      return "segmentation"
+    return "segmentation_" + "".join(character if character.isalnum() or character in "-_" else "_" for character in segmentName)
+
+  def WriteSurface(self, surfaceMesh, outputDir, fileBaseName="segmentation"):
+    # Write to OBJ (and any other requested format) Files
+    from DICOM2OBJLib import MeshWriters
+    with self.profiler.stage("write", file=fileBaseName, triangles=surfaceMesh.GetNumberOfPolys()) as stage:
+      outputFiles = MeshWriters.writeMesh(surfaceMesh, os.path.join(outputDir, fileBaseName),
+        self.parameters["outputFormats"], self.parameters["glbPositionType"])
+      stage["bytes"] = dict((os.path.basename(fileName), os.path.getsize(fileName)) for fileName in outputFiles)
+    byteBudget = self.parameters["decimationTargetBytes"]
+    for fileName, fileSize in stage["bytes"].items():
+      if byteBudget and fileSize > byteBudget:
+        logging.warning("{0} is {1} bytes, above the budget of {2} bytes".format(fileName, fileSize, byteBudget))
 
     # Send segment to output folder
     #outputFolder = "Z:/GitHub/andrewxr.io"
@@ -201,28 +1125,261 @@ class DICOM2OBJLogic(ScriptedLoadableModuleLogic):
     #segmentIDs.InsertNextValue(segmentTypeID)
     #slicer.vtkSlicerSegmentationsModuleLogic.ExportSegmentsClosedSurfaceRepresentationToFiles(outputFolder, segmentationNode, segmentIDs, "OBJ", True, 1.0, False)
 
-def main(argv):
+    return outputFiles
+
+  def WriteLevelsOfDetailManifest(self, outputDir, levelsOfDetail):
+    # Lists the file of every segment and level so viewers can pick a preview or detailed mesh
+    import json
+    manifestFileName = os.path.join(outputDir, "DICOM2OBJ_lod.json")
+    with open(manifestFileName, "w") as manifestFile:
+      json.dump({"levels": levelsOfDetail}, manifestFile, indent=2)
+    return manifestFileName
+
+  def ResetScene(self):
+    # Remove everything a conversion left behind so the next job starts from an empty scene
+    slicer.mrmlScene.Clear(0)
+
+  def RunJob(self, inputDir, outputDir, cancelFile=None):
+    """Convert one study without raising and return a status dictionary.
+    The scene is reset afterwards so the process can be reused.
+    """
+    from DICOM2OBJLib import ProgressEvents
+    startTime = time.time()
+    try:
+      os.makedirs(outputDir, exist_ok=True)
+      self.ProceduralSegmentation(inputDir, outputDir, cancelFile)
+      status = {"status": "ok"}
+    except ProgressEvents.ConversionCancelled as e:
+      logging.warning("DICOM2OBJ conversion cancelled: " + inputDir)
+      status = {"status": "cancelled", "error": str(e)}
+    except Exception as e:
+      logging.exception("DICOM2OBJ conversion failed: " + inputDir)
+      status = {"status": "error", "error": str(e)}
+    finally:
+      self.ResetScene()
+    status.update({"input": inputDir, "output": outputDir, "seconds": round(time.time() - startTime, 3)})
+    return status
+
+  def RunBatch(self, jobs):
+    # Convert every (inputDir, outputDir) job in this process, continuing past failed studies
+    from DICOM2OBJLib import BatchConversion
+    statuses = []
+    for jobIndex, (inputDir, outputDir) in enumerate(jobs, 1):
+      status = self.RunJob(inputDir, outputDir)
+      try:
+        BatchConversion.writeStatus(outputDir, status)
+      except OSError as e:
+        logging.error("Could not write status for {0}: {1}".format(inputDir, e))
+      print("[{0}/{1}] {2} {3} ({4}s)".format(jobIndex, len(jobs), status["status"], inputDir, status["seconds"]))
+      statuses.append(status)
+    return statuses
+
+  def Serve(self, socketPath=None, port=8750):
+    # Keep this process warm and run conversions sent to the server until it is shut down
+    from DICOM2OBJLib import ConversionServer
+    ConversionServer.serve(self, socketPath=socketPath, port=port)
+
+def main(argv, startupProfile=None):
+  """Run the command line. startupProfile is the import timing installed at the top of the __main__ block."""
+  from DICOM2OBJLib import ProgressEvents, StartupProfile
+  exitStatus = 0
   try:
     parser = argparse.ArgumentParser(description="InnovateVisualizer DICOM2OBJ Converter")
-    parser.add_argument("-i", "--input-folder", dest="input_folder", metavar="PATH", default="-", required=True, help="Folder of input DICOM files (can contain sub-folders)")
+    parser.add_argument("-i", "--input-folder", dest="input_folder", metavar="PATH", default="-", help="Folder of input DICOM files (can contain sub-folders), or a .zip/.tar.gz archive of them")
     parser.add_argument("-o", "--output-folder", dest="output_folder", metavar="PATH", default=".", help="Folder to save obj data")
+    parser.add_argument("-f", "--format", dest="format", metavar="FORMATS", default="obj", help="Comma separated output formats: obj, stl, glb (e.g. obj,glb)")
+    parser.add_argument("--glb-positions", dest="glb_positions", choices=["float32", "int16"], default="float32", help="GLB vertex position type, int16 is quantized and smaller")
+    parser.add_argument("--decimation", dest="decimation", choices=["pro", "quadric", "clustering"], default="pro", help="Decimation algorithm: pro preserves topology, quadric is faster, clustering is fastest")
+    parser.add_argument("--max-triangles", dest="max_triangles", type=int, default=None, help="Decimate each segment mesh to at most this many triangles instead of by 95%%")
+    parser.add_argument("--max-file-mb", dest="max_file_mb", type=float, default=None, help="Decimate each segment mesh so every output file is expected to stay below this size")
+    parser.add_argument("--lod", dest="lod", metavar="REDUCTIONS", default=None, help="Comma separated target reductions of levels of detail written from one run, e.g. 0.8,0.95,0.99")
+    parser.add_argument("--dicom-import", dest="dicom_import", choices=["scanner", "database"], default="scanner", help="Index DICOM files with the parallel header scanner or import them into a temporary DICOM database")
+    parser.add_argument("--series-policy", dest="series_policy", choices=["largest", "thinnest"], default="largest", help="Segment the axial CT series with the most slices or with the thinnest slices")
+    parser.add_argument("--series-uid", dest="series_uid", metavar="UID", default=None, help="SeriesInstanceUID of the series to segment (overrides --series-policy)")
+    parser.add_argument("--engine", dest="engine", choices=["editor", "headless"], default="editor", help="Run thresholding and smoothing through the Segment Editor effects or directly on the volume without any widget")
+    parser.add_argument("--no-crop", dest="no_crop", action="store_true", help="Segment the full volume instead of cropping it to the voxels inside the segment ranges first")
+    parser.add_argument("--crop-sampling", dest="crop_sampling", type=int, default=1, help="Find the crop region on every n-th voxel along each axis (faster, may miss structures thinner than n voxels)")
+    parser.add_argument("--max-memory", dest="max_memory", metavar="MB", type=float, default=None, help="Release intermediate data as early as possible and convert at a coarser resolution if the estimated peak memory would exceed this limit")
+    parser.add_argument("--slab-slices", dest="slab_slices", type=int, default=None, help="Segment the volume in slabs of this many slices streamed from a memory-mapped file, for volumes larger than memory")
+    parser.add_argument("--quality", dest="quality", choices=["preview", "draft", "standard", "archival"], default=None, help="Oversampling, smoothing kernels and iterations of a quality level (with --time-budget: the best level allowed)")
+    parser.add_argument("--time-budget", dest="time_budget", metavar="SECONDS", type=float, default=None, help="Use the best quality level whose estimated conversion time fits this budget")
+    parser.add_argument("--surface-extractor", dest="surface_extractor", choices=["segmentation", "flyingEdges", "marchingCubes"], default="segmentation", help="Labelmap to surface conversion: the segmentation's conversion rule, or per segment with multi-threaded discrete flying edges or marching cubes")
+    parser.add_argument("--threads", dest="threads", type=int, default=None, help="Threads used by VTK filters of each job (default: all cores)")
+    parser.add_argument("--smp-backend", dest="smp_backend", choices=["sequential", "stdthread", "tbb", "openmp"], default=None, help="VTK SMP backend of each job (needs VTK 9.1 or later)")
+    parser.add_argument("--no-cache", dest="no_cache", action="store_true", help="Always run the full conversion instead of serving results from the cache")
+    parser.add_argument("--no-intermediate-cache", dest="no_intermediate_cache", action="store_true", help="Do not cache the labelmap and closed surfaces, which let reruns with other mesh parameters skip segmentation")
+    parser.add_argument("--purge-cache", dest="purge_cache", action="store_true", help="Delete all cached results before converting")
+    parser.add_argument("--cache-dir", dest="cache_dir", metavar="PATH", default=None, help="Folder of the result cache (default: DICOM2OBJ in the Slicer cache folder)")
+    parser.add_argument("--cache-size-mb", dest="cache_size_mb", type=float, default=2048, help="Size limit of the result cache, least recently used results are evicted beyond it")
+    parser.add_argument("--profile", dest="profile", action="store_true", help="Write wall time, CPU time, memory, voxel and triangle counts of every stage to DICOM2OBJ_profile.json in the output folder")
+    parser.add_argument("--progress", dest="progress", metavar="PATH", default=None, help="Write JSON lines progress events (stage start/end, percent, voxel and triangle counts) to a file, or to stdout with '-'")
+    parser.add_argument("--cancel-file", dest="cancel_file", metavar="PATH", default=None, help="Stop the conversion before its next stage once this file exists (SIGTERM/SIGINT also stop it cleanly with --progress)")
+    parser.add_argument("--benchmark", dest="benchmark", action="store_true", help="Run the offline benchmark on synthetic phantoms, results are written to --output-folder")
+    parser.add_argument("--benchmark-cases", dest="benchmark_cases", metavar="CASES", default=None, help="Comma separated <shape>-<size> cases (shapes: cylinder, vertebra; sizes: 128, 256, 512, 512x1500) or 'all' (default: the 128 and 256 cases)")
+    parser.add_argument("--benchmark-baseline", dest="benchmark_baseline", metavar="PATH", default=None, help="Benchmark baseline to compare against, exits with an error on regressions")
+    parser.add_argument("--save-baseline", dest="save_baseline", action="store_true", help="Store the benchmark results as the new --benchmark-baseline")
+    parser.add_argument("--benchmark-tolerance", dest="benchmark_tolerance", type=float, default=0.25, help="Relative growth in time or memory reported as a regression")
+    parser.add_argument("--startup-report", dest="startup_report", action="store_true", help="Print the application startup time and the import time of every module imported by the conversion")
+    parser.add_argument("--lean-launch-arguments", dest="lean_launch_arguments", action="store_true", help="Print the Slicer arguments that skip loading the modules of this installation the conversion (with the selected --engine and --dicom-import) does not use")
+    parser.add_argument("--leak-check", dest="leak_check", metavar="RUNS", type=int, default=None, help="Convert --input-folder this many times in one process and report scene nodes, live VTK objects, Python objects and memory after every run")
+    parser.add_argument("--batch", dest="batch", metavar="PATH", default=None, help="Convert every study listed in a CSV/JSONL manifest, or every sub-folder of a folder, into --output-folder")
+    parser.add_argument("--serve", dest="serve", action="store_true", help="Keep Slicer running and accept conversion jobs over HTTP instead of converting a single study")
+    parser.add_argument("--socket", dest="socket", metavar="PATH", default=None, help="Unix socket to listen on in server mode (default: localhost TCP port)")
+    parser.add_argument("--port", dest="port", type=int, default=8750, help="Localhost TCP port to listen on in server mode")
     #parser.add_argument("-d","--copyDICOM",dest="copyDICOM",type=bool,default=False, help="Organize DICOM files in the output directory")
-    #parser.add_argument("-type", dest="type", type=string, default = "", help="Type of segmentation to take from .dcm data")
+    parser.add_argument("-type", "--type", dest="type", metavar="PRESET_OR_PATH", default=None, help="Segments to extract: a preset name (spine, bone-soft-tissue) or a JSON segment specification file (default: spine)")
     args = parser.parse_args(argv)
+    # Timing wraps every import of the process, so it is only installed when the timings are reported
+    if (args.startup_report or args.profile) and startupProfile is None:
+      startupProfile = StartupProfile.StartupProfile()
+      startupProfile.install()
 
-    if args.input_folder == "-":
-      print('Please specify input DICOM study folder!')
-    if args.output_folder == ".":
-      print('Current directory is selected as output folder (default). To change it, please specify --output-folder')
+    moduleManager = slicer.app.moduleManager()
+    if args.lean_launch_arguments:
+      moduleNames = StartupProfile.PIPELINE_MODULES["DICOM2OBJ"] + (StartupProfile.EDITOR_MODULES if args.engine == "editor" else []) + (
+        StartupProfile.DATABASE_MODULES if args.dicom_import == "database" else [])
+      print(" ".join(StartupProfile.leanLaunchArguments(moduleManager, moduleNames)))
+      sys.exit()
+    # A lean launch may not have loaded the modules these options need
+    if args.engine == "editor" and not hasattr(slicer.modules, "segmenteditor"):
+      parser.error("--engine editor needs the Segment Editor module, which is not loaded; use --engine headless")
+    if args.dicom_import == "database" and not hasattr(slicer.modules, "dicom"):
+      parser.error("--dicom-import database needs the DICOM module, which is not loaded; use --dicom-import scanner")
 
     logic = DICOM2OBJLogic()
-    logic.ProceduralSegmentation(args.input_folder, args.output_folder)
+    logic.startupProfile = startupProfile
+    logic.parameters["dicomImport"] = args.dicom_import
+    logic.parameters["seriesSelection"] = "uid" if args.series_uid else args.series_policy
+    logic.parameters["seriesInstanceUID"] = args.series_uid
+    logic.parameters["engine"] = args.engine
+    logic.parameters["cropToThresholdRange"] = not args.no_crop
+    logic.parameters["cropSampling"] = args.crop_sampling
+    logic.parameters["maxMemoryMB"] = args.max_memory
+    if args.slab_slices is not None and args.slab_slices < 1:
+      parser.error("--slab-slices must be at least 1")
+    logic.parameters["slabSlices"] = args.slab_slices
+    logic.profileEnabled = args.profile
+    logic.parameters["surfaceExtractor"] = args.surface_extractor
+    logic.parameters["quality"] = args.quality
+    logic.parameters["timeBudgetSeconds"] = args.time_budget
+    logic.threads = args.threads
+    logic.smpBackend = args.smp_backend
+    # A server always checks cancel files, jobs can name their own
+    if args.progress or args.cancel_file or args.serve:
+      progressStream = ProgressEvents.openProgressStream(args.progress) if args.progress else None
+      progressReporter = ProgressEvents.ProgressReporter(progressStream, args.cancel_file)
+      if not args.serve:
+        # A server keeps the default handlers so it can still be stopped
+        progressReporter.installSignalHandlers()
+      logic.profiler.observers.append(progressReporter)
+    if args.type:
+      from DICOM2OBJLib import SegmentSpec
+      logic.parameters["segments"] = SegmentSpec.readSegmentSpec(args.type)
+    from DICOM2OBJLib import MeshWriters
+    logic.parameters["outputFormats"] = [outputFormat.strip().lower() for outputFormat in args.format.split(",") if outputFormat.strip()]
+    for outputFormat in logic.parameters["outputFormats"]:
+      if outputFormat not in MeshWriters.OUTPUT_FORMATS:
+        parser.error("Unknown output format: " + outputFormat)
+    logic.parameters["glbPositionType"] = args.glb_positions
+    logic.parameters["decimationMethod"] = args.decimation
+    logic.parameters["decimationTargetTriangles"] = args.max_triangles
+    logic.parameters["decimationTargetBytes"] = int(args.max_file_mb * 1024 * 1024) if args.max_file_mb else None
+    if args.lod:
+      logic.parameters["levelsOfDetail"] = sorted(float(targetReduction) for targetReduction in args.lod.split(","))
+      for targetReduction in logic.parameters["levelsOfDetail"]:
+        if not 0.0 <= targetReduction < 1.0:
+          parser.error("Level of detail target reductions must be between 0 and 1: " + args.lod)
+
+    from DICOM2OBJLib import ResultCache
+    resultCache = ResultCache.ResultCache(args.cache_dir or os.path.join(slicer.app.cachePath, "DICOM2OBJ"), args.cache_size_mb)
+    if args.purge_cache:
+      resultCache.purge()
+      print("Purged result cache " + resultCache.cacheDir)
+    if not args.no_cache:
+      logic.resultCache = resultCache
+    logic.cacheIntermediates = not args.no_intermediate_cache
+
+    if args.serve:
+      logic.Serve(socketPath=args.socket, port=args.port)
+    elif args.benchmark:
+      from DICOM2OBJLib import Benchmark
+      if not args.benchmark_cases:
+        caseNames = Benchmark.DEFAULT_CASES
+      elif args.benchmark_cases == "all":
+        caseNames = Benchmark.ALL_CASES
+      else:
+        caseNames = [caseName.strip() for caseName in args.benchmark_cases.split(",")]
+      for caseName in caseNames:
+        Benchmark.parseCase(caseName)
+      try:
+        from STL2OBJ import STL2OBJLogic
+        stlLogic = STL2OBJLogic()
+      except ImportError:
+        logging.warning("STL2OBJ module not found, skipping STL2OBJ benchmark")
+        stlLogic = None
+      report = Benchmark.runBenchmark(caseNames, args.output_folder, logic, stlLogic)
+      Benchmark.writeReport(report, os.path.join(args.output_folder, "DICOM2OBJ_benchmark.json"))
+      Benchmark.printReport(report)
+      if args.benchmark_baseline and args.save_baseline:
+        Benchmark.writeReport(report, args.benchmark_baseline)
+        print("Saved benchmark baseline " + args.benchmark_baseline)
+      elif args.benchmark_baseline:
+        regressions = Benchmark.compareWithBaseline(report, Benchmark.readReport(args.benchmark_baseline), args.benchmark_tolerance)
+        for regression in regressions:
+          print("Regression: " + regression)
+        if regressions:
+          sys.exit(1)
+        print("No regressions against " + args.benchmark_baseline)
+    elif args.leak_check:
+      from DICOM2OBJLib import JobContext
+      if args.input_folder == "-":
+        parser.error("--leak-check needs --input-folder")
+      os.makedirs(args.output_folder, exist_ok=True)
+      report = JobContext.runLeakCheck(logic, slicer.mrmlScene, args.input_folder, args.output_folder, args.leak_check)
+      JobContext.printLeakReport(report)
+      print("Leak check written to " + JobContext.writeLeakReport(report, args.output_folder))
+      if report["leaking"]:
+        print("Scene nodes or VTK objects outlived their conversion")
+        sys.exit(1)
+    elif args.batch:
+      from DICOM2OBJLib import BatchConversion
+      statuses = logic.RunBatch(BatchConversion.readManifest(args.batch, args.output_folder))
+      failed = [status for status in statuses if status["status"] != "ok"]
+      print("Converted {0} of {1} studies".format(len(statuses) - len(failed), len(statuses)))
+      for status in failed:
+        print("Failed: {0} ({1})".format(status["input"], status["error"]))
+      if [status for status in failed if status["status"] == "error"]:
+        exitStatus = ProgressEvents.EXIT_ERROR
+      elif failed:
+        exitStatus = ProgressEvents.EXIT_CANCELLED
+    elif args.input_folder == "-":
+      if not args.purge_cache:
+        print('Please specify input DICOM study folder!')
+        exitStatus = 2
+    else:
+      if args.output_folder == ".":
+        print('Current directory is selected as output folder (default). To change it, please specify --output-folder')
+      logic.ProceduralSegmentation(args.input_folder, args.output_folder)
+    if args.startup_report:
+      startupProfile.printReport(moduleManager)
+  except ProgressEvents.ConversionCancelled:
+    logging.warning("DICOM2OBJ conversion cancelled")
+    exitStatus = ProgressEvents.EXIT_CANCELLED
   except Exception as e:
-    print(e)
-  sys.exit()
+    logging.exception(e)
+    exitStatus = ProgressEvents.EXIT_ERROR
+  finally:
+    if startupProfile:
+      startupProfile.uninstall()
+  sys.exit(exitStatus)
 
 if __name__ == "__main__":
-  main(sys.argv[1:])
+  # Slicer puts this folder on the Python path when it loads the scripted modules, which lean launches may skip
+  moduleDir = os.path.dirname(os.path.abspath(sys.argv[0]))
+  if moduleDir not in sys.path:
+    sys.path.insert(0, moduleDir)
+  from DICOM2OBJLib import StartupProfile
+  main(sys.argv[1:], StartupProfile.installIfRequested(sys.argv[1:], ["--startup-report", "--profile"]))
 
 class DICOM2OBJTest(ScriptedLoadableModuleTest):
   """
@@ -241,6 +1398,198 @@ class DICOM2OBJTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_SegmentDicom1()
+    self.setUp()
+    self.test_HeadlessEngineMatchesEditor()
+    self.setUp()
+    self.test_ConvertArray()
+    self.setUp()
+    self.test_SlabStitching()
+    self.setUp()
+    self.test_ThresholdLabelmapOverlaps()
+    self.setUp()
+    self.test_GlbFromArrays()
+    self.setUp()
+    self.test_ResultCacheEviction()
+
+  def createPhantomVolume(self):
+    # Synthetic CT: a bone-like cylinder in air
+    import numpy as np
+    voxels = np.full((60, 64, 64), -1000, dtype=np.int16)
+    zz, yy, xx = np.mgrid[0:60, 0:64, 0:64]
+    voxels[(yy - 32) ** 2 + (xx - 32) ** 2 < 15 ** 2] = 400
+    volumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    volumeNode.SetSpacing(0.8, 0.8, 1.25)
+    slicer.util.updateVolumeFromArray(volumeNode, voxels)
+    return volumeNode
+
+  def test_HeadlessEngineMatchesEditor(self):
+    """The headless engine should segment the same voxels as the Segment Editor effects.
+    """
+    import numpy as np
+    self.delayDisplay("Comparing segmentation engines")
+    volumeNode = self.createPhantomVolume()
+    logic = DICOM2OBJLogic()
+    voxelCounts = {}
+    for engine in ["editor", "headless"]:
+      logic.parameters["engine"] = engine
+      segmentationNode = logic.SegmentVolume(volumeNode)
+      segmentID = segmentationNode.GetSegmentation().GetNthSegmentID(0)
+      voxelCounts[engine] = np.count_nonzero(slicer.util.arrayFromSegment(segmentationNode, segmentID))
+    self.assertGreater(voxelCounts["editor"], 0)
+    self.assertAlmostEqual(voxelCounts["headless"] / float(voxelCounts["editor"]), 1.0, delta=0.01)
+    self.delayDisplay('Test passed!')
+
+  def test_ConvertArray(self):
+    """The array API should return a mesh in RAS coordinates without adding nodes to the scene.
+    """
+    import numpy as np
+    self.delayDisplay("Converting a volume array")
+    voxels = np.full((60, 64, 64), -1000, dtype=np.int16)
+    zz, yy, xx = np.mgrid[0:60, 0:64, 0:64]
+    voxels[(yy - 32) ** 2 + (xx - 32) ** 2 < 15 ** 2] = 400
+    nodeCount = slicer.mrmlScene.GetNumberOfNodes()
+    logic = DICOM2OBJLogic()
+    [(segmentName, vertices, faces)] = logic.ConvertArray(voxels, spacing=(0.8, 0.8, 1.25), origin=(10.0, 20.0, 30.0))
+    self.assertEqual(slicer.mrmlScene.GetNumberOfNodes(), nodeCount)
+    self.assertEqual(vertices.shape[1], 3)
+    self.assertEqual(faces.shape[1], 3)
+    self.assertGreater(len(faces), 0)
+    self.assertLess(faces.max(), len(vertices))
+    # The cylinder axis is at voxel (32, 32)
+    self.assertAlmostEqual(vertices[:, 0].mean(), 10.0 + 32 * 0.8, delta=1.0)
+    self.assertAlmostEqual(vertices[:, 1].mean(), 20.0 + 32 * 0.8, delta=1.0)
+    self.delayDisplay('Test passed!')
+
+  def test_SlabStitching(self):
+    """Surfaces stitched from slabs should be closed and have as many triangles as the surface of the whole volume.
+    """
+    import numpy as np
+    from DICOM2OBJLib import SlabStreaming
+    self.delayDisplay("Stitching slab surfaces")
+    # The cylinder runs through every slab and ends at the first and last slice
+    voxels = np.zeros((60, 64, 64), dtype=bool)
+    zz, yy, xx = np.mgrid[0:60, 0:64, 0:64]
+    voxels[(yy - 32) ** 2 + (xx - 32) ** 2 < 15 ** 2] = True
+    logic = DICOM2OBJLogic()
+    kernelSize = logic.KernelSizeInVoxels([0.8, 0.8, 1.25], 2.5)
+    margin = kernelSize[2] // 2
+    ijkToRas = vtk.vtkMatrix4x4()
+
+    pieces = []
+    for first, last in SlabStreaming.slabRanges(voxels.shape[0], 16):
+      mask, firstIndex = SlabStreaming.readSlab(voxels, first, last, margin)
+      pieces.append(logic.ExtractSlabSurface(mask, firstIndex, last - first, kernelSize, "marchingCubes",
+        first == 0, last == voxels.shape[0] - 1, first))
+    self.assertGreater(len(pieces), 1)
+    stitched = logic.StitchSlabSurfaces(pieces, ijkToRas)
+    whole = logic.StitchSlabSurfaces([logic.ExtractSlabSurface(voxels, 0, voxels.shape[0] - 1, kernelSize, "marchingCubes", True, True, 0)], ijkToRas)
+
+    self.assertGreater(whole.GetNumberOfPolys(), 0)
+    self.assertEqual(stitched.GetNumberOfPolys(), whole.GetNumberOfPolys())
+    self.assertEqual(stitched.GetNumberOfPoints(), whole.GetNumberOfPoints())
+    boundaryEdges = vtk.vtkFeatureEdges()
+    boundaryEdges.SetInputData(stitched)
+    boundaryEdges.BoundaryEdgesOn()
+    boundaryEdges.FeatureEdgesOff()
+    boundaryEdges.ManifoldEdgesOff()
+    boundaryEdges.NonManifoldEdgesOff()
+    boundaryEdges.Update()
+    self.assertEqual(boundaryEdges.GetOutput().GetNumberOfCells(), 0)
+    self.delayDisplay('Test passed!')
+
+  def test_ThresholdLabelmapOverlaps(self):
+    """Where ranges overlap a voxel should get the first listed segment, maximum thresholds are inclusive.
+    """
+    import numpy as np
+    from DICOM2OBJLib import SegmentSpec
+    self.delayDisplay("Labeling overlapping threshold ranges")
+    segments = SegmentSpec.validateSegments([
+      {"name": "Low", "minimumThreshold": 0, "maximumThreshold": 100},
+      {"name": "High", "minimumThreshold": 50, "maximumThreshold": 200},
+      {"name": "Inside", "minimumThreshold": 120, "maximumThreshold": 130},
+      ])
+    values = [-10, 0, 50, 100, 100.5, 125, 200, 200.5]
+    # More slices than slabSize, so several slabs are labeled
+    voxels = np.tile(np.array(values, dtype=np.float32).reshape(1, 1, -1), (5, 2, 1))
+    labels = SegmentSpec.thresholdLabelmap(voxels, segments, slabSize=2)
+    self.assertEqual(labels.dtype, np.uint8)
+    self.assertEqual(labels.shape, voxels.shape)
+    expected = np.array([0, 1, 1, 1, 2, 2, 2, 0], dtype=np.uint8)
+    self.assertTrue(np.array_equal(labels, np.broadcast_to(expected, voxels.shape)))
+    # The same ranges in the other order
+    labels = SegmentSpec.thresholdLabelmap(voxels, segments[::-1], slabSize=2)
+    self.assertTrue(np.array_equal(labels[0, 0], [0, 3, 2, 2, 2, 1, 2, 0]))
+    self.delayDisplay('Test passed!')
+
+  def test_GlbFromArrays(self):
+    """GLB files should have a valid layout, the smallest index type and positions within the quantization error.
+    """
+    import json
+    import struct
+    import numpy as np
+    from DICOM2OBJLib import MeshWriters
+    self.delayDisplay("Writing GLB")
+    points = np.array([[0, 0, 0], [10, 0, 0], [0, 20, 0], [0, 0, -30]], dtype=np.float64)
+    triangles = np.array([[0, 1, 2], [0, 2, 3], [0, 3, 1], [1, 3, 2]])
+
+    def readGlb(glbData):
+      magic, version, length = struct.unpack_from("<4sII", glbData, 0)
+      self.assertEqual((magic, version, length), (b"glTF", 2, len(glbData)))
+      jsonLength, jsonType = struct.unpack_from("<I4s", glbData, 12)
+      self.assertEqual(jsonType, b"JSON")
+      gltf = json.loads(glbData[20:20 + jsonLength].decode("utf-8"))
+      binaryLength, binaryType = struct.unpack_from("<I4s", glbData, 20 + jsonLength)
+      self.assertEqual(binaryType, b"BIN\x00")
+      self.assertEqual(len(glbData) % 4, 0)
+      return gltf, glbData[28 + jsonLength:28 + jsonLength + binaryLength]
+
+    gltf, binaryData = readGlb(MeshWriters.glbFromArrays(points, triangles))
+    positionAccessor, indexAccessor = gltf["accessors"]
+    self.assertEqual((positionAccessor["count"], indexAccessor["count"]), (4, 12))
+    self.assertEqual(indexAccessor["componentType"], MeshWriters.GL_UNSIGNED_SHORT)
+    positionView, indexView = gltf["bufferViews"]
+    self.assertTrue(np.array_equal(np.frombuffer(binaryData, np.float32, 12, positionView["byteOffset"]).reshape(-1, 3), points))
+    self.assertTrue(np.array_equal(np.frombuffer(binaryData, np.uint16, 12, indexView["byteOffset"]).reshape(-1, 3), triangles))
+
+    gltf, binaryData = readGlb(MeshWriters.glbFromArrays(points, triangles, "int16"))
+    self.assertEqual(gltf["extensionsRequired"], ["KHR_mesh_quantization"])
+    quantized = np.frombuffer(binaryData, np.int16, 16, gltf["bufferViews"][0]["byteOffset"]).reshape(-1, 4)[:, :3]
+    node = gltf["nodes"][0]
+    dequantized = quantized / 32767.0 * np.array(node["scale"]) + np.array(node["translation"])
+    self.assertLess(np.abs(dequantized - points).max(), 30.0 / 32767.0)
+
+    # uint16 index 0xFFFF is reserved for primitive restart
+    manyPoints = np.zeros((0xFFFF, 3))
+    gltf, binaryData = readGlb(MeshWriters.glbFromArrays(manyPoints, [[0, 1, 0xFFFE]]))
+    self.assertEqual(gltf["accessors"][1]["componentType"], MeshWriters.GL_UNSIGNED_INT)
+    self.delayDisplay('Test passed!')
+
+  def test_ResultCacheEviction(self):
+    """The least recently used entries should be evicted once the cache exceeds its size limit.
+    """
+    import tempfile
+    from DICOM2OBJLib import ResultCache
+    self.delayDisplay("Evicting cached results")
+    with tempfile.TemporaryDirectory() as tempDir:
+      # Room for two entries of 1000 bytes
+      cache = ResultCache.ResultCache(os.path.join(tempDir, "cache"), maximumSizeMB=2500.0 / (1024 * 1024))
+      keys = {}
+      for name in ["a", "b", "c"]:
+        fileName = os.path.join(tempDir, name + ".obj")
+        with open(fileName, "wb") as outputFile:
+          outputFile.write(bytes(1000))
+        keys[name] = cache.key([name], {"parameter": 1})
+        if name == "c":
+          # Using "a" makes "b" the least recently used entry
+          os.utime(cache.entryDir(keys["a"]), (1000, 1000))
+          os.utime(cache.entryDir(keys["b"]), (2000, 2000))
+          self.assertEqual(cache.fetch(keys["a"], os.path.join(tempDir, "output")), [os.path.join(tempDir, "output", "a.obj")])
+        cache.store(keys[name], [fileName])
+      self.assertIsNotNone(cache.lookup(keys["a"]))
+      self.assertIsNone(cache.lookup(keys["b"]))
+      self.assertIsNotNone(cache.lookup(keys["c"]))
+      self.assertNotEqual(cache.key(["a"], {"parameter": 1}), cache.key(["a"], {"parameter": 2}))
+    self.delayDisplay('Test passed!')
 
   def test_SegmentDicom1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -256,16 +1605,19 @@ class DICOM2OBJTest(ScriptedLoadableModuleTest):
 
     self.delayDisplay("Starting the test")
     #
-    # first, get some data
+    # first, get some data: a synthetic vertebra phantom written as DICOM, no download needed
     #
-    import SampleData
-    SampleData.downloadFromURL(
-      nodeNames='FA',
-      fileNames='FA.nrrd',
-      uris='http://slicer.kitware.com/midas3/download?items=5767')
-    self.delayDisplay('Finished with download and loading')
-
-    volumeNode = slicer.util.getNode(pattern="FA")
-    logic = SegmentDicomLogic()
-    self.assertIsNotNone( logic.hasImageData(volumeNode) )
+    import tempfile
+    from DICOM2OBJLib import Benchmark
+    with tempfile.TemporaryDirectory(prefix="DICOM2OBJTest") as workDir:
+      dicomDir = Benchmark.writePhantomSeries(os.path.join(workDir, "dicom"), "vertebra", "128")
+      self.delayDisplay('Finished writing phantom')
+
+      outputDir = os.path.join(workDir, "output")
+      logic = DICOM2OBJLogic()
+      logic.parameters["engine"] = "headless"
+      logic.RunJob(dicomDir, outputDir)
+      outputFileName = os.path.join(outputDir, "segmentation.obj")
+      self.assertTrue(os.path.exists(outputFileName))
+      self.assertGreater(os.path.getsize(outputFileName), 0)
     self.delayDisplay('Test passed!')
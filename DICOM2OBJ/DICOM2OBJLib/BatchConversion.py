@@ -0,0 +1,80 @@
+import csv
+import json
+import os
+
+#
+# Batch conversion manifests
+#
+# A batch is a list of (input folder, output folder) jobs read from one of:
+#   - a JSON lines file, one {"input": ..., "output": ...} object per line
+#   - a CSV file with input,output columns (header row optional)
+#   - a root folder, where every sub-folder or zip/tar archive is one study
+# Relative or missing output folders are placed under the batch output root.
+# Studies of a root folder whose names only differ by their archive suffix
+# (a/, a.zip, a.tar.gz) get output folders named after the full entry name;
+# any other two jobs writing to the same output folder are an error.
+#
+
+STATUS_FILE_NAME = "DICOM2OBJ_status.json"
+
+def readManifest(manifestPath, outputRoot="."):
+  from DICOM2OBJLib import DicomArchive
+  if os.path.isdir(manifestPath):
+    names = [name for name in sorted(os.listdir(manifestPath))
+      if os.path.isdir(os.path.join(manifestPath, name)) or DicomArchive.isArchive(os.path.join(manifestPath, name))]
+    baseNames = [DicomArchive.archiveBaseName(name) for name in names]
+    jobs = [(os.path.join(manifestPath, name), name.replace(".", "_") if baseNames.count(baseName) > 1 and name != baseName else None)
+      for name, baseName in zip(names, baseNames)]
+  elif manifestPath.lower().endswith((".jsonl", ".json")):
+    jobs = readJsonLinesManifest(manifestPath)
+  else:
+    jobs = readCsvManifest(manifestPath)
+  jobs = [(inputDir, resolveOutputFolder(inputDir, outputDir, outputRoot)) for inputDir, outputDir in jobs]
+  checkOutputFolders(jobs)
+  return jobs
+
+def readJsonLinesManifest(manifestPath):
+  jobs = []
+  with open(manifestPath) as manifestFile:
+    for lineNumber, line in enumerate(manifestFile, 1):
+      line = line.strip()
+      if not line or line.startswith("#"):
+        continue
+      entry = json.loads(line)
+      if not entry.get("input"):
+        raise ValueError("{0}:{1}: missing 'input'".format(manifestPath, lineNumber))
+      jobs.append((entry["input"], entry.get("output")))
+  return jobs
+
+def readCsvManifest(manifestPath):
+  jobs = []
+  with open(manifestPath, newline="") as manifestFile:
+    for row in csv.reader(manifestFile):
+      row = [value.strip() for value in row]
+      if not row or not row[0] or row[0].startswith("#"):
+        continue
+      if row[0].lower() == "input":
+        # Header row
+        continue
+      jobs.append((row[0], row[1] if len(row) > 1 and row[1] else None))
+  return jobs
+
+def resolveOutputFolder(inputDir, outputDir, outputRoot):
+  from DICOM2OBJLib import DicomArchive
+  if not outputDir:
+    outputDir = DicomArchive.archiveBaseName(inputDir)
+  return os.path.join(outputRoot, outputDir)
+
+def checkOutputFolders(jobs):
+  # Jobs sharing an output folder would overwrite each other's meshes and status
+  inputsByOutput = {}
+  for inputDir, outputDir in jobs:
+    inputsByOutput.setdefault(os.path.normcase(os.path.abspath(outputDir)), []).append(inputDir)
+  for outputDir, inputDirs in sorted(inputsByOutput.items()):
+    if len(inputDirs) > 1:
+      raise ValueError("Batch jobs {0} all write to {1}".format(", ".join(inputDirs), outputDir))
+
+def writeStatus(outputDir, status):
+  os.makedirs(outputDir, exist_ok=True)
+  with open(os.path.join(outputDir, STATUS_FILE_NAME), "w") as statusFile:
+    json.dump(status, statusFile, indent=2)
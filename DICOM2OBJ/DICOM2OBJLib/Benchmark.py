@@ -0,0 +1,233 @@
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+#
+# Offline benchmark suite
+#
+# Generates synthetic CT phantoms as DICOM series (no downloads needed), runs
+# the DICOM2OBJ and STL2OBJ conversions on them and reports throughput,
+# per-stage timings, peak memory and output triangle counts. Results can be
+# saved as a baseline and later runs compared against it to flag regressions.
+#
+# Cases are named <shape>-<size>, e.g. vertebra-256.
+#
+
+# Size name: (columns, rows, slices, pixel spacing mm, slice spacing mm)
+PHANTOM_SIZES = {
+  "128": (128, 128, 128, 2.8, 2.5),
+  "256": (256, 256, 256, 1.4, 1.25),
+  "512": (512, 512, 512, 0.7, 0.625),
+  "512x1500": (512, 512, 1500, 0.7, 0.625),
+  }
+PHANTOM_SHAPES = ["cylinder", "vertebra"]
+DEFAULT_CASES = ["cylinder-128", "vertebra-128", "cylinder-256", "vertebra-256"]
+ALL_CASES = [shape + "-" + size for size in PHANTOM_SIZES for shape in PHANTOM_SHAPES]
+
+CT_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.2"
+
+def parseCase(caseName):
+  shape, size = caseName.split("-", 1)
+  if shape not in PHANTOM_SHAPES or size not in PHANTOM_SIZES:
+    raise ValueError("Unknown benchmark case: {0} (available: {1})".format(caseName, ", ".join(ALL_CASES)))
+  return shape, size
+
+def phantomSlice(shape, sliceIndex, columns, rows, pixelSpacing, sliceSpacing):
+  """HU values of one axial slice of a phantom. Coordinates are in mm from the image center."""
+  y, x = np.mgrid[0:rows, 0:columns].astype(np.float32)
+  x = (x - columns / 2.0) * pixelSpacing
+  y = (y - rows / 2.0) * pixelSpacing
+  z = sliceIndex * sliceSpacing
+  fieldOfView = columns * pixelSpacing
+
+  # Air, soft tissue body and noise
+  hu = np.full((rows, columns), -1000.0, dtype=np.float32)
+  body = (x / (0.42 * fieldOfView)) ** 2 + (y / (0.32 * fieldOfView)) ** 2 < 1.0
+  hu[body] = 40.0
+
+  if shape == "cylinder":
+    hu[x ** 2 + (y - 0.1 * fieldOfView) ** 2 < (0.08 * fieldOfView) ** 2] = 700.0
+  elif shape == "vertebra":
+    # Vertebral bodies (cortical shell, cancellous core) separated by discs
+    period = 30.0
+    bodyHeight = 24.0
+    bodyRadius = 0.06 * fieldOfView
+    centerY = 0.05 * fieldOfView
+    if z % period < bodyHeight:
+      radius = np.sqrt(x ** 2 + (y - centerY) ** 2)
+      hu[radius < bodyRadius] = 1000.0
+      hu[radius < bodyRadius - 2.0] = 250.0
+      # Posterior arch around the spinal canal and spinous process
+      canalY = centerY + bodyRadius + 0.035 * fieldOfView
+      canalRadius = np.sqrt(x ** 2 + (y - canalY) ** 2)
+      hu[(canalRadius > 0.03 * fieldOfView) & (canalRadius < 0.045 * fieldOfView)] = 700.0
+      if z % period < bodyHeight / 2.0:
+        hu[(np.abs(x) < 3.0) & (y > canalY) & (y < canalY + 0.12 * fieldOfView)] = 700.0
+    else:
+      hu[np.sqrt(x ** 2 + (y - centerY) ** 2) < bodyRadius] = 80.0
+  else:
+    raise ValueError("Unknown phantom shape: " + str(shape))
+
+  noise = np.random.default_rng(sliceIndex).normal(0.0, 20.0, hu.shape)
+  return np.clip(np.round(hu + noise * body), -1024, 3071).astype(np.int16)
+
+def writePhantomSeries(outputDir, shape, size):
+  """Write a phantom as a CT DICOM series, one file per slice. Existing complete series are reused."""
+  import pydicom
+  from pydicom.dataset import Dataset, FileMetaDataset
+  from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+  columns, rows, slices, pixelSpacing, sliceSpacing = PHANTOM_SIZES[size]
+  completeMarker = os.path.join(outputDir, "complete")
+  if os.path.exists(completeMarker):
+    return outputDir
+  os.makedirs(outputDir, exist_ok=True)
+
+  studyInstanceUID = generate_uid()
+  seriesInstanceUID = generate_uid()
+  frameOfReferenceUID = generate_uid()
+  for sliceIndex in range(slices):
+    fileMeta = FileMetaDataset()
+    fileMeta.MediaStorageSOPClassUID = CT_IMAGE_STORAGE
+    fileMeta.MediaStorageSOPInstanceUID = generate_uid()
+    fileMeta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    dataset = Dataset()
+    dataset.file_meta = fileMeta
+    dataset.is_little_endian = True
+    dataset.is_implicit_VR = False
+    dataset.SOPClassUID = CT_IMAGE_STORAGE
+    dataset.SOPInstanceUID = fileMeta.MediaStorageSOPInstanceUID
+    dataset.StudyInstanceUID = studyInstanceUID
+    dataset.SeriesInstanceUID = seriesInstanceUID
+    dataset.FrameOfReferenceUID = frameOfReferenceUID
+    dataset.PatientName = "Phantom^" + shape
+    dataset.PatientID = "PHANTOM-{0}-{1}".format(shape, size)
+    dataset.Modality = "CT"
+    dataset.ImageType = ["ORIGINAL", "PRIMARY", "AXIAL"]
+    dataset.SeriesDescription = "{0} phantom {1}".format(shape, size)
+    dataset.SeriesNumber = 1
+    dataset.InstanceNumber = sliceIndex + 1
+    dataset.ImagePositionPatient = [-columns * pixelSpacing / 2.0, -rows * pixelSpacing / 2.0, sliceIndex * sliceSpacing]
+    dataset.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    dataset.PixelSpacing = [pixelSpacing, pixelSpacing]
+    dataset.SliceThickness = sliceSpacing
+    dataset.Rows = rows
+    dataset.Columns = columns
+    dataset.SamplesPerPixel = 1
+    dataset.PhotometricInterpretation = "MONOCHROME2"
+    dataset.BitsAllocated = 16
+    dataset.BitsStored = 16
+    dataset.HighBit = 15
+    dataset.PixelRepresentation = 1
+    dataset.RescaleIntercept = 0
+    dataset.RescaleSlope = 1
+    dataset.PixelData = phantomSlice(shape, sliceIndex, columns, rows, pixelSpacing, sliceSpacing).tobytes()
+    pydicom.dcmwrite(os.path.join(outputDir, "slice{0:04d}.dcm".format(sliceIndex)), dataset, write_like_original=False)
+
+  open(completeMarker, "w").close()
+  return outputDir
+
+def convertObjToStl(objFileName, stlFileName):
+  import vtk
+  reader = vtk.vtkOBJReader()
+  reader.SetFileName(objFileName)
+  writer = vtk.vtkSTLWriter()
+  writer.SetInputConnection(reader.GetOutputPort())
+  writer.SetFileName(stlFileName)
+  writer.SetFileTypeToBinary()
+  writer.Write()
+
+def runCase(caseName, workDir, dicomLogic, stlLogic=None):
+  shape, size = parseCase(caseName)
+  caseDir = os.path.join(workDir, caseName)
+  startTime = time.perf_counter()
+  dicomDir = writePhantomSeries(os.path.join(workDir, "phantoms", caseName), shape, size)
+  logging.info("Benchmark phantom {0} ready in {1:.1f}s".format(caseName, time.perf_counter() - startTime))
+
+  # DICOM2OBJ, its peak memory is the one of this conversion, not of the cases before
+  outputDir = os.path.join(caseDir, "dicom2obj")
+  os.makedirs(outputDir, exist_ok=True)
+  dicomLogic.ProceduralSegmentation(dicomDir, outputDir)
+  profile = dicomLogic.profiler.summary()
+  dicomLogic.ResetScene()
+  voxels = sum(stage.get("voxels", 0) for stage in profile["stages"] if stage["stage"] == "load")
+  result = {
+    "case": caseName,
+    "voxels": voxels,
+    "wallSeconds": profile["totalWallSeconds"],
+    "cpuSeconds": profile["totalCpuSeconds"],
+    "voxelsPerSecond": round(voxels / profile["totalWallSeconds"]) if profile["totalWallSeconds"] else None,
+    "peakMemoryMB": profile["peakMemoryMB"],
+    "triangles": sum(stage.get("triangles", 0) for stage in profile["stages"] if stage["stage"] == "write"),
+    "stages": {},
+    }
+  for stage in profile["stages"]:
+    # Stages run once per segment are summed
+    result["stages"][stage["stage"]] = round(result["stages"].get(stage["stage"], 0.0) + stage["wallSeconds"], 4)
+
+  # STL2OBJ on the resulting surface
+  if stlLogic is not None:
+    from DICOM2OBJLib import StageProfiler
+    stlFileName = os.path.join(caseDir, caseName + ".stl")
+    convertObjToStl(os.path.join(outputDir, "segmentation.obj"), stlFileName)
+    stlOutputDir = os.path.join(caseDir, "stl2obj")
+    os.makedirs(stlOutputDir, exist_ok=True)
+    peakMemory = StageProfiler.PeakMemory()
+    peakMemory.start()
+    startWallTime = time.perf_counter()
+    try:
+      stlLogic.ConvertFile(stlFileName, stlOutputDir)
+    finally:
+      peakMemory.stop()
+    result["stlWallSeconds"] = round(time.perf_counter() - startWallTime, 4)
+    stlPeakMemoryMB = peakMemory.take()
+    result["stlPeakMemoryMB"] = round(stlPeakMemoryMB, 1) if stlPeakMemoryMB is not None else None
+    result["stlMegabytesPerSecond"] = round(os.path.getsize(stlFileName) / (1024.0 * 1024.0) / result["stlWallSeconds"], 2) if result["stlWallSeconds"] else None
+
+  return result
+
+def runBenchmark(caseNames, workDir, dicomLogic, stlLogic=None):
+  results = []
+  # Cached results would hide the conversion time
+  resultCache, dicomLogic.resultCache = dicomLogic.resultCache, None
+  try:
+    for caseName in caseNames:
+      logging.info("Benchmark case " + caseName)
+      results.append(runCase(caseName, workDir, dicomLogic, stlLogic))
+  finally:
+    dicomLogic.resultCache = resultCache
+  return {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "parameters": dicomLogic.parameters, "threading": dicomLogic.threadingSettings, "cases": results}
+
+def compareWithBaseline(report, baseline, tolerance=0.25):
+  """Return a list of regression messages of report compared to baseline.
+  Time and memory regress when they grow by more than tolerance, triangle counts when they change by more than tolerance.
+  """
+  regressions = []
+  baselineCases = dict((case["case"], case) for case in baseline.get("cases", []))
+  for case in report["cases"]:
+    baselineCase = baselineCases.get(case["case"])
+    if baselineCase is None:
+      continue
+    for metric in ["wallSeconds", "peakMemoryMB", "stlWallSeconds", "stlPeakMemoryMB"]:
+      if case.get(metric) and baselineCase.get(metric) and case[metric] > baselineCase[metric] * (1.0 + tolerance):
+        regressions.append("{0}: {1} {2} -> {3}".format(case["case"], metric, baselineCase[metric], case[metric]))
+    if baselineCase.get("triangles") and abs(case["triangles"] - baselineCase["triangles"]) > baselineCase["triangles"] * tolerance:
+      regressions.append("{0}: triangles {1} -> {2}".format(case["case"], baselineCase["triangles"], case["triangles"]))
+  return regressions
+
+def readReport(fileName):
+  with open(fileName) as reportFile:
+    return json.load(reportFile)
+
+def writeReport(report, fileName):
+  with open(fileName, "w") as reportFile:
+    json.dump(report, reportFile, indent=2)
+
+def printReport(report):
+  print("{0:<18}{1:>14}{2:>10}{3:>16}{4:>12}{5:>12}{6:>10}".format("case", "voxels", "seconds", "voxels/s", "peak MB", "triangles", "stl s"))
+  for case in report["cases"]:
+    print("{0:<18}{1:>14}{2:>10.2f}{3:>16}{4:>12}{5:>12}{6:>10}".format(case["case"], case["voxels"], case["wallSeconds"],
+      case["voxelsPerSecond"], case["peakMemoryMB"], case["triangles"], case.get("stlWallSeconds", "-")))
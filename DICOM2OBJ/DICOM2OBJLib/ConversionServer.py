@@ -0,0 +1,115 @@
+import json
+import logging
+import os
+import socketserver
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+#
+# Long-lived conversion server
+#
+# Keeps one Slicer process (and the DICOM2OBJ logic) warm and accepts jobs over
+# HTTP, either on a localhost TCP port or on a local Unix socket:
+#
+#   POST /convert   {"input": "<DICOM folder>", "output": "<output folder>", "cancelFile": "<optional path>"}
+#   GET  /health
+#   POST /shutdown
+#
+# Jobs run one at a time on the main thread, because the MRML scene is not
+# thread safe. The scene is reset after every job.
+#
+
+class ConversionRequestHandler(BaseHTTPRequestHandler):
+
+  def do_GET(self):
+    if self.path == "/health":
+      self.sendJson(200, {"status": "ready", "jobs": self.server.jobCount})
+    else:
+      self.sendJson(404, {"status": "error", "error": "Unknown path " + self.path})
+
+  def do_POST(self):
+    if self.path == "/shutdown":
+      self.sendJson(200, {"status": "stopping"})
+      self.server.stopRequested = True
+      return
+    if self.path != "/convert":
+      self.sendJson(404, {"status": "error", "error": "Unknown path " + self.path})
+      return
+
+    try:
+      job = self.readJson()
+    except ValueError as e:
+      self.sendJson(400, {"status": "error", "error": "Invalid JSON: " + str(e)})
+      return
+    if not isinstance(job, dict) or not job.get("input") or not job.get("output"):
+      self.sendJson(400, {"status": "error", "error": "Job requires 'input' and 'output'"})
+      return
+
+    result = self.server.runJob(job)
+    self.sendJson(200 if result["status"] == "ok" else 500, result)
+
+  def readJson(self):
+    length = int(self.headers.get("Content-Length", 0))
+    body = self.rfile.read(length) if length else b"{}"
+    return json.loads(body.decode("utf-8"))
+
+  def sendJson(self, code, content):
+    body = json.dumps(content).encode("utf-8")
+    self.send_response(code)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    # Default implementation writes to stderr and expects a TCP client address
+    logging.debug("DICOM2OBJ server: " + format % args)
+
+
+class ConversionServerMixin:
+
+  def setupConversion(self, logic):
+    self.logic = logic
+    self.jobCount = 0
+    self.stopRequested = False
+
+  def runJob(self, job):
+    self.jobCount += 1
+    # The job is cancelled before its next stage once its cancel file exists
+    result = self.logic.RunJob(job["input"], job["output"], job.get("cancelFile"))
+    logging.info("DICOM2OBJ job {0} {1} in {2}s".format(self.jobCount, result["status"], result["seconds"]))
+    return result
+
+
+class ConversionHTTPServer(ConversionServerMixin, HTTPServer):
+  pass
+
+
+class ConversionUnixServer(ConversionServerMixin, socketserver.UnixStreamServer):
+  pass
+
+
+def serve(logic, socketPath=None, port=8750, host="127.0.0.1"):
+  """Handle conversion requests until a shutdown request is received.
+  Listens on socketPath if given, otherwise on host:port.
+  """
+  if socketPath:
+    if os.path.exists(socketPath):
+      os.remove(socketPath)
+    server = ConversionUnixServer(socketPath, ConversionRequestHandler)
+    address = socketPath
+  else:
+    server = ConversionHTTPServer((host, port), ConversionRequestHandler)
+    address = "http://{0}:{1}".format(host, port)
+  server.setupConversion(logic)
+
+  print("DICOM2OBJ server listening on " + address)
+  try:
+    while not server.stopRequested:
+      server.handle_request()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    if socketPath and os.path.exists(socketPath):
+      os.remove(socketPath)
+  print("DICOM2OBJ server stopped after {0} jobs".format(server.jobCount))
@@ -0,0 +1,96 @@
+import copy
+import io
+import os
+import shutil
+import tarfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+#
+# DICOM studies packed in zip or tar archives
+#
+# Archives are indexed without unpacking them: the header scanner reads each
+# member from the archive stream, and only as many bytes as the header needs.
+# Members without the DICOM preamble are skipped after their first block. Only
+# the files of the selected series are then extracted, to a temporary folder
+# the volume loaders can read.
+#
+# Zip members are read in parallel; tar members, compressed or not, are read
+# in archive order in a single pass.
+#
+
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+
+# First block read from every member, enough for the header of most DICOM files
+HEADER_PREFIX_BYTES = 16384
+
+# Tag of the pixel data element, little and big endian. The header ends where it starts.
+PIXEL_DATA_TAGS = (b"\xe0\x7f\x10\x00", b"\x7f\xe0\x00\x10")
+
+def isArchive(path):
+  return os.path.isfile(path) and path.lower().endswith(ARCHIVE_SUFFIXES)
+
+def archiveBaseName(path):
+  """File name of the archive without its archive suffix."""
+  name = os.path.basename(os.path.normpath(path))
+  for suffix in sorted(ARCHIVE_SUFFIXES, key=len, reverse=True):
+    if name.lower().endswith(suffix):
+      return name[:-len(suffix)]
+  return name
+
+def readMemberHeader(memberFile):
+  """Read the header tags of an archive member, None if it is not a DICOM file.
+  The member is read in growing blocks until the pixel data element is reached, never beyond.
+  """
+  from DICOM2OBJLib import DicomScanner
+  data = memberFile.read(HEADER_PREFIX_BYTES)
+  if data[128:132] != b"DICM":
+    return None
+  while not any(tag in data for tag in PIXEL_DATA_TAGS):
+    block = memberFile.read(len(data))
+    if not block:
+      break
+    data += block
+  return DicomScanner.readHeader(io.BytesIO(data))
+
+def scanArchive(archivePath, maxWorkers=None):
+  """Return the DicomSeries of a zip or tar archive. Their files are archive member names."""
+  from DICOM2OBJLib import DicomScanner
+  if zipfile.is_zipfile(archivePath):
+    with zipfile.ZipFile(archivePath) as archive:
+      memberNames = [info.filename for info in archive.infolist() if not info.is_dir()]
+
+      def readZipMember(memberName):
+        with archive.open(memberName) as memberFile:
+          return readMemberHeader(memberFile)
+
+      with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        return DicomScanner.groupSeries(zip(memberNames, executor.map(readZipMember, memberNames)))
+  # Stream mode, compressed tar archives cannot be read out of order efficiently
+  with tarfile.open(archivePath, "r|*") as archive:
+    return DicomScanner.groupSeries((member.name, readMemberHeader(archive.extractfile(member)))
+      for member in archive if member.isfile())
+
+def spoolSeries(archivePath, series, spoolDir):
+  """Extract the members of series into spoolDir.
+  Returns a copy of series whose files are the extracted files, in the same order.
+  """
+  spooledFileNames = dict((memberName, os.path.join(spoolDir, "{0:06d}.dcm".format(index)))
+    for index, memberName in enumerate(series.files))
+  if zipfile.is_zipfile(archivePath):
+    with zipfile.ZipFile(archivePath) as archive:
+      for memberName, fileName in spooledFileNames.items():
+        with archive.open(memberName) as memberFile, open(fileName, "wb") as spooledFile:
+          shutil.copyfileobj(memberFile, spooledFile)
+  else:
+    with tarfile.open(archivePath, "r|*") as archive:
+      for member in archive:
+        if member.isfile() and member.name in spooledFileNames:
+          with open(spooledFileNames[member.name], "wb") as spooledFile:
+            shutil.copyfileobj(archive.extractfile(member), spooledFile)
+  missing = [memberName for memberName, fileName in spooledFileNames.items() if not os.path.exists(fileName)]
+  if missing:
+    raise ValueError("Could not extract {0} files of DICOM series {1} from {2}".format(len(missing), series.seriesInstanceUID, archivePath))
+  spooledSeries = copy.copy(series)
+  spooledSeries.instances = [(spooledFileNames[instance[0]],) + tuple(instance[1:]) for instance in series.instances]
+  return spooledSeries
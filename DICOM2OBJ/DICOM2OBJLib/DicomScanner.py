@@ -0,0 +1,206 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+#
+# Header-only DICOM scanner
+#
+# Indexes a folder of DICOM files much faster than importing it into a DICOM
+# database: only the few header tags needed to group and sort the images are
+# read (pixel data is skipped), and files are read in parallel, which matters
+# most on network mounts. Files are grouped by study and series, and each
+# series is sorted by slice position so its file list can be passed straight
+# to the volume reader.
+#
+
+HEADER_TAGS = [
+  "StudyInstanceUID",
+  "SeriesInstanceUID",
+  "SOPInstanceUID",
+  "Modality",
+  "SeriesDescription",
+  "ImageType",
+  "ImagePositionPatient",
+  "ImageOrientationPatient",
+  "InstanceNumber",
+  "SliceThickness",
+  "PixelSpacing",
+  "Rows",
+  "Columns",
+  ]
+
+SERIES_SELECTION_POLICIES = ["largest", "thinnest", "uid"]
+
+
+class DicomSeries:
+
+  def __init__(self, studyInstanceUID, seriesInstanceUID):
+    self.studyInstanceUID = studyInstanceUID
+    self.seriesInstanceUID = seriesInstanceUID
+    self.modality = ""
+    self.description = ""
+    self.imageType = []
+    self.sliceThickness = None
+    self.pixelSpacing = None
+    self.rows = None
+    self.columns = None
+    self.imageOrientation = None
+    # (file name, SOPInstanceUID, position along slice normal or None, instance number)
+    self.instances = []
+
+  @property
+  def files(self):
+    return [instance[0] for instance in self.instances]
+
+  @property
+  def instanceUIDs(self):
+    return [instance[1] for instance in self.instances]
+
+  @property
+  def hasImages(self):
+    return bool(self.rows and self.columns)
+
+  def addInstance(self, fileName, dataset):
+    if not self.instances:
+      self.modality = str(dataset.get("Modality", ""))
+      self.description = str(dataset.get("SeriesDescription", ""))
+      self.imageType = [str(value) for value in dataset.get("ImageType", [])]
+      self.sliceThickness = floatOrNone(dataset.get("SliceThickness"))
+      pixelSpacing = dataset.get("PixelSpacing")
+      if pixelSpacing and len(pixelSpacing) == 2:
+        self.pixelSpacing = [float(value) for value in pixelSpacing]
+      self.rows = dataset.get("Rows")
+      self.columns = dataset.get("Columns")
+      orientation = dataset.get("ImageOrientationPatient")
+      if orientation and len(orientation) == 6:
+        self.imageOrientation = [float(value) for value in orientation]
+    position = dataset.get("ImagePositionPatient")
+    slicePosition = None
+    if position and len(position) == 3 and self.imageOrientation:
+      slicePosition = sum(float(p) * n for p, n in zip(position, self.sliceNormal()))
+    instanceNumber = dataset.get("InstanceNumber")
+    self.instances.append((fileName, str(dataset.SOPInstanceUID), slicePosition, int(instanceNumber) if instanceNumber is not None else 0))
+
+  def sliceNormal(self):
+    row, column = self.imageOrientation[:3], self.imageOrientation[3:]
+    return [row[1] * column[2] - row[2] * column[1],
+      row[2] * column[0] - row[0] * column[2],
+      row[0] * column[1] - row[1] * column[0]]
+
+  def spacing(self):
+    """Voxel spacing in mm along columns, rows and slices, 1 where unknown."""
+    rowSpacing, columnSpacing = self.pixelSpacing or [1.0, 1.0]
+    positions = [instance[2] for instance in self.instances]
+    if len(positions) > 1 and None not in positions and positions[-1] != positions[0]:
+      sliceSpacing = abs(positions[-1] - positions[0]) / (len(positions) - 1)
+    else:
+      sliceSpacing = self.sliceThickness or 1.0
+    return [columnSpacing, rowSpacing, sliceSpacing]
+
+  def sortInstances(self):
+    # Sort by position along the slice normal, fall back to instance number if any position is missing
+    if all(instance[2] is not None for instance in self.instances):
+      self.instances.sort(key=lambda instance: (instance[2], instance[3], instance[0]))
+    else:
+      self.instances.sort(key=lambda instance: (instance[3], instance[0]))
+
+  def __repr__(self):
+    return "DicomSeries({0}, {1} {2}, {3} files)".format(self.seriesInstanceUID, self.modality, self.description, len(self.instances))
+
+
+def floatOrNone(value):
+  try:
+    return float(value)
+  except (TypeError, ValueError):
+    return None
+
+def readHeader(fileName):
+  import pydicom
+  try:
+    dataset = pydicom.dcmread(fileName, stop_before_pixels=True, specific_tags=HEADER_TAGS)
+  except Exception:
+    # Not a DICOM file
+    return None
+  if "SeriesInstanceUID" not in dataset or "SOPInstanceUID" not in dataset:
+    return None
+  return dataset
+
+def listFiles(inputDir):
+  fileNames = []
+  for root, dirs, files in os.walk(inputDir):
+    fileNames.extend(os.path.join(root, name) for name in files)
+  return sorted(fileNames)
+
+def scanFiles(fileNames, maxWorkers=None):
+  """Read the headers of fileNames in parallel and return their DicomSeries,
+  each with instances sorted by slice position.
+  """
+  with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+    # map keeps the input order, so the grouping is deterministic
+    return groupSeries(zip(fileNames, executor.map(readHeader, fileNames)))
+
+def groupSeries(headers):
+  """Group (file name, header dataset or None) pairs into DicomSeries sorted by slice position."""
+  seriesByUID = {}
+  fileCount = 0
+  for fileName, dataset in headers:
+    fileCount += 1
+    if dataset is None:
+      continue
+    seriesInstanceUID = str(dataset.SeriesInstanceUID)
+    if seriesInstanceUID not in seriesByUID:
+      seriesByUID[seriesInstanceUID] = DicomSeries(str(dataset.get("StudyInstanceUID", "")), seriesInstanceUID)
+    seriesByUID[seriesInstanceUID].addInstance(fileName, dataset)
+  seriesList = list(seriesByUID.values())
+  for series in seriesList:
+    series.sortInstances()
+  seriesList.sort(key=lambda series: (series.studyInstanceUID, series.seriesInstanceUID))
+  logging.info("Found {0} DICOM series in {1} files".format(len(seriesList), fileCount))
+  return seriesList
+
+def scanDirectory(inputDir, maxWorkers=None):
+  return scanFiles(listFiles(inputDir), maxWorkers)
+
+def instanceUIDs(seriesList):
+  """Sorted SOPInstanceUIDs of all instances in seriesList."""
+  return sorted(instanceUID for series in seriesList for instanceUID in series.instanceUIDs)
+
+def isAxial(series):
+  if not series.imageOrientation:
+    return False
+  return abs(series.sliceNormal()[2]) > 0.9
+
+def isLocalizer(series):
+  return "LOCALIZER" in [value.upper() for value in series.imageType]
+
+def candidateSeries(seriesList):
+  """Image series preferred for segmentation: CT, axial and not a localizer,
+  each criterion only applied if some series still match it.
+  """
+  candidates = [series for series in seriesList if series.hasImages]
+  for criterion in [lambda series: series.modality == "CT", isAxial, lambda series: not isLocalizer(series)]:
+    matching = [series for series in candidates if criterion(series)]
+    if matching:
+      candidates = matching
+  return candidates
+
+def selectSeries(seriesList, policy="largest", seriesInstanceUID=None):
+  """Pick the single series to segment.
+    largest: axial CT series with the most slices
+    thinnest: axial CT series with the thinnest slices (most slices if equal)
+    uid: the series with the given SeriesInstanceUID
+  """
+  if policy == "uid":
+    for series in seriesList:
+      if series.seriesInstanceUID == seriesInstanceUID:
+        return series
+    raise ValueError("DICOM series not found: " + str(seriesInstanceUID))
+
+  candidates = candidateSeries(seriesList)
+  if not candidates:
+    raise ValueError("No DICOM image series found")
+  if policy == "largest":
+    return max(candidates, key=lambda series: len(series.instances))
+  elif policy == "thinnest":
+    return min(candidates, key=lambda series: (series.sliceThickness if series.sliceThickness else float("inf"), -len(series.instances)))
+  raise ValueError("Unknown series selection policy: " + str(policy))
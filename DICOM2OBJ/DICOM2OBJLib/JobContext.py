@@ -0,0 +1,169 @@
+import gc
+import json
+import logging
+import os
+
+#
+# Scene-scoped conversion jobs and leak checks
+#
+# SceneJobContext remembers the scene nodes and subject hierarchy items that
+# exist when a job begins, and on release removes every node and item the job
+# added: loaded and derived volumes with their display and storage nodes,
+# segmentations, exported models and their folder, DICOM-loaded nodes. With
+# object tracking on, the VTK data objects handed to track() are held until
+# release; once the nodes are gone, any whose C++ reference count shows other
+# holders (a filter, a segment representation, ...) are reported as live.
+# Tracking keeps the objects alive for the whole job, so it is only turned on
+# by leak checks, not by memory-bounded conversions.
+#
+# runLeakCheck converts the same study repeatedly with tracking on and reports
+# scene node counts, subject hierarchy items, live tracked objects, Python
+# objects, VTK objects by class and resident memory after every run, so growth
+# across jobs of a long-lived process shows up before it reaches production.
+# VTK objects are counted through their Python wrappers; objects only held in
+# C++ are covered by the reference counts of the tracked objects.
+#
+
+LEAK_CHECK_FILE_NAME = "DICOM2OBJ_leakcheck.json"
+
+def sceneNodes(scene):
+  nodes = scene.GetNodes()
+  return [nodes.GetItemAsObject(index) for index in range(nodes.GetNumberOfItems())]
+
+def vtkObjectCounts():
+  """Number of live VTK objects with a Python wrapper, by class name."""
+  import vtk
+  counts = {}
+  for candidate in gc.get_objects():
+    if isinstance(candidate, vtk.vtkObjectBase):
+      className = candidate.GetClassName()
+      counts[className] = counts.get(className, 0) + 1
+  return counts
+
+def subjectHierarchyItemIDs(scene):
+  import vtk
+  shNode = scene.GetSubjectHierarchyNode()
+  itemIDs = vtk.vtkIdList()
+  shNode.GetItemChildren(shNode.GetSceneItemID(), itemIDs, True)
+  return [itemIDs.GetId(index) for index in range(itemIDs.GetNumberOfIds())]
+
+
+class SceneJobContext:
+
+  def __init__(self, scene, trackObjects=False):
+    self.scene = scene
+    self.trackObjects = trackObjects
+    self.initialNodeIDs = set()
+    self.initialItemIDs = set()
+    self.trackedObjects = []
+    # Summary of the last release
+    self.releaseSummary = {}
+
+  def begin(self):
+    self.initialNodeIDs = set(node.GetID() for node in sceneNodes(self.scene))
+    self.initialItemIDs = set(subjectHierarchyItemIDs(self.scene))
+    self.trackedObjects = []
+    return self
+
+  def track(self, vtkObject):
+    """Hold vtkObject until the job is released, if tracking objects, and return it."""
+    if self.trackObjects and vtkObject is not None:
+      self.trackedObjects.append(vtkObject)
+    return vtkObject
+
+  def release(self):
+    """Remove the nodes and subject hierarchy items added since begin() and return a summary."""
+    # Singletons (subject hierarchy, selection, interaction nodes) are shared by all jobs
+    addedNodes = [node for node in sceneNodes(self.scene) if node.GetID() not in self.initialNodeIDs and not node.GetSingletonTag()]
+    # Newest first, so derived nodes go before the nodes they reference
+    for node in reversed(addedNodes):
+      if node.GetScene() is not None:
+        self.scene.RemoveNode(node)
+    shNode = self.scene.GetSubjectHierarchyNode()
+    addedItemIDs = [itemID for itemID in subjectHierarchyItemIDs(self.scene) if itemID not in self.initialItemIDs]
+    for itemID in reversed(addedItemIDs):
+      # Children may have gone with their parent folder
+      if itemID in subjectHierarchyItemIDs(self.scene):
+        shNode.RemoveItem(itemID)
+
+    gc.collect()
+    liveObjects = {}
+    for vtkObject in self.trackedObjects:
+      # The Python wrapper holds one reference, any other is held by another object
+      references = vtkObject.GetReferenceCount() - 1
+      if references < 1:
+        continue
+      className = vtkObject.GetClassName()
+      live = liveObjects.setdefault(className, {"count": 0, "references": 0})
+      live["count"] += 1
+      live["references"] += references
+    # Objects without other holders are freed here
+    self.trackedObjects = []
+    self.releaseSummary = {"removedNodes": len(addedNodes), "removedItems": len(addedItemIDs), "liveObjects": liveObjects}
+    return self.releaseSummary
+
+  def __enter__(self):
+    return self.begin()
+
+  def __exit__(self, exceptionType, exceptionValue, traceback):
+    self.release()
+    return False
+
+
+def snapshot(scene):
+  from DICOM2OBJLib import StageProfiler
+  gc.collect()
+  currentMemoryMB, peakMemoryMB = StageProfiler.memoryUsageMB()
+  vtkClasses = vtkObjectCounts()
+  return {
+    "nodes": scene.GetNumberOfNodes(),
+    "subjectHierarchyItems": len(subjectHierarchyItemIDs(scene)),
+    "pythonObjects": len(gc.get_objects()),
+    "vtkObjects": sum(vtkClasses.values()),
+    "vtkClasses": vtkClasses,
+    "memoryMB": round(currentMemoryMB, 1) if currentMemoryMB is not None else None,
+    }
+
+def runLeakCheck(logic, scene, inputDir, outputDir, runs):
+  """Convert inputDir runs times with logic and return the scene and memory snapshot after every run."""
+  # Cached results would skip the conversion after the first run
+  resultCache, logic.resultCache = logic.resultCache, None
+  trackObjects, logic.trackObjects = logic.trackObjects, True
+  try:
+    report = {"input": inputDir, "before": snapshot(scene), "runs": []}
+    for run in range(1, runs + 1):
+      logic.ProceduralSegmentation(inputDir, outputDir)
+      record = snapshot(scene)
+      record["run"] = run
+      record["released"] = logic.jobContext.releaseSummary if logic.jobContext else {}
+      report["runs"].append(record)
+      logging.info("Leak check run {0}/{1}: {2} nodes, {3} VTK objects, {4} MB".format(run, runs, record["nodes"], record["vtkObjects"], record["memoryMB"]))
+  finally:
+    logic.resultCache = resultCache
+    logic.trackObjects = trackObjects
+  # The first run also loads modules and fills caches, growth is measured from there
+  first, last = report["runs"][0], report["runs"][-1]
+  report["growth"] = dict((name, round(last[name] - first[name], 1)) for name in ["nodes", "subjectHierarchyItems", "pythonObjects", "vtkObjects", "memoryMB"]
+    if last[name] is not None and first[name] is not None)
+  classNames = set(first["vtkClasses"]) | set(last["vtkClasses"])
+  report["vtkClassGrowth"] = dict((className, last["vtkClasses"].get(className, 0) - first["vtkClasses"].get(className, 0))
+    for className in sorted(classNames) if last["vtkClasses"].get(className, 0) != first["vtkClasses"].get(className, 0))
+  report["leaking"] = bool(report["growth"].get("nodes") or report["growth"].get("subjectHierarchyItems")
+    or report["growth"].get("vtkObjects", 0) > 0 or any(record["released"].get("liveObjects") for record in report["runs"]))
+  return report
+
+def writeLeakReport(report, outputDir):
+  fileName = os.path.join(outputDir, LEAK_CHECK_FILE_NAME)
+  with open(fileName, "w") as reportFile:
+    json.dump(report, reportFile, indent=2)
+  return fileName
+
+def printLeakReport(report):
+  print("{0:>5}{1:>8}{2:>10}{3:>16}{4:>13}{5:>12}{6:>14}".format("run", "nodes", "sh items", "python objects", "vtk objects", "memory MB", "live objects"))
+  for record in report["runs"]:
+    liveObjects = sum(live["count"] for live in record["released"].get("liveObjects", {}).values())
+    print("{0:>5}{1:>8}{2:>10}{3:>16}{4:>13}{5:>12}{6:>14}".format(record["run"], record["nodes"], record["subjectHierarchyItems"],
+      record["pythonObjects"], record["vtkObjects"], record["memoryMB"], liveObjects))
+  print("Growth from run 1: " + ", ".join("{0} {1:+}".format(name, value) for name, value in sorted(report["growth"].items())))
+  if report["vtkClassGrowth"]:
+    print("VTK objects by class: " + ", ".join("{0} {1:+}".format(className, count) for className, count in report["vtkClassGrowth"].items()))
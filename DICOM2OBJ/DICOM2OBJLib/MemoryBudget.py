@@ -0,0 +1,48 @@
+import numpy as np
+
+#
+# Memory budget of a conversion
+#
+# Estimates the peak memory of converting a volume from its voxel count, and
+# picks the smallest integer downsampling of the volume (averaging blocks of
+# factor x factor x factor voxels) whose estimate fits a memory limit. The
+# estimate assumes memory-bounded mode, where the source volume is released as
+# soon as the compact uint8 labelmap or downsampled copy has been made.
+#
+
+# Full resolution int16 volume as loaded
+LOADED_BYTES_PER_VOXEL = 2.0
+# Working volume: int16 volume and its cropped copy, uint8 labelmap, segment mask,
+# median output and the segment's binary labelmap
+WORKING_BYTES_PER_VOXEL = 8.0
+# Closed surface extraction: padded and smoothed labelmap copies and the raw surface
+SURFACE_BYTES_PER_VOXEL = 6.0
+MAXIMUM_DOWNSAMPLING = 8
+
+def estimatePeakMemoryMB(voxels, downsampling=1, baselineMB=0.0):
+  workingVoxels = voxels / float(downsampling ** 3)
+  peak = (WORKING_BYTES_PER_VOXEL + SURFACE_BYTES_PER_VOXEL) * workingVoxels
+  if downsampling > 1:
+    # The loaded volume and its downsampled copy exist together until the volume is released
+    peak = max(peak, LOADED_BYTES_PER_VOXEL * (voxels + workingVoxels))
+  return baselineMB + peak / (1024.0 * 1024.0)
+
+def workingDownsampling(voxels, maxMemoryMB, baselineMB=0.0):
+  """Smallest downsampling factor whose estimated peak memory fits into maxMemoryMB."""
+  for downsampling in range(1, MAXIMUM_DOWNSAMPLING + 1):
+    if estimatePeakMemoryMB(voxels, downsampling, baselineMB) <= maxMemoryMB:
+      return downsampling
+  raise ValueError("Converting {0} voxels needs more than {1} MB even at 1/{2} resolution (estimated {3:.0f} MB)".format(
+    voxels, maxMemoryMB, MAXIMUM_DOWNSAMPLING, estimatePeakMemoryMB(voxels, MAXIMUM_DOWNSAMPLING, baselineMB)))
+
+def downsampleVolume(voxels, factor):
+  """Average blocks of factor x factor x factor voxels. Trailing voxels that do not fill a block are dropped."""
+  shape = [size // factor for size in voxels.shape]
+  if min(shape) == 0:
+    raise ValueError("Volume of shape {0} is too small to downsample by {1}".format(voxels.shape, factor))
+  downsampled = np.empty(shape, dtype=voxels.dtype)
+  # One output slice at a time bounds the size of the float temporary
+  for k in range(shape[0]):
+    block = voxels[k * factor:(k + 1) * factor, :shape[1] * factor, :shape[2] * factor].astype(np.float32)
+    downsampled[k] = np.round(block.reshape(factor, shape[1], factor, shape[2], factor).mean(axis=(0, 2, 4)))
+  return downsampled
@@ -0,0 +1,165 @@
+import json
+import struct
+
+import numpy as np
+
+#
+# Surface mesh writers
+#
+# Writes a triangle surface (vtkPolyData) to one or more file formats. Besides the
+# VTK OBJ/STL writers this includes a binary glTF (GLB) writer, which is much
+# smaller and faster to load in a browser than ASCII OBJ. GLB positions are either
+# float32 or normalized int16 (KHR_mesh_quantization, dequantized by the node
+# transform); indices are uint16 when the mesh is small enough, otherwise uint32.
+#
+
+OUTPUT_FORMATS = ["obj", "stl", "glb"]
+GLB_POSITION_TYPES = ["float32", "int16"]
+
+# Upper estimates of the file size per triangle of a closed surface (about half as many
+# vertices as triangles), used to turn a byte budget into a triangle count.
+# OBJ: "v" and "vn" lines per vertex plus an "f a//a b//b c//c" line per triangle
+# STL: 50 bytes per triangle
+# GLB: positions per vertex plus uint32 indices per triangle
+BYTES_PER_TRIANGLE = {"obj": 90, "stl": 50, "glb": {"float32": 20, "int16": 16}}
+
+# glTF constants
+GL_SHORT = 5122
+GL_UNSIGNED_SHORT = 5123
+GL_UNSIGNED_INT = 5125
+GL_FLOAT = 5126
+GL_ARRAY_BUFFER = 34962
+GL_ELEMENT_ARRAY_BUFFER = 34963
+GL_TRIANGLES = 4
+
+def writeMesh(polyData, fileBaseName, formats, glbPositionType="float32"):
+  """Write polyData to fileBaseName + "." + format for every requested format.
+  Returns the list of written files.
+  """
+  outputFiles = []
+  for outputFormat in formats:
+    fileName = fileBaseName + "." + outputFormat
+    if outputFormat == "obj":
+      writeWithVtk(polyData, fileName, "vtkOBJWriter")
+    elif outputFormat == "stl":
+      writeWithVtk(polyData, fileName, "vtkSTLWriter")
+    elif outputFormat == "glb":
+      writeGlb(polyData, fileName, glbPositionType)
+    else:
+      raise ValueError("Unknown output format: " + str(outputFormat))
+    outputFiles.append(fileName)
+  return outputFiles
+
+def trianglesWithinBytes(byteBudget, formats, glbPositionType="float32"):
+  """Largest triangle count expected to fit every format's file into byteBudget bytes."""
+  bytesPerTriangle = 0
+  for outputFormat in formats:
+    formatBytes = BYTES_PER_TRIANGLE[outputFormat]
+    if isinstance(formatBytes, dict):
+      formatBytes = formatBytes[glbPositionType]
+    bytesPerTriangle = max(bytesPerTriangle, formatBytes)
+  return max(int(byteBudget // bytesPerTriangle), 1)
+
+def writeWithVtk(polyData, fileName, writerClassName):
+  import vtk
+  writer = getattr(vtk, writerClassName)()
+  writer.SetFileName(fileName)
+  writer.SetInputData(polyData)
+  if writerClassName == "vtkSTLWriter":
+    writer.SetFileTypeToBinary()
+  writer.Update()
+
+def triangleArrays(polyData):
+  """Return (points, triangles) numpy arrays of a surface, triangulating polygons if needed."""
+  import vtk
+  from vtk.util import numpy_support
+  triangulator = vtk.vtkTriangleFilter()
+  triangulator.PassVertsOff()
+  triangulator.PassLinesOff()
+  triangulator.SetInputData(polyData)
+  triangulator.Update()
+  triangleMesh = triangulator.GetOutput()
+  if triangleMesh.GetNumberOfPoints() == 0:
+    return np.zeros((0, 3), np.float32), np.zeros((0, 3), np.uint32)
+  points = numpy_support.vtk_to_numpy(triangleMesh.GetPoints().GetData())
+  # Legacy cell array layout: [3, i0, i1, i2, 3, ...]
+  triangles = numpy_support.vtk_to_numpy(triangleMesh.GetPolys().GetData()).reshape(-1, 4)[:, 1:]
+  return points, triangles
+
+def writeGlb(polyData, fileName, positionType="float32"):
+  points, triangles = triangleArrays(polyData)
+  with open(fileName, "wb") as glbFile:
+    glbFile.write(glbFromArrays(points, triangles, positionType))
+
+def glbFromArrays(points, triangles, positionType="float32"):
+  """Build a GLB file holding a single triangle mesh primitive."""
+  if positionType not in GLB_POSITION_TYPES:
+    raise ValueError("Unknown GLB position type: " + str(positionType))
+  points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+  triangles = np.asarray(triangles).reshape(-1, 3)
+  node = {"mesh": 0}
+  gltf = {"asset": {"version": "2.0", "generator": "InnovateVisualizer DICOM2OBJ"}}
+
+  # Positions
+  if len(points):
+    minimum, maximum = points.min(axis=0), points.max(axis=0)
+  else:
+    minimum = maximum = np.zeros(3)
+  if positionType == "int16":
+    # Normalized int16 in [-1, 1], mapped back to patient coordinates by the node transform.
+    # Vertex attributes must be 4-byte aligned, so each position is padded to 4 components.
+    center = (minimum + maximum) / 2.0
+    halfExtent = np.maximum((maximum - minimum) / 2.0, 1e-9)
+    quantized = np.zeros((len(points), 4), dtype=np.int16)
+    quantized[:, :3] = np.round((points - center) / halfExtent * 32767.0)
+    positionData = quantized.tobytes()
+    positionAccessor = {"componentType": GL_SHORT, "normalized": True,
+      "min": quantized[:, :3].min(axis=0).tolist() if len(points) else [0, 0, 0],
+      "max": quantized[:, :3].max(axis=0).tolist() if len(points) else [0, 0, 0]}
+    positionByteStride = 8
+    node["translation"] = center.tolist()
+    node["scale"] = halfExtent.tolist()
+    gltf["extensionsUsed"] = ["KHR_mesh_quantization"]
+    gltf["extensionsRequired"] = ["KHR_mesh_quantization"]
+  else:
+    positionData = points.astype(np.float32).tobytes()
+    positionAccessor = {"componentType": GL_FLOAT,
+      "min": minimum.astype(np.float32).tolist(), "max": maximum.astype(np.float32).tolist()}
+    positionByteStride = 12
+
+  # Indices, the largest value of each type is reserved for primitive restart
+  if len(points) < 0xFFFF:
+    indexData = triangles.astype(np.uint16).tobytes()
+    indexComponentType = GL_UNSIGNED_SHORT
+  else:
+    indexData = triangles.astype(np.uint32).tobytes()
+    indexComponentType = GL_UNSIGNED_INT
+
+  # Binary buffer: positions followed by 4-byte aligned indices
+  positionData += b"\x00" * (-len(positionData) % 4)
+  binaryData = positionData + indexData
+  binaryData += b"\x00" * (-len(binaryData) % 4)
+
+  positionAccessor.update({"bufferView": 0, "count": len(points), "type": "VEC3"})
+  gltf.update({
+    "scene": 0,
+    "scenes": [{"nodes": [0]}],
+    "nodes": [node],
+    "meshes": [{"primitives": [{"attributes": {"POSITION": 0}, "indices": 1, "mode": GL_TRIANGLES}]}],
+    "accessors": [
+      positionAccessor,
+      {"bufferView": 1, "componentType": indexComponentType, "count": triangles.size, "type": "SCALAR"},
+      ],
+    "bufferViews": [
+      {"buffer": 0, "byteOffset": 0, "byteLength": len(points) * positionByteStride, "byteStride": positionByteStride, "target": GL_ARRAY_BUFFER},
+      {"buffer": 0, "byteOffset": len(positionData), "byteLength": len(indexData), "target": GL_ELEMENT_ARRAY_BUFFER},
+      ],
+    "buffers": [{"byteLength": len(binaryData)}],
+    })
+
+  jsonData = json.dumps(gltf, separators=(",", ":")).encode("utf-8")
+  jsonData += b" " * (-len(jsonData) % 4)
+  header = struct.pack("<4sII", b"glTF", 2, 12 + 8 + len(jsonData) + 8 + len(binaryData))
+  return (header
+    + struct.pack("<I4s", len(jsonData), b"JSON") + jsonData
+    + struct.pack("<I4s", len(binaryData), b"BIN\x00") + binaryData)
@@ -0,0 +1,127 @@
+import json
+import os
+import signal
+import sys
+import time
+
+#
+# Progress events and cancellation
+#
+# ProgressReporter writes one JSON object per line for every progress event
+# (stage start and end with their voxel and triangle counts, percent done,
+# conversion start and end) to stdout or a file, so a scheduler can follow a
+# conversion. It also stops conversions between stages once cancellation is
+# requested by SIGTERM/SIGINT or by creating a cancel file. A signal stops every
+# later conversion of the process too; a cancel file only the conversion it is
+# seen in, and a conversion may name its own cancel file in its start event:
+#
+#   {"event": "stageEnd", "time": 1600000000.0, "percent": 40.0, "stage": "threshold", "voxels": 33554432, "wallSeconds": 1.2, ...}
+#
+# Hooked into DICOM2OBJ as a StageProfiler observer.
+#
+# With progress on stdout, everything else the process writes to stdout is sent
+# to stderr, so stdout stays a valid JSON lines stream. The command line tools
+# exit with EXIT_ERROR after a failure and EXIT_CANCELLED after a cancellation.
+#
+
+EXIT_ERROR = 1
+EXIT_CANCELLED = 3
+
+# Percent done once a stage ends; the percent reported is the highest reached so far
+STAGE_PERCENT = {
+  "scan": 5,
+  "cacheLookup": 6,
+  "memoryBudget": 6,
+  "load": 25,
+  "downsample": 28,
+  "crop": 30,
+  "threshold": 40,
+  "segmentMask": 45,
+  "median": 55,
+  "intermediateLoad": 70,
+  "closedSurface": 75,
+  "exportModels": 78,
+  "intermediateStore": 80,
+  "decimate": 85,
+  "meshSmoothing": 92,
+  "clean": 94,
+  "write": 98,
+  "cacheStore": 100,
+  }
+
+
+class ConversionCancelled(Exception):
+  pass
+
+
+def openProgressStream(path):
+  """Stream of progress events written to the file path (appended), or to stdout for "-".
+  For stdout, file descriptor 1 is then redirected to stderr, so messages printed
+  by Python, Slicer or VTK do not end up between the JSON lines.
+  """
+  if path != "-":
+    return open(path, "a")
+  sys.stdout.flush()
+  progressStream = os.fdopen(os.dup(1), "w")
+  os.dup2(2, 1)
+  return progressStream
+
+
+class ProgressReporter:
+
+  def __init__(self, stream=None, cancelFile=None):
+    self.stream = stream
+    self.cancelFile = cancelFile
+    # Cancel file of the running conversion
+    self.conversionCancelFile = cancelFile
+    self.cancelRequested = False
+    self.stopRequested = False
+    self.percent = 0.0
+
+  def installSignalHandlers(self):
+    # Let the running stage finish instead of killing the process
+    for signalName in ["SIGTERM", "SIGINT"]:
+      if hasattr(signal, signalName):
+        signal.signal(getattr(signal, signalName), self.requestCancel)
+
+  def requestCancel(self, *args):
+    self.stopRequested = True
+
+  def checkCancelled(self):
+    if self.conversionCancelFile and os.path.exists(self.conversionCancelFile):
+      self.cancelRequested = True
+    if self.cancelRequested or self.stopRequested:
+      raise ConversionCancelled("Conversion cancelled")
+
+  def emit(self, event, **info):
+    if self.stream is None:
+      return
+    message = {"event": event, "time": round(time.time(), 3)}
+    message.update(info)
+    self.stream.write(json.dumps(message, default=str) + "\n")
+    self.stream.flush()
+
+  def progress(self, stage, fraction=None, **counts):
+    """Report progress within a stage and stop if cancelled."""
+    self.checkCancelled()
+    if fraction is not None:
+      self.percent = max(self.percent, round(100.0 * fraction, 1))
+    self.emit("progress", stage=stage, percent=self.percent, **counts)
+
+  def __call__(self, event, record):
+    # StageProfiler observer
+    if event == "conversionStart":
+      self.percent = 0.0
+      # A cancelled conversion does not cancel the next one of a batch or server
+      self.cancelRequested = False
+      self.conversionCancelFile = record.get("cancelFile") or self.cancelFile
+      self.checkCancelled()
+    elif event == "stageStart":
+      self.checkCancelled()
+    elif event == "stageEnd":
+      self.percent = max(self.percent, STAGE_PERCENT.get(record["stage"], self.percent))
+    elif event == "conversionEnd" and record.get("status") == "ok":
+      self.percent = 100.0
+    info = dict(record)
+    info["percent"] = self.percent
+    self.emit(event, **info)
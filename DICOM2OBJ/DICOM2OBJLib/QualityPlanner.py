@@ -0,0 +1,137 @@
+import copy
+import json
+import os
+
+#
+# Quality levels and time budgets
+#
+# A quality level sets the surface oversampling, the median kernel (as a scale
+# of each segment's kernel), the surface smoothing and the mesh smoothing
+# iterations. With a time budget, the best level whose estimated conversion
+# time fits the budget is used. Stage costs are estimated from the voxel count,
+# the voxel spacing (median kernel size in voxels) and the expected surface
+# triangle count; once the surfaces exist, the mesh smoothing iterations are
+# fitted to the time that is actually left, from their real triangle count.
+#
+# The cost constants are seconds per unit measured on a single 8 core worker
+# with the default filters; they only need to be right within a small factor.
+#
+
+# Cheapest first
+QUALITY_LEVELS = [
+  ("preview", {"oversamplingFactor": 0.5, "smoothingKernelScale": 0.0, "jointSmoothing": 0.3, "surfaceSmoothingFactor": 0.3, "meshSmoothingIterations": 10}),
+  ("draft", {"oversamplingFactor": 0.75, "smoothingKernelScale": 0.6, "jointSmoothing": 0.4, "surfaceSmoothingFactor": 0.4, "meshSmoothingIterations": 25}),
+  ("standard", {"oversamplingFactor": 1.0, "smoothingKernelScale": 1.0, "jointSmoothing": 0.5, "surfaceSmoothingFactor": 0.5, "meshSmoothingIterations": 50}),
+  ("archival", {"oversamplingFactor": 2.0, "smoothingKernelScale": 1.0, "jointSmoothing": 0.5, "surfaceSmoothingFactor": 0.5, "meshSmoothingIterations": 100}),
+  ]
+QUALITY_NAMES = [name for name, settings in QUALITY_LEVELS]
+
+SECONDS_PER_LOADED_VOXEL = 4e-8
+SECONDS_PER_THRESHOLD_VOXEL = 1e-8
+# Per voxel and kernel element
+SECONDS_PER_MEDIAN_VOXEL = 3e-9
+# Per oversampled voxel, surface extraction and its smoothing
+SECONDS_PER_SURFACE_VOXEL = 2e-8
+SECONDS_PER_DECIMATED_TRIANGLE = 2e-6
+# Per triangle and iteration
+SECONDS_PER_SMOOTHED_TRIANGLE = 1e-7
+# Triangles of a closed surface per (oversampled voxels)^(2/3)
+TRIANGLES_PER_SURFACE_AREA = 6.0
+
+QUALITY_FILE_NAME = "DICOM2OBJ_quality.json"
+
+def qualitySettings(quality):
+  for name, settings in QUALITY_LEVELS:
+    if name == quality:
+      return dict(settings)
+  raise ValueError("Unknown quality: {0} (available: {1})".format(quality, ", ".join(QUALITY_NAMES)))
+
+def kernelVoxels(spacing, kernelSizeMm):
+  # Same rounding to an odd number of voxels as the Smoothing effect
+  if kernelSizeMm <= 0:
+    return 1
+  count = 1
+  for axisSpacing in spacing:
+    count *= int(round((kernelSizeMm / axisSpacing + 1) / 2)) * 2 - 1
+  return count
+
+def estimateTriangles(voxels, oversamplingFactor, segmentCount):
+  return int(TRIANGLES_PER_SURFACE_AREA * (voxels * oversamplingFactor ** 3) ** (2.0 / 3.0) * segmentCount)
+
+def estimateMeshSeconds(triangles, targetReduction, meshSmoothingIterations):
+  decimatedTriangles = triangles * (1.0 - targetReduction)
+  return triangles * SECONDS_PER_DECIMATED_TRIANGLE + decimatedTriangles * meshSmoothingIterations * SECONDS_PER_SMOOTHED_TRIANGLE
+
+def estimateSeconds(voxels, spacing, segments, settings, targetReduction, surfaceExtractor="segmentation"):
+  """Estimated seconds of each stage of converting voxels with the settings of a quality level."""
+  # Only the segmentation conversion rule oversamples the labelmap
+  oversamplingFactor = settings["oversamplingFactor"] if surfaceExtractor == "segmentation" else 1.0
+  triangles = estimateTriangles(voxels, oversamplingFactor, len(segments))
+  return {
+    "load": voxels * SECONDS_PER_LOADED_VOXEL,
+    "threshold": voxels * SECONDS_PER_THRESHOLD_VOXEL,
+    "median": sum(voxels * kernelVoxels(spacing, segment["smoothingKernelSizeMm"] * settings["smoothingKernelScale"]) * SECONDS_PER_MEDIAN_VOXEL
+      for segment in segments),
+    "closedSurface": voxels * oversamplingFactor ** 3 * SECONDS_PER_SURFACE_VOXEL * len(segments),
+    "mesh": estimateMeshSeconds(triangles, targetReduction, settings["meshSmoothingIterations"]),
+    }
+
+def planQuality(voxels, spacing, segments, quality=None, timeBudgetSeconds=None, targetReduction=0.95,
+  surfaceExtractor="segmentation", maximumOversamplingFactor=None):
+  """Pick the quality level of a conversion: quality, or with a time budget the best level
+  up to quality (default: the best level) whose estimated time fits the budget.
+  Returns the plan, with the chosen level, its settings and the estimated seconds of each stage.
+  """
+  candidates = [(name, dict(settings)) for name, settings in QUALITY_LEVELS]
+  if quality:
+    qualitySettings(quality)
+    candidates = candidates[:QUALITY_NAMES.index(quality) + 1]
+  if maximumOversamplingFactor:
+    for name, settings in candidates:
+      settings["oversamplingFactor"] = min(settings["oversamplingFactor"], maximumOversamplingFactor)
+  if not timeBudgetSeconds:
+    # A fixed level
+    candidates = candidates[-1:]
+
+  chosen = None
+  for name, settings in candidates:
+    estimatedSeconds = estimateSeconds(voxels, spacing, segments, settings, targetReduction, surfaceExtractor)
+    if chosen is None or not timeBudgetSeconds or sum(estimatedSeconds.values()) <= timeBudgetSeconds:
+      chosen = (name, settings, estimatedSeconds)
+  name, settings, estimatedSeconds = chosen
+  totalSeconds = sum(estimatedSeconds.values())
+  return {
+    "quality": name,
+    "timeBudgetSeconds": timeBudgetSeconds,
+    "voxels": voxels,
+    "spacing": [round(value, 4) for value in spacing],
+    "settings": settings,
+    "estimatedSeconds": dict((stage, round(seconds, 3)) for stage, seconds in estimatedSeconds.items()),
+    "estimatedTotalSeconds": round(totalSeconds, 3),
+    "withinBudget": not timeBudgetSeconds or totalSeconds <= timeBudgetSeconds,
+    }
+
+def applyPlan(parameters, plan):
+  """Copy of the conversion parameters with the settings of plan."""
+  settings = plan["settings"]
+  parameters = copy.deepcopy(parameters)
+  for name in ["oversamplingFactor", "jointSmoothing", "surfaceSmoothingFactor", "meshSmoothingIterations"]:
+    parameters[name] = settings[name]
+  for segment in parameters["segments"]:
+    segment["smoothingKernelSizeMm"] = round(segment["smoothingKernelSizeMm"] * settings["smoothingKernelScale"], 3)
+  return parameters
+
+def meshSmoothingIterations(remainingSeconds, triangles, targetReduction, maximumIterations):
+  """Most mesh smoothing iterations, up to maximumIterations, whose estimated time fits remainingSeconds."""
+  smoothingSeconds = remainingSeconds - estimateMeshSeconds(triangles, targetReduction, 0)
+  decimatedTriangles = triangles * (1.0 - targetReduction)
+  if decimatedTriangles <= 0:
+    return maximumIterations
+  return max(0, min(maximumIterations, int(smoothingSeconds / (decimatedTriangles * SECONDS_PER_SMOOTHED_TRIANGLE))))
+
+def writePlan(outputDir, plan):
+  fileName = os.path.join(outputDir, QUALITY_FILE_NAME)
+  os.makedirs(outputDir, exist_ok=True)
+  with open(fileName, "w") as planFile:
+    json.dump(plan, planFile, indent=2)
+  return fileName
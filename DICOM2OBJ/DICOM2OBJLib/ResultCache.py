@@ -0,0 +1,110 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+#
+# On-disk cache of conversion results
+#
+# Entries are keyed by a hash of the SOPInstanceUIDs of the converted series and
+# every pipeline parameter, so a resubmitted series with the same settings is
+# served from the cache instead of being segmented again. Each entry is a
+# folder holding the output files; its modification time is refreshed on every
+# hit and the least recently used entries are evicted when the cache grows
+# beyond its size limit.
+#
+# Intermediate results (labelmaps, raw surfaces) are stored in the same way,
+# under keys of their own kind that leave out the parameters of later stages.
+#
+
+# Bump when the pipeline changes in a way that changes its output for the same parameters
+CACHE_VERSION = 1
+
+
+class ResultCache:
+
+  def __init__(self, cacheDir, maximumSizeMB=2048):
+    self.cacheDir = cacheDir
+    self.maximumSizeBytes = int(maximumSizeMB * 1024 * 1024)
+
+  def key(self, instanceUIDs, parameters, kind=None):
+    if not instanceUIDs:
+      return None
+    content = {"version": CACHE_VERSION, "instances": list(instanceUIDs), "parameters": parameters}
+    if kind:
+      content["kind"] = kind
+    content = json.dumps(content, sort_keys=True)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+  def entryDir(self, key):
+    return os.path.join(self.cacheDir, key)
+
+  def lookup(self, key):
+    """Return the folder of the cached files of key, or None on a cache miss."""
+    entryDir = self.entryDir(key)
+    if not os.path.isdir(entryDir):
+      return None
+    # Mark as recently used
+    os.utime(entryDir, None)
+    return entryDir
+
+  def fetch(self, key, outputDir):
+    """Copy the cached files of key into outputDir.
+    Returns the list of written files, or None on a cache miss.
+    """
+    entryDir = self.entryDir(key)
+    if not os.path.isdir(entryDir):
+      return None
+    outputFiles = []
+    os.makedirs(outputDir, exist_ok=True)
+    for name in sorted(os.listdir(entryDir)):
+      outputFiles.append(shutil.copy2(os.path.join(entryDir, name), os.path.join(outputDir, name)))
+    # Mark as recently used
+    os.utime(entryDir, None)
+    return outputFiles
+
+  def store(self, key, files):
+    entryDir = self.entryDir(key)
+    if os.path.isdir(entryDir):
+      return
+    # Copy into a temporary folder first so other processes never see partial entries
+    temporaryDir = "{0}.tmp-{1}".format(entryDir, os.getpid())
+    os.makedirs(temporaryDir, exist_ok=True)
+    try:
+      for fileName in files:
+        shutil.copy2(fileName, os.path.join(temporaryDir, os.path.basename(fileName)))
+      os.rename(temporaryDir, entryDir)
+    except OSError as e:
+      logging.warning("Could not store result in cache: " + str(e))
+      shutil.rmtree(temporaryDir, ignore_errors=True)
+      return
+    self.evict()
+
+  def entries(self):
+    """Return (modification time, size in bytes, path) of every cache entry."""
+    entries = []
+    if not os.path.isdir(self.cacheDir):
+      return entries
+    for name in os.listdir(self.cacheDir):
+      entryDir = os.path.join(self.cacheDir, name)
+      if not os.path.isdir(entryDir) or ".tmp-" in name:
+        continue
+      size = sum(os.path.getsize(os.path.join(entryDir, fileName)) for fileName in os.listdir(entryDir))
+      entries.append((os.path.getmtime(entryDir), size, entryDir))
+    return entries
+
+  def evict(self):
+    # Remove least recently used entries until the cache fits its size limit
+    entries = sorted(self.entries())
+    totalSize = sum(size for modifiedTime, size, entryDir in entries)
+    for modifiedTime, size, entryDir in entries:
+      if totalSize <= self.maximumSizeBytes:
+        break
+      shutil.rmtree(entryDir, ignore_errors=True)
+      totalSize -= size
+      logging.info("Evicted cache entry " + entryDir)
+
+  def purge(self):
+    if os.path.isdir(self.cacheDir):
+      shutil.rmtree(self.cacheDir)
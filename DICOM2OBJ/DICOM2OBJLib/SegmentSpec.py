@@ -0,0 +1,110 @@
+import json
+import os
+
+import numpy as np
+
+#
+# Segment specifications
+#
+# A segment specification lists the segments to extract from one volume, each
+# with a name, an inclusive HU range, a color and a median smoothing kernel:
+#
+#   {"segments": [
+#     {"name": "Bone", "minimumThreshold": 200, "maximumThreshold": 3000, "color": [0.89, 0.85, 0.78], "smoothingKernelSizeMm": 2.5},
+#     {"name": "Vessels", "minimumThreshold": 150, "maximumThreshold": 200, "color": [0.8, 0.2, 0.2]}
+#   ]}
+#
+# Where ranges overlap, a voxel belongs to the first listed segment containing it.
+#
+
+DEFAULT_COLOR = [0.5, 0.5, 0.5]
+DEFAULT_SMOOTHING_KERNEL_SIZE_MM = 2.5
+
+PRESETS = {
+  "spine": [
+    {"name": "Spine", "minimumThreshold": 90.0, "maximumThreshold": 1600.0, "color": [0.89, 0.85, 0.78], "smoothingKernelSizeMm": 2.5},
+    ],
+  "bone-soft-tissue": [
+    {"name": "Bone", "minimumThreshold": 200.0, "maximumThreshold": 3000.0, "color": [0.89, 0.85, 0.78], "smoothingKernelSizeMm": 2.5},
+    {"name": "SoftTissue", "minimumThreshold": -100.0, "maximumThreshold": 199.0, "color": [0.89, 0.6, 0.5], "smoothingKernelSizeMm": 3.0},
+    ],
+  }
+
+def readSegmentSpec(presetOrFileName):
+  """Return the validated segment list of a preset name or a JSON specification file."""
+  if presetOrFileName in PRESETS:
+    segments = PRESETS[presetOrFileName]
+  elif os.path.isfile(presetOrFileName):
+    with open(presetOrFileName) as specFile:
+      spec = json.load(specFile)
+    segments = spec["segments"] if isinstance(spec, dict) else spec
+  else:
+    raise ValueError("Unknown segment preset or specification file: {0} (presets: {1})".format(presetOrFileName, ", ".join(sorted(PRESETS))))
+  return validateSegments(segments)
+
+def validateSegments(segments):
+  if not segments:
+    raise ValueError("Segment specification contains no segments")
+  if len(segments) > 255:
+    raise ValueError("At most 255 segments can be extracted in one run")
+  validated = []
+  for segment in segments:
+    for key in ["name", "minimumThreshold", "maximumThreshold"]:
+      if key not in segment:
+        raise ValueError("Segment specification is missing '{0}': {1}".format(key, segment))
+    validated.append({
+      "name": str(segment["name"]),
+      "minimumThreshold": float(segment["minimumThreshold"]),
+      "maximumThreshold": float(segment["maximumThreshold"]),
+      "color": [float(component) for component in segment.get("color", DEFAULT_COLOR)],
+      "smoothingKernelSizeMm": float(segment.get("smoothingKernelSizeMm", DEFAULT_SMOOTHING_KERNEL_SIZE_MM)),
+      })
+  names = [segment["name"] for segment in validated]
+  if len(set(names)) != len(names):
+    raise ValueError("Segment names must be unique: " + ", ".join(names))
+  return validated
+
+def thresholdLabelmap(voxels, segments, slabSize=16):
+  """Label every voxel with 1 + the index of the first segment whose range contains it (0 if none).
+  The ranges are turned into a table of intervals so the volume is swept only once.
+  """
+  # Interval edges, maximum thresholds are inclusive
+  edges = sorted(set([segment["minimumThreshold"] for segment in segments]
+    + [np.nextafter(segment["maximumThreshold"], np.inf) for segment in segments]))
+  # Label of the interval [edges[i-1], edges[i]) is intervalLabels[i]
+  intervalLabels = np.zeros(len(edges) + 1, dtype=np.uint8)
+  for intervalIndex in range(1, len(edges)):
+    lower = edges[intervalIndex - 1]
+    for labelValue, segment in enumerate(segments, 1):
+      if segment["minimumThreshold"] <= lower <= segment["maximumThreshold"]:
+        intervalLabels[intervalIndex] = labelValue
+        break
+  edges = np.asarray(edges)
+  # Slabs of slices bound the size of the temporary interval index array
+  labels = np.empty(voxels.shape, dtype=np.uint8)
+  for start in range(0, voxels.shape[0], slabSize):
+    labels[start:start + slabSize] = intervalLabels[np.searchsorted(edges, voxels[start:start + slabSize], side="right")]
+  return labels
+
+def thresholdBoundingBox(voxels, segments, step=1, slabSize=16):
+  """Return the inclusive [(first, last), ...] index range along each array axis of the
+  voxels inside any segment range, or None if there are none. With step > 1 only every
+  step-th voxel along each axis is checked and the ranges are extended by the skipped voxels.
+  """
+  sampled = voxels[::step, ::step, ::step]
+  occupied = [np.zeros(sampled.shape[axis], dtype=bool) for axis in range(3)]
+  for start in range(0, sampled.shape[0], slabSize):
+    slab = sampled[start:start + slabSize]
+    mask = np.zeros(slab.shape, dtype=bool)
+    for segment in segments:
+      mask |= (slab >= segment["minimumThreshold"]) & (slab <= segment["maximumThreshold"])
+    occupied[0][start:start + slabSize] |= mask.any(axis=(1, 2))
+    occupied[1] |= mask.any(axis=(0, 2))
+    occupied[2] |= mask.any(axis=(0, 1))
+  if not occupied[0].any():
+    return None
+  bounds = []
+  for axis in range(3):
+    indices = np.flatnonzero(occupied[axis])
+    bounds.append((int(indices[0]) * step, min(int(indices[-1]) * step + step - 1, voxels.shape[axis] - 1)))
+  return bounds
@@ -0,0 +1,73 @@
+import numpy as np
+
+#
+# Slab streaming of volumes larger than memory
+#
+# The selected series is written slice by slice into a memory-mapped volume
+# file, then segmented in slabs of slices read back from that file. Each slab
+# is read with an overlap of half the largest median kernel on both sides, so
+# smoothing sees the same neighborhood as in the whole volume, and surfaces are
+# extracted on the planes first..last of the slab. Consecutive slabs share their
+# boundary plane: surface vertices on it are computed from the same voxels and
+# coincide exactly, so merging coincident points stitches the slab surfaces
+# into one seamless mesh. Peak memory scales with the slab size, not the study.
+#
+
+def volumeGeometry(series, firstDataset):
+  """IJK to RAS matrix (4x4 nested lists) of series, from its sorted instances and the header of its first slice."""
+  rowDirection, columnDirection = series.imageOrientation[:3], series.imageOrientation[3:]
+  normal = series.sliceNormal()
+  # PixelSpacing is (between rows, between columns)
+  rowSpacing, columnSpacing = [float(value) for value in firstDataset.PixelSpacing]
+  positions = [instance[2] for instance in series.instances]
+  if len(positions) > 1 and None not in positions and positions[-1] != positions[0]:
+    sliceSpacing = (positions[-1] - positions[0]) / (len(positions) - 1)
+  else:
+    sliceSpacing = series.sliceThickness or 1.0
+  origin = [float(value) for value in firstDataset.ImagePositionPatient]
+  ijkToLps = [
+    [rowDirection[axis] * columnSpacing, columnDirection[axis] * rowSpacing, normal[axis] * sliceSpacing, origin[axis]]
+    for axis in range(3)]
+  # LPS to RAS
+  ijkToRas = [[-value for value in ijkToLps[0]], [-value for value in ijkToLps[1]], ijkToLps[2], [0.0, 0.0, 0.0, 1.0]]
+  return ijkToRas
+
+def writeVolumeFile(series, fileName):
+  """Write the rescaled voxels of series into a memory-mapped file of shape (slices, rows, columns),
+  one slice at a time. Returns the read-only memory map and the IJK to RAS matrix.
+  """
+  import pydicom
+  firstDataset = pydicom.dcmread(series.files[0], stop_before_pixels=True)
+  slope = float(firstDataset.get("RescaleSlope", 1.0))
+  intercept = float(firstDataset.get("RescaleIntercept", 0.0))
+  # Integer rescaling keeps CT values in int16, half the size of float32
+  dtype = np.int16 if slope == int(slope) and intercept == int(intercept) else np.float32
+  shape = (len(series.instances), int(series.rows), int(series.columns))
+  volume = np.memmap(fileName, dtype=dtype, mode="w+", shape=shape)
+  for sliceIndex, sliceFileName in enumerate(series.files):
+    dataset = pydicom.dcmread(sliceFileName)
+    values = dataset.pixel_array * float(dataset.get("RescaleSlope", 1.0)) + float(dataset.get("RescaleIntercept", 0.0))
+    if dtype == np.int16:
+      values = np.clip(np.round(values), -32768, 32767)
+    volume[sliceIndex] = values
+  volume.flush()
+  del volume
+  return np.memmap(fileName, dtype=dtype, mode="r", shape=shape), volumeGeometry(series, firstDataset)
+
+def slabRanges(slices, slabSlices):
+  """Inclusive (first, last) planes of each slab. Consecutive slabs share one plane."""
+  if slices < 2:
+    return [(0, slices - 1)]
+  return [(first, min(first + slabSlices, slices - 1)) for first in range(0, slices - 1, slabSlices)]
+
+def readSlab(volume, first, last, margin):
+  """Planes first-margin..last+margin of volume (clipped to the volume) in memory,
+  and the index of plane first in them.
+  """
+  start = max(first - margin, 0)
+  stop = min(last + margin, volume.shape[0] - 1)
+  return np.array(volume[start:stop + 1]), first - start
+
+def estimateSlabMemoryMB(sliceVoxels, slabSlices, margin):
+  # Slab voxels, labels, segment mask, median output and padded mask
+  return sliceVoxels * (slabSlices + 1 + 2 * margin) * 8.0 / (1024.0 * 1024.0)
@@ -0,0 +1,197 @@
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+#
+# Per-stage profiling of conversions
+#
+# Every pipeline stage runs inside StageProfiler.stage(), which records its wall
+# time, CPU time (all threads of the process), the memory of the process when
+# the stage ended and the peak memory during the stage (including its nested
+# stages). Stages add their own counts (voxels, triangles, ...) to the record
+# they are given.
+#
+# The process's own peak only grows, so it would report the peak of the
+# largest earlier job for every later stage of a long-lived process. On Linux
+# the peak is reset at every stage boundary instead; elsewhere the resident
+# memory is sampled from a thread while stages run.
+#
+# Observers are called with ("stageStart" or "stageEnd", record) around every
+# stage and with the events the pipeline sends through notify(). An observer
+# raising on "stageStart" stops the conversion before that stage runs.
+#
+
+def memoryUsageMB():
+  """Return (current, peak) resident memory of this process in MB, None where unavailable.
+  On Linux the peak is the one since the last resetPeakMemory().
+  """
+  if sys.platform == "win32":
+    return windowsMemoryUsageMB()
+  try:
+    # Kilobytes
+    with open("/proc/self/status") as status:
+      values = dict((name, int(value.split()[0]) / 1024.0) for name, sep, value in (line.partition(":") for line in status)
+        if name in ("VmRSS", "VmHWM"))
+    return values.get("VmRSS"), values.get("VmHWM")
+  except (OSError, ValueError, IndexError):
+    pass
+  import resource
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # Kilobytes on Linux, bytes on macOS
+  peakMB = peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0
+  return None, peakMB
+
+def resetPeakMemory():
+  """Restart the peak of memoryUsageMB() from the current resident memory.
+  Returns False where the peak cannot be reset (only possible on Linux).
+  """
+  try:
+    with open("/proc/self/clear_refs", "w") as clearRefs:
+      clearRefs.write("5")
+    return True
+  except OSError:
+    return False
+
+def windowsMemoryUsageMB():
+  import ctypes
+  from ctypes import wintypes
+
+  class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+    _fields_ = [
+      ("cb", wintypes.DWORD),
+      ("PageFaultCount", wintypes.DWORD),
+      ("PeakWorkingSetSize", ctypes.c_size_t),
+      ("WorkingSetSize", ctypes.c_size_t),
+      ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+      ("QuotaPagedPoolUsage", ctypes.c_size_t),
+      ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+      ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+      ("PagefileUsage", ctypes.c_size_t),
+      ("PeakPagefileUsage", ctypes.c_size_t),
+      ]
+
+  counters = PROCESS_MEMORY_COUNTERS()
+  counters.cb = ctypes.sizeof(counters)
+  if not ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+    return None, None
+  return counters.WorkingSetSize / (1024.0 * 1024.0), counters.PeakWorkingSetSize / (1024.0 * 1024.0)
+
+
+class PeakMemory:
+  """Peak resident memory (MB) between calls of take(). Resets the peak of the process where
+  possible, otherwise samples the resident memory from a thread between start() and stop().
+  """
+
+  SAMPLE_SECONDS = 0.01
+
+  def __init__(self):
+    self.resettable = resetPeakMemory()
+    self.sampledPeakMB = None
+    self.sampler = None
+    self.stopSampling = threading.Event()
+
+  def start(self):
+    if not self.resettable and self.sampler is None:
+      self.stopSampling.clear()
+      self.sampler = threading.Thread(target=self.sample, name="PeakMemory", daemon=True)
+      self.sampler.start()
+
+  def stop(self):
+    if self.sampler is not None:
+      self.stopSampling.set()
+      self.sampler.join()
+      self.sampler = None
+
+  def sample(self):
+    while not self.stopSampling.wait(self.SAMPLE_SECONDS):
+      currentMB = memoryUsageMB()[0]
+      if currentMB is not None:
+        self.sampledPeakMB = max(self.sampledPeakMB or 0.0, currentMB)
+
+  def take(self):
+    currentMB, peakMB = memoryUsageMB()
+    if self.resettable:
+      resetPeakMemory()
+      return peakMB
+    if currentMB is None:
+      # Only the peak of the whole process is known (macOS)
+      return peakMB
+    peakMB = max(self.sampledPeakMB or 0.0, currentMB)
+    self.sampledPeakMB = currentMB
+    return peakMB
+
+
+class StageProfiler:
+
+  def __init__(self):
+    self.observers = []
+    self.peakMemory = PeakMemory()
+    # Peak memory of the open stages, outermost first
+    self.openStagePeaks = []
+    self.reset()
+
+  def reset(self):
+    self.stages = []
+    self.startWallTime = time.perf_counter()
+    self.startCpuTime = time.process_time()
+    # Peak of this conversion, not of the earlier ones
+    self.peakMemory.take()
+    self.peakMemoryMB = None
+
+  def addPeakMemory(self, peakMB):
+    # A peak belongs to every open stage and to the conversion
+    if peakMB is None:
+      return
+    self.openStagePeaks = [max(stagePeakMB, peakMB) if stagePeakMB is not None else peakMB for stagePeakMB in self.openStagePeaks]
+    self.peakMemoryMB = max(self.peakMemoryMB, peakMB) if self.peakMemoryMB is not None else peakMB
+
+  @contextmanager
+  def stage(self, name, **info):
+    record = {"stage": name}
+    record.update(info)
+    self.notify("stageStart", record)
+    # The peak so far belongs to the enclosing stages
+    self.addPeakMemory(self.peakMemory.take())
+    self.openStagePeaks.append(None)
+    self.peakMemory.start()
+    startWallTime = time.perf_counter()
+    startCpuTime = time.process_time()
+    try:
+      yield record
+    except Exception as e:
+      record["error"] = str(e)
+      raise
+    finally:
+      record["wallSeconds"] = round(time.perf_counter() - startWallTime, 4)
+      record["cpuSeconds"] = round(time.process_time() - startCpuTime, 4)
+      self.addPeakMemory(self.peakMemory.take())
+      peakMemoryMB = self.openStagePeaks.pop()
+      if not self.openStagePeaks:
+        self.peakMemory.stop()
+      currentMemoryMB = memoryUsageMB()[0]
+      record["memoryMB"] = round(currentMemoryMB, 1) if currentMemoryMB is not None else None
+      record["peakMemoryMB"] = round(peakMemoryMB, 1) if peakMemoryMB is not None else None
+      self.stages.append(record)
+      self.notify("stageEnd", record)
+
+  def notify(self, event, record):
+    for observer in self.observers:
+      observer(event, record)
+
+  def summary(self):
+    self.addPeakMemory(self.peakMemory.take())
+    return {
+      "totalWallSeconds": round(time.perf_counter() - self.startWallTime, 4),
+      "totalCpuSeconds": round(time.process_time() - self.startCpuTime, 4),
+      # Since reset()
+      "peakMemoryMB": round(self.peakMemoryMB, 1) if self.peakMemoryMB is not None else None,
+      "stages": self.stages,
+      }
+
+  def write(self, fileName, **info):
+    profile = dict(info)
+    profile.update(self.summary())
+    with open(fileName, "w") as profileFile:
+      json.dump(profile, profileFile, indent=2)
@@ -0,0 +1,150 @@
+import builtins
+import os
+import sys
+import threading
+import time
+
+#
+# Startup time of the conversion entry points
+#
+# Slicer loads every installed module before running a --python-script, most of
+# them never used by a headless conversion. A lean launch ignores all modules
+# except the ones the pipeline depends on (and their dependencies); the
+# arguments of such a launch are derived from the modules of the current
+# installation. StartupProfile reports how long the application took to reach
+# the script and how long each module imported for the first time afterwards
+# took, including the modules it imported itself.
+#
+# Imports are timed from the start of the script's __main__ block. Modules the
+# application loaded before running the script, and those imported at the top
+# of the module file (vtk, qt, slicer, numpy), are already loaded by then: their
+# time is part of the startup time, and the report lists them as preloaded.
+#
+
+# Slicer modules used by the conversions: volume loading, segmentations, model export
+PIPELINE_MODULES = {
+  "DICOM2OBJ": ["Volumes", "Segmentations", "Models", "SubjectHierarchy"],
+  # Only for DICOM2OBJLib, shared by both modules
+  "STL2OBJ": ["DICOM2OBJ"],
+  }
+# Only needed by the Segment Editor engine and by the DICOM database import
+EDITOR_MODULES = ["SegmentEditor"]
+DATABASE_MODULES = ["DICOM"]
+
+LEAN_LAUNCH_ARGUMENTS = ["--no-splash", "--no-main-window", "--ignore-slicerrc", "--disable-cli-modules"]
+
+# Heavy modules reported as preloaded when they were imported before timing started
+HEAVY_MODULES = ["numpy", "vtk", "qt", "ctk", "slicer", "pydicom", "SimpleITK", "DICOMLib", "SegmentEditorEffects"]
+
+def processUptimeSeconds():
+  """Seconds since this process started, None where unavailable (only read on Linux)."""
+  try:
+    with open("/proc/self/stat") as stat:
+      # Fields after the command name, which may contain spaces; starttime is field 22
+      startTicks = int(stat.read().rsplit(")", 1)[1].split()[19])
+    with open("/proc/uptime") as uptime:
+      uptimeSeconds = float(uptime.read().split()[0])
+  except (OSError, ValueError, IndexError):
+    return None
+  return uptimeSeconds - startTicks / float(os.sysconf("SC_CLK_TCK"))
+
+def requiredModules(moduleManager, moduleNames):
+  """moduleNames and every module they depend on, directly or not."""
+  required = set()
+  pending = list(moduleNames)
+  while pending:
+    moduleName = pending.pop()
+    if moduleName in required:
+      continue
+    required.add(moduleName)
+    module = moduleManager.module(moduleName)
+    if module is not None:
+      pending.extend(module.dependencies())
+  return required
+
+def leanLaunchArguments(moduleManager, moduleNames):
+  """Slicer arguments that skip loading every module of this installation not in requiredModules(moduleNames)."""
+  required = requiredModules(moduleManager, moduleNames)
+  ignored = sorted(name for name in moduleManager.factoryManager().loadedModuleNames() if name not in required)
+  return LEAN_LAUNCH_ARGUMENTS + (["--modules-to-ignore", ",".join(ignored)] if ignored else [])
+
+
+def installIfRequested(argv, options):
+  """Return an installed StartupProfile if any of options (e.g. "--startup-report") is in argv, else None.
+  Called at the top of the __main__ block, so the imports of the entry point are timed too.
+  """
+  if not any(option in argv for option in options):
+    return None
+  startupProfile = StartupProfile()
+  startupProfile.install()
+  return startupProfile
+
+
+class StartupProfile:
+
+  def __init__(self):
+    # Time the application needed to start and reach the script
+    self.startupSeconds = processUptimeSeconds()
+    self.imports = []
+    self.timedModules = set()
+    self.originalImport = None
+    self.local = threading.local()
+    self.preloadedModules = []
+
+  def install(self):
+    """Start timing first imports of modules."""
+    if self.originalImport is None:
+      self.preloadedModules = [moduleName for moduleName in HEAVY_MODULES if moduleName in sys.modules]
+      self.originalImport = builtins.__import__
+      builtins.__import__ = self.timedImport
+
+  def uninstall(self):
+    if self.originalImport is not None:
+      builtins.__import__ = self.originalImport
+      self.originalImport = None
+
+  def timedImport(self, name, globals=None, locals=None, fromlist=(), level=0):
+    # Relative imports and modules that are already loaded are not timed
+    newModules = [] if level else [moduleName for moduleName in [name] + [name + "." + item for item in (fromlist or []) if item != "*"]
+      if moduleName not in sys.modules]
+    if not newModules:
+      return self.originalImport(name, globals, locals, fromlist, level)
+    depth = getattr(self.local, "depth", 0)
+    self.local.depth = depth + 1
+    startTime = time.perf_counter()
+    try:
+      return self.originalImport(name, globals, locals, fromlist, level)
+    finally:
+      self.local.depth = depth
+      seconds = time.perf_counter() - startTime
+      # fromlist items that are attributes rather than modules never appear in sys.modules
+      loadedModules = [moduleName for moduleName in newModules if moduleName in sys.modules and moduleName not in self.timedModules]
+      if loadedModules:
+        self.timedModules.update(loadedModules)
+        # Modules loaded by one import statement share its time
+        self.imports.append({"module": ", ".join(loadedModules), "seconds": round(seconds, 4), "nested": depth > 0})
+
+  def summary(self, moduleManager=None):
+    imports = sorted(self.imports, key=lambda record: -record["seconds"])
+    summary = {
+      "startupSeconds": round(self.startupSeconds, 3) if self.startupSeconds is not None else None,
+      # Nested imports are included in the time of the import that triggered them
+      "importSeconds": round(sum(record["seconds"] for record in imports if not record["nested"]), 4),
+      "imports": imports,
+      # Already loaded when timing started, their time is part of startupSeconds
+      "preloaded": self.preloadedModules,
+      }
+    if moduleManager is not None:
+      summary["loadedModules"] = sorted(moduleManager.factoryManager().loadedModuleNames())
+    return summary
+
+  def printReport(self, moduleManager=None, minimumNestedSeconds=0.01):
+    summary = self.summary(moduleManager)
+    print("Startup: {0}s until the script ran{1}, {2}s importing modules".format(summary["startupSeconds"],
+      " with {0} Slicer modules loaded".format(len(summary["loadedModules"])) if "loadedModules" in summary else "", summary["importSeconds"]))
+    if summary["preloaded"]:
+      print("  Loaded before timing started (part of the startup time): " + ", ".join(summary["preloaded"]))
+    for record in summary["imports"]:
+      if record["nested"] and record["seconds"] < minimumNestedSeconds:
+        continue
+      print("  {0:>8.4f}s {1}{2}".format(record["seconds"], record["module"], " (nested)" if record["nested"] else ""))
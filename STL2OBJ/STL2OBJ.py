@@ -1,7 +1,8 @@
 import os
-import unittest
+import sys
 import logging
-import vtk, qt, ctk, slicer
+import argparse
+import qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
 
@@ -14,7 +15,8 @@ class STL2OBJ(ScriptedLoadableModule):
     ScriptedLoadableModule.__init__(self, parent)
     self.parent.title = "STL2OBJ"
     self.parent.categories = ["Modules"]
-    self.parent.dependencies = []
+    # DICOM2OBJLib provides the GLB writer, progress events and startup profile
+    self.parent.dependencies = ["DICOM2OBJ"]
     self.parent.contributors = ["Andrew Gonzalez"]
     self.parent.helpText = """
 This is an example of scripted loadable module bundled in an extension.
@@ -22,29 +24,6 @@ It performs a simple thresholding on the input volume and optionally captures a
 """
     self.parent.helpText += self.getDefaultModuleDocumentationLink()
     self.parent.acknowledgementText = "acknowledgementText"
-    #self.RunOnStartUp()
-    
-  def RunOnStartUp(self):
-    # Run module on startup of slicer
-    slicer.app.connect("startupCompleted()", self.LoadSegment)
-  
-  def LoadSegment(self):
-    # Adding delay to allow other slicer modules to be instantiated
-    qt.QTimer.singleShot(100, self.Convert2OBJ)
-
-  def Convert2OBJ(self):
-    fileName = "test"
-    inputFolder = "C:/Users/Public/Downloads/" + fileName + ".stl" # TODO automate with communication with website back-end
-    outputFolder = "Z:/TestingSlicer" # TODO automate with communication with website back-end
-
-    # Load STL, import as segmentation, and export as OBJ
-    stlSegmentationNode = slicer.util.loadSegmentation(inputFolder)
-    segmentIDs = vtk.vtkStringArray()
-    segmentIDs.InsertNextValue(fileName)
-    slicer.vtkSlicerSegmentationsModuleLogic.ExportSegmentsClosedSurfaceRepresentationToFiles(outputFolder, stlSegmentationNode, segmentIDs, "OBJ", True, 1.0, False)
-
-    # Clean Up
-    stlSegmentationNode = None
 
 
 class STL2OBJWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
@@ -80,6 +59,125 @@ class STL2OBJLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  def ConvertFile(self, inputFile, outputFolder, outputFormats=("obj",), glbPositionType="float32", chunkTriangles=None, progress=None):
+    """Convert an STL file to every format in outputFormats and return the written files.
+    progress is passed to STL2OBJLib.StlConverter.convertFile.
+    """
+    # Streamed straight from the STL file, no segmentation node or scene is involved
+    from STL2OBJLib import StlConverter
+    os.makedirs(outputFolder, exist_ok=True)
+    return StlConverter.convertFile(inputFile, outputFolder, outputFormats, glbPositionType,
+      chunkTriangles or StlConverter.DEFAULT_CHUNK_TRIANGLES, progress)
+
+  def ConvertBatch(self, inputPathOrGlob, outputFolder, outputFormats=("obj",), glbPositionType="float32", chunkTriangles=None, workers=None, force=False, progress=None):
+    """Convert every STL file of a folder or glob pattern across worker processes and return the summary.
+    Files whose outputs are newer than the input are skipped unless force is set.
+    """
+    from STL2OBJLib import BatchConversion
+    inputFiles = BatchConversion.listInputFiles(inputPathOrGlob)
+    if not inputFiles:
+      raise ValueError("No STL files found: " + inputPathOrGlob)
+    return BatchConversion.convertFiles(inputFiles, outputFolder, outputFormats, glbPositionType, chunkTriangles, workers, force, progress)
+
+def main(argv, startupProfile=None):
+  """Run the command line. startupProfile is the import timing installed at the top of the __main__ block."""
+  try:
+    # Found on the Python path where the DICOM2OBJ module, a dependency of this module, is loaded
+    from DICOM2OBJLib import ProgressEvents, StartupProfile
+  except ImportError as e:
+    logging.error("STL2OBJ needs DICOM2OBJLib of the DICOM2OBJ module: {0}".format(e))
+    sys.exit(1)
+  exitStatus = 0
+  try:
+    from STL2OBJLib import StlConverter
+    parser = argparse.ArgumentParser(description="InnovateVisualizer STL2OBJ Converter")
+    parser.add_argument("-i", "--input-file", dest="input_file", metavar="PATH", default="-", help="Input STL file (binary or ASCII)")
+    parser.add_argument("-o", "--output-folder", dest="output_folder", metavar="PATH", default=".", help="Folder to save obj data")
+    parser.add_argument("-f", "--format", dest="format", metavar="FORMATS", default="obj", help="Comma separated output formats: obj, stl, glb (e.g. obj,glb)")
+    parser.add_argument("--glb-positions", dest="glb_positions", choices=["float32", "int16"], default="float32", help="GLB vertex position type, int16 is quantized and smaller")
+    parser.add_argument("--chunk-triangles", dest="chunk_triangles", type=int, default=StlConverter.DEFAULT_CHUNK_TRIANGLES, help="Triangles read and written at a time, bounds the memory used for the input")
+    parser.add_argument("--batch", dest="batch", metavar="PATH_OR_GLOB", default=None, help="Convert every STL file of a folder (including sub-folders) or matching a glob pattern, e.g. 'uploads/**/*.stl', into --output-folder")
+    parser.add_argument("--workers", dest="workers", type=int, default=None, help="Worker processes of a batch conversion (default: number of CPUs)")
+    parser.add_argument("--force", dest="force", action="store_true", help="Also convert batch files whose outputs are newer than the input")
+    parser.add_argument("--progress", dest="progress", metavar="PATH", default=None, help="Write JSON lines progress events to a file, or to stdout with '-'")
+    parser.add_argument("--cancel-file", dest="cancel_file", metavar="PATH", default=None, help="Stop the conversion once this file exists (SIGTERM/SIGINT also stop it cleanly with --progress)")
+    parser.add_argument("--startup-report", dest="startup_report", action="store_true", help="Print the application startup time and the import time of every module imported by the conversion")
+    parser.add_argument("--lean-launch-arguments", dest="lean_launch_arguments", action="store_true", help="Print the Slicer arguments that skip loading the modules of this installation the conversion does not use")
+    args = parser.parse_args(argv)
+    # Timing wraps every import of the process, so it is only installed when the timings are reported
+    if args.startup_report and startupProfile is None:
+      startupProfile = StartupProfile.StartupProfile()
+      startupProfile.install()
+
+    moduleManager = slicer.app.moduleManager()
+    if args.lean_launch_arguments:
+      print(" ".join(StartupProfile.leanLaunchArguments(moduleManager, StartupProfile.PIPELINE_MODULES["STL2OBJ"])))
+      sys.exit()
+
+    outputFormats = [outputFormat.strip().lower() for outputFormat in args.format.split(",") if outputFormat.strip()]
+    for outputFormat in outputFormats:
+      if outputFormat not in StlConverter.OUTPUT_FORMATS:
+        parser.error("Unknown output format: " + outputFormat)
+
+    # Progress events and cancellation between chunks (single file) or files (batch)
+    progressReporter = None
+    if args.progress or args.cancel_file:
+      progressStream = ProgressEvents.openProgressStream(args.progress) if args.progress else None
+      progressReporter = ProgressEvents.ProgressReporter(progressStream, args.cancel_file)
+      progressReporter.installSignalHandlers()
+
+    if args.batch:
+      from STL2OBJLib import BatchConversion
+      def progress(finishedFiles, totalFiles, status):
+        print("[{0}/{1}] {2} {3} ({4}s)".format(finishedFiles, totalFiles, status["status"], status["input"], status["seconds"]))
+        if progressReporter:
+          progressReporter.progress("batch", float(finishedFiles) / totalFiles, files=finishedFiles, **status)
+      summary = STL2OBJLogic().ConvertBatch(args.batch, args.output_folder, outputFormats, args.glb_positions, args.chunk_triangles, args.workers, args.force, progress)
+      print("Converted {0}, skipped {1} up to date, {2} failed in {3}s".format(summary["converted"], summary["skipped"], summary["failed"], summary["seconds"]))
+      for status in summary["files"]:
+        if status["status"] == "error":
+          print("Failed: {0} ({1})".format(status["input"], status["error"]))
+      print("Summary written to " + os.path.join(args.output_folder, BatchConversion.SUMMARY_FILE_NAME))
+      if summary["failed"]:
+        exitStatus = ProgressEvents.EXIT_ERROR
+    elif args.input_file == "-":
+      print('Please specify input STL file!')
+      exitStatus = 2
+    else:
+      if args.output_folder == ".":
+        print('Current directory is selected as output folder (default). To change it, please specify --output-folder')
+      progress = None
+      if progressReporter:
+        progress = lambda triangles, totalTriangles: progressReporter.progress("convert", float(triangles) / totalTriangles if totalTriangles else None, triangles=triangles)
+      for fileName in STL2OBJLogic().ConvertFile(args.input_file, args.output_folder, outputFormats, args.glb_positions, args.chunk_triangles, progress):
+        print("Wrote " + fileName)
+    if args.startup_report:
+      startupProfile.printReport(moduleManager)
+  except ProgressEvents.ConversionCancelled:
+    logging.warning("STL2OBJ conversion cancelled")
+    exitStatus = ProgressEvents.EXIT_CANCELLED
+  except Exception as e:
+    logging.exception(e)
+    exitStatus = ProgressEvents.EXIT_ERROR
+  finally:
+    if startupProfile:
+      startupProfile.uninstall()
+  sys.exit(exitStatus)
+
+if __name__ == "__main__":
+  # Slicer puts this folder on the Python path when it loads the scripted modules, which lean launches may skip
+  moduleDir = os.path.dirname(os.path.abspath(sys.argv[0]))
+  if moduleDir not in sys.path:
+    sys.path.insert(0, moduleDir)
+  startupProfile = None
+  try:
+    from DICOM2OBJLib import StartupProfile
+    startupProfile = StartupProfile.installIfRequested(sys.argv[1:], ["--startup-report"])
+  except ImportError:
+    # Reported by main()
+    pass
+  main(sys.argv[1:], startupProfile)
+
 class STL2OBJTest(ScriptedLoadableModuleTest):
   """
   This is the test case for your scripted module.
@@ -96,32 +194,109 @@ class STL2OBJTest(ScriptedLoadableModuleTest):
     """Run as few or as many tests as needed here.
     """
     self.setUp()
-    self.test_SegmentDicom1()
-
-  def test_SegmentDicom1(self):
-    """ Ideally you should have several levels of tests.  At the lowest level
-    tests should exercise the functionality of the logic with different inputs
-    (both valid and invalid).  At higher levels your tests should emulate the
-    way the user would interact with your code and confirm that it still works
-    the way you intended.
-    One of the most important features of the tests is that it should alert other
-    developers when their changes will have an impact on the behavior of your
-    module.  For example, if a developer removes a feature that you depend on,
-    your test should break so they know that the feature is needed.
-    """
+    self.test_ConvertStl()
+    self.setUp()
+    self.test_ConvertAsciiStl()
+    self.setUp()
+    self.test_VertexWelderCollisions()
+    self.setUp()
+    self.test_ObjCoordinatePrecision()
 
-    self.delayDisplay("Starting the test")
-    #
-    # first, get some data
-    #
-    import SampleData
-    SampleData.downloadFromURL(
-      nodeNames='FA',
-      fileNames='FA.nrrd',
-      uris='http://slicer.kitware.com/midas3/download?items=5767')
-    self.delayDisplay('Finished with download and loading')
-
-    volumeNode = slicer.util.getNode(pattern="FA")
-    logic = SegmentDicomLogic()
-    self.assertIsNotNone( logic.hasImageData(volumeNode) )
+  def test_ConvertStl(self):
+    """Convert a binary STL cube read in several chunks and check that its vertices are welded."""
+    import tempfile
+    import numpy as np
+    from STL2OBJLib import StlConverter
+    corners = np.array([[x, y, z] for x in (0, 1) for y in (0, 1) for z in (0, 1)], dtype=np.float32)
+    faces = [[0, 1, 3], [0, 3, 2], [4, 6, 7], [4, 7, 5], [0, 4, 5], [0, 5, 1],
+      [2, 3, 7], [2, 7, 6], [0, 2, 6], [0, 6, 4], [1, 5, 7], [1, 7, 3]]
+    records = np.zeros(len(faces), dtype=StlConverter.STL_RECORD_DTYPE)
+    records["vertices"] = corners[faces]
+    with tempfile.TemporaryDirectory() as tempDir:
+      inputFile = os.path.join(tempDir, "cube.stl")
+      with open(inputFile, "wb") as stlFile:
+        stlFile.write(bytes(80) + np.array([len(faces)], dtype="<u4").tobytes() + records.tobytes())
+      outputFolder = os.path.join(tempDir, "output")
+      outputFiles = STL2OBJLogic().ConvertFile(inputFile, outputFolder, ["obj", "stl"], chunkTriangles=5)
+      self.assertEqual(outputFiles, [os.path.join(outputFolder, "cube.obj"), os.path.join(outputFolder, "cube.stl")])
+      with open(outputFiles[0]) as objFile:
+        lines = objFile.read().splitlines()
+      self.assertEqual(len([line for line in lines if line.startswith("v ")]), 8)
+      self.assertEqual(len([line for line in lines if line.startswith("f ")]), 12)
+      self.assertTrue(np.array_equal(StlConverter.readBinaryStl(outputFiles[1])["vertices"], records["vertices"]))
+      # Bytes after the last record do not make a binary file ASCII
+      with open(inputFile, "ab") as stlFile:
+        stlFile.write(bytes(2))
+      outputFiles = STL2OBJLogic().ConvertFile(inputFile, outputFolder, ["stl"])
+      self.assertEqual(StlConverter.readBinaryStl(outputFiles[0]).shape, (len(faces),))
+    self.delayDisplay('Test passed!')
+
+  def test_ConvertAsciiStl(self):
+    """Convert an ASCII STL file, and fail on one without triangles instead of writing empty outputs."""
+    import tempfile
+    from STL2OBJLib import StlConverter
+    facet = " facet normal 0 0 1\n  outer loop\n   vertex {0}\n   vertex 1 0 0\n   vertex 0 1 0\n  endloop\n endfacet\n"
+    with tempfile.TemporaryDirectory() as tempDir:
+      inputFile = os.path.join(tempDir, "triangles.stl")
+      with open(inputFile, "w") as stlFile:
+        stlFile.write("solid triangles\n" + facet.format("0 0 0") + facet.format("1 1 0") + "endsolid triangles\n")
+      self.assertFalse(StlConverter.isBinaryStl(inputFile))
+      outputFolder = os.path.join(tempDir, "output")
+      [outputFile] = STL2OBJLogic().ConvertFile(inputFile, outputFolder, ["obj"])
+      with open(outputFile) as objFile:
+        lines = objFile.read().splitlines()
+      self.assertEqual(len([line for line in lines if line.startswith("v ")]), 4)
+      self.assertEqual(len([line for line in lines if line.startswith("f ")]), 2)
+
+      with open(inputFile, "w") as stlFile:
+        stlFile.write("solid empty\nendsolid empty\n")
+      with self.assertRaises(ValueError):
+        STL2OBJLogic().ConvertFile(inputFile, outputFolder, ["obj"])
+      self.assertFalse(os.path.exists(outputFile))
+    self.delayDisplay('Test passed!')
+
+  def test_ObjCoordinatePrecision(self):
+    """OBJ vertices should read back as the exact float32 coordinates of the STL file."""
+    import tempfile
+    import numpy as np
+    from STL2OBJLib import StlConverter
+    # Large coordinates with small differences, 6 significant digits would merge them
+    vertices = np.array([[[1234.5678, 100000.5, -0.001234567], [1234.5679, 100000.0, 0.0], [98765.43, 1e-7, 3.3333333]]], dtype=np.float32)
+    records = np.zeros(1, dtype=StlConverter.STL_RECORD_DTYPE)
+    records["vertices"] = vertices
+    with tempfile.TemporaryDirectory() as tempDir:
+      inputFile = os.path.join(tempDir, "precision.stl")
+      with open(inputFile, "wb") as stlFile:
+        stlFile.write(bytes(80) + np.array([1], dtype="<u4").tobytes() + records.tobytes())
+      [outputFile] = STL2OBJLogic().ConvertFile(inputFile, os.path.join(tempDir, "output"), ["obj"])
+      with open(outputFile) as objFile:
+        lines = objFile.read().splitlines()
+    points = np.array([line.split()[1:] for line in lines if line.startswith("v ")], dtype=np.float64).astype(np.float32)
+    faces = np.array([line.split()[1:] for line in lines if line.startswith("f ")], dtype=np.int64) - 1
+    self.assertEqual(len(points), 3)
+    self.assertTrue(np.array_equal(points[faces], vertices))
+    self.delayDisplay('Test passed!')
+
+  def test_VertexWelderCollisions(self):
+    """Vertices whose hashes collide must keep their own positions, in the same and in later chunks."""
+    import numpy as np
+    from STL2OBJLib import StlConverter
+    chunks = [
+      np.array([[[0, 0, 0], [1, 0, 0], [0, 1, 0]], [[1, 0, 0], [0, 1, 0], [1, 1, 0]]], dtype=np.float32),
+      np.array([[[1, 1, 0], [0, 0, 1], [-0.0, 0, 0]]], dtype=np.float32),
+      ]
+    hashMultipliers = StlConverter.HASH_MULTIPLIERS
+    for multipliers in [hashMultipliers, [np.uint64(0)] * 3]:
+      # With zero multipliers every vertex hashes to 0
+      StlConverter.HASH_MULTIPLIERS = multipliers
+      try:
+        welder = StlConverter.VertexWelder()
+        for triangleVertices in chunks:
+          newPoints, triangles = welder.weld(triangleVertices)
+          self.assertTrue(np.array_equal(welder.points[triangles], triangleVertices))
+      finally:
+        StlConverter.HASH_MULTIPLIERS = hashMultipliers
+      if multipliers is hashMultipliers:
+        # Without collisions each of the 5 distinct positions is one point, -0.0 is welded to 0.0
+        self.assertEqual(len(welder.points), 5)
     self.delayDisplay('Test passed!')
@@ -0,0 +1,138 @@
+import contextlib
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+#
+# Parallel batch STL conversion
+#
+# Converts every STL file of a folder (including sub-folders) or of a glob
+# pattern across a pool of worker processes. Sub-folders of the inputs are
+# kept below the output folder. Files whose outputs are all newer than the
+# input are skipped, and a summary of the status and time of every file is
+# written to the output folder.
+#
+# Workers are always spawned with Slicer's Python interpreter: forking the
+# Slicer application would copy its Qt, VTK and MRML state into every worker.
+# Spawned workers get the parent's sys.path, so they import STL2OBJLib (and
+# DICOM2OBJLib for GLB output) like the parent; the module script itself is not
+# run in them, it needs the Slicer application.
+#
+
+SUMMARY_FILE_NAME = "STL2OBJ_summary.json"
+
+def listInputFiles(inputPathOrGlob):
+  if os.path.isdir(inputPathOrGlob):
+    fileNames = [os.path.join(root, name) for root, dirs, files in os.walk(inputPathOrGlob) for name in files if name.lower().endswith(".stl")]
+  else:
+    fileNames = [fileName for fileName in glob.glob(inputPathOrGlob, recursive=True) if os.path.isfile(fileName)]
+  return sorted(fileNames)
+
+def outputFileBaseNames(inputFiles, outputFolder):
+  """Output file name (without extension) of every input, keeping the input folders below their common folder."""
+  if not inputFiles:
+    return []
+  commonFolder = os.path.commonpath([os.path.dirname(os.path.abspath(fileName)) for fileName in inputFiles])
+  return [os.path.join(outputFolder, os.path.relpath(os.path.splitext(os.path.abspath(fileName))[0], commonFolder)) for fileName in inputFiles]
+
+def isUpToDate(inputFile, outputFiles):
+  inputTime = os.path.getmtime(inputFile)
+  return all(os.path.exists(fileName) and os.path.getmtime(fileName) >= inputTime for fileName in outputFiles)
+
+def convertJob(job):
+  """Convert one (input file, output folder, formats, GLB position type, chunk triangles) job without raising."""
+  from STL2OBJLib import StlConverter
+  inputFile, outputFolder, outputFormats, glbPositionType, chunkTriangles = job
+  startTime = time.perf_counter()
+  try:
+    os.makedirs(outputFolder, exist_ok=True)
+    outputFiles = StlConverter.convertFile(inputFile, outputFolder, outputFormats, glbPositionType, chunkTriangles)
+    status = {"status": "ok", "outputs": outputFiles}
+  except Exception as e:
+    logging.exception("STL2OBJ conversion failed: " + inputFile)
+    status = {"status": "error", "error": str(e)}
+  status.update({"input": inputFile, "seconds": round(time.perf_counter() - startTime, 3)})
+  return status
+
+def initializeWorker():
+  # Workers are stopped by the parent, which handles cancellation itself
+  if hasattr(signal, "SIGTERM"):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def processPoolContext():
+  # Workers only need NumPy, they are started with Slicer's Python interpreter instead of
+  # another instance of the Slicer application (outside Slicer, with this interpreter)
+  context = multiprocessing.get_context("spawn")
+  pythonSlicer = os.path.join(os.path.dirname(sys.executable), "PythonSlicer" + (".exe" if sys.platform == "win32" else ""))
+  if os.path.exists(pythonSlicer):
+    context.set_executable(pythonSlicer)
+  return context
+
+@contextlib.contextmanager
+def mainScriptHidden():
+  """Keep spawned processes from running the main script (the module file run by Slicer),
+  which imports Slicer's Qt and MRML modules that PythonSlicer does not have.
+  """
+  mainModule = sys.modules["__main__"]
+  mainFile = mainModule.__dict__.pop("__file__", None)
+  try:
+    yield
+  finally:
+    if mainFile is not None:
+      mainModule.__file__ = mainFile
+
+def convertFiles(inputFiles, outputFolder, outputFormats=("obj",), glbPositionType="float32", chunkTriangles=None, workers=None, force=False, progress=None):
+  """Convert inputFiles across workers processes and return the summary, which is also written to outputFolder.
+  progress(finished files, total files, status) is called as files finish; raising from it stops the batch.
+  """
+  from STL2OBJLib import StlConverter
+  startTime = time.perf_counter()
+  chunkTriangles = chunkTriangles or StlConverter.DEFAULT_CHUNK_TRIANGLES
+  workers = workers or os.cpu_count() or 1
+  statuses = []
+  jobs = []
+  for inputFile, fileBaseName in zip(inputFiles, outputFileBaseNames(inputFiles, outputFolder)):
+    outputFiles = [fileBaseName + "." + outputFormat for outputFormat in outputFormats]
+    if not force and isUpToDate(inputFile, outputFiles):
+      statuses.append({"status": "skipped", "input": inputFile, "outputs": outputFiles, "seconds": 0.0})
+    else:
+      jobs.append((inputFile, os.path.dirname(fileBaseName), list(outputFormats), glbPositionType, chunkTriangles))
+
+  if jobs:
+    # The pool replaces workers that die, so the script stays hidden while it runs
+    with mainScriptHidden():
+      pool = processPoolContext().Pool(min(workers, len(jobs)), initializeWorker)
+      try:
+        # Results are reported as files finish, the summary lists them in input order
+        for jobIndex, status in enumerate(pool.imap_unordered(convertJob, jobs), 1):
+          logging.info("[{0}/{1}] {2} {3} ({4}s)".format(jobIndex, len(jobs), status["status"], status["input"], status["seconds"]))
+          statuses.append(status)
+          if progress:
+            progress(jobIndex, len(jobs), status)
+        pool.close()
+      except BaseException:
+        pool.terminate()
+        raise
+      finally:
+        pool.join()
+  statuses.sort(key=lambda status: status["input"])
+
+  summary = {
+    "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    "workers": workers,
+    "seconds": round(time.perf_counter() - startTime, 3),
+    "converted": len([status for status in statuses if status["status"] == "ok"]),
+    "skipped": len([status for status in statuses if status["status"] == "skipped"]),
+    "failed": len([status for status in statuses if status["status"] == "error"]),
+    "files": statuses,
+    }
+  os.makedirs(outputFolder, exist_ok=True)
+  with open(os.path.join(outputFolder, SUMMARY_FILE_NAME), "w") as summaryFile:
+    json.dump(summary, summaryFile, indent=2)
+  return summary
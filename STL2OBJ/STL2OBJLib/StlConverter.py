@@ -0,0 +1,215 @@
+import logging
+import os
+import time
+
+import numpy as np
+
+#
+# Streaming STL conversion
+#
+# Converts STL files without a Slicer scene. Binary STL is read through a
+# memory-mapped record view and processed in chunks of triangles, so only one
+# chunk of the input is in memory at a time. Duplicate vertices are welded with
+# a vectorized hash pass: the vertices of a chunk are hashed and matched against
+# a sorted table of the hashes of all vertices seen so far. Memory use grows
+# only with the number of distinct vertices. OBJ and STL files are written
+# chunk by chunk; GLB needs the whole mesh and is written at the end.
+#
+
+STL_HEADER_SIZE = 84
+# Start of the file read to tell ASCII from binary STL
+STL_PROBE_SIZE = 1024
+STL_RECORD_DTYPE = np.dtype([("normal", "<f4", (3,)), ("vertices", "<f4", (3, 3)), ("attribute", "<u2")])
+OUTPUT_FORMATS = ["obj", "stl", "glb"]
+DEFAULT_CHUNK_TRIANGLES = 1000000
+
+# Large odd 64-bit multipliers of the vertex hash
+HASH_MULTIPLIERS = [np.uint64(0x9E3779B97F4A7C15), np.uint64(0xC2B2AE3D27D4EB4F), np.uint64(0x165667B19E3779F9)]
+
+
+class VertexWelder:
+  """Gives every distinct vertex position one index across all chunks passed to weld()."""
+
+  def __init__(self):
+    # Sorted hashes of the welded vertices and the vertex index of each hash
+    self.hashes = np.zeros(0, dtype=np.uint64)
+    self.hashIndices = np.zeros(0, dtype=np.int64)
+    self.points = np.zeros((0, 3), dtype=np.float32)
+
+  def weld(self, triangleVertices):
+    """Return (new points, triangles) of a (n, 3, 3) chunk of triangle vertices: the points
+    not seen in earlier chunks and the point indices of every triangle.
+    """
+    # Adding 0 turns -0.0 into 0.0, so both are welded
+    vertices = triangleVertices.reshape(-1, 3) + np.float32(0.0)
+    chunkHashes, firstIndices, inverse = np.unique(vertexHashes(vertices), return_index=True, return_inverse=True)
+    positions = np.searchsorted(self.hashes, chunkHashes)
+    known = positions < len(self.hashes)
+    known[known] = self.hashes[positions[known]] == chunkHashes[known]
+    new = ~known
+
+    chunkIndices = np.empty(len(chunkHashes), dtype=np.int64)
+    chunkIndices[known] = self.hashIndices[positions[known]]
+    chunkIndices[new] = len(self.points) + np.arange(np.count_nonzero(new))
+    newPoints = vertices[firstIndices[new]]
+    self.hashes = np.insert(self.hashes, positions[new], chunkHashes[new])
+    self.hashIndices = np.insert(self.hashIndices, positions[new], chunkIndices[new])
+    self.points = np.concatenate([self.points, newPoints])
+    triangles = chunkIndices[inverse.ravel()]
+
+    # Different positions with the same hash are kept as separate points
+    collisions = np.flatnonzero(np.any(self.points[triangles] != vertices, axis=1))
+    if len(collisions):
+      triangles[collisions] = len(self.points) + np.arange(len(collisions))
+      newPoints = np.concatenate([newPoints, vertices[collisions]])
+      self.points = np.concatenate([self.points, vertices[collisions]])
+    return newPoints, triangles.reshape(-1, 3)
+
+
+def vertexHashes(vertices):
+  bits = vertices.view(np.uint32).astype(np.uint64)
+  return (bits[:, 0] * HASH_MULTIPLIERS[0]) ^ (bits[:, 1] * HASH_MULTIPLIERS[1]) ^ (bits[:, 2] * HASH_MULTIPLIERS[2])
+
+def headerTriangleCount(fileName):
+  with open(fileName, "rb") as stlFile:
+    stlFile.seek(80)
+    return int(np.frombuffer(stlFile.read(4), dtype="<u4")[0])
+
+def isBinaryStl(fileName):
+  fileSize = os.path.getsize(fileName)
+  if fileSize < STL_HEADER_SIZE:
+    return False
+  with open(fileName, "rb") as stlFile:
+    probe = stlFile.read(STL_PROBE_SIZE)
+  # ASCII files start with "solid" followed by facets. Some binary files also start with "solid",
+  # but their header is followed by binary records, where these keywords practically never appear.
+  looksAscii = probe.lstrip().startswith(b"solid") and any(keyword in probe for keyword in [b"facet", b"vertex", b"endsolid"])
+  return not looksAscii or fileSize == STL_HEADER_SIZE + headerTriangleCount(fileName) * STL_RECORD_DTYPE.itemsize
+
+def binaryTriangleCount(fileName):
+  """Triangles of a binary STL file. Trailing bytes after the records are ignored, and a
+  count of 0 in the header (left by some writers) is replaced by the records in the file.
+  """
+  recordCount = (os.path.getsize(fileName) - STL_HEADER_SIZE) // STL_RECORD_DTYPE.itemsize
+  triangleCount = headerTriangleCount(fileName)
+  if triangleCount == 0:
+    return recordCount
+  if triangleCount > recordCount:
+    raise ValueError("Truncated binary STL file {0}: {1} triangles in the header, {2} in the file".format(fileName, triangleCount, recordCount))
+  return triangleCount
+
+def readBinaryStl(fileName):
+  """Memory-mapped record view of the triangles of a binary STL file."""
+  triangleCount = binaryTriangleCount(fileName)
+  if triangleCount == 0:
+    return np.zeros(0, dtype=STL_RECORD_DTYPE)
+  return np.memmap(fileName, dtype=STL_RECORD_DTYPE, mode="r", offset=STL_HEADER_SIZE, shape=(triangleCount,))
+
+def asciiTriangleChunks(fileName, chunkTriangles):
+  vertices = []
+  with open(fileName, "r", errors="replace") as stlFile:
+    for line in stlFile:
+      words = line.split()
+      if words and words[0] == "vertex":
+        vertices.append([float(value) for value in words[1:4]])
+        if len(vertices) == 3 * chunkTriangles:
+          yield np.array(vertices, dtype=np.float32).reshape(-1, 3, 3)
+          vertices = []
+  if vertices:
+    yield np.array(vertices, dtype=np.float32).reshape(-1, 3, 3)
+
+def triangleChunks(fileName, chunkTriangles=DEFAULT_CHUNK_TRIANGLES):
+  """Yield the triangles of a binary or ASCII STL file as (n, 3, 3) float32 vertex arrays of at most chunkTriangles triangles."""
+  if not isBinaryStl(fileName):
+    for triangleVertices in asciiTriangleChunks(fileName, chunkTriangles):
+      yield triangleVertices
+    return
+  records = readBinaryStl(fileName)
+  for start in range(0, len(records), chunkTriangles):
+    # Only this chunk is copied out of the mapped file
+    yield np.array(records["vertices"][start:start + chunkTriangles], dtype=np.float32)
+
+def triangleNormals(triangleVertices):
+  normals = np.cross(triangleVertices[:, 1] - triangleVertices[:, 0], triangleVertices[:, 2] - triangleVertices[:, 0])
+  lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+  return normals / np.where(lengths > 0, lengths, 1.0)
+
+def writeObjChunk(objFile, points, triangles):
+  # One formatting operation per chunk instead of one per line. 9 significant digits
+  # write every float32 coordinate exactly, so distinct vertices stay distinct.
+  if len(points):
+    objFile.write(("v %.9g %.9g %.9g\n" * len(points)) % tuple(points.ravel().tolist()))
+  if len(triangles):
+    objFile.write(("f %d %d %d\n" * len(triangles)) % tuple((triangles.ravel() + 1).tolist()))
+
+def writeStlChunk(stlFile, triangleVertices):
+  records = np.zeros(len(triangleVertices), dtype=STL_RECORD_DTYPE)
+  records["normal"] = triangleNormals(triangleVertices)
+  records["vertices"] = triangleVertices
+  stlFile.write(records.tobytes())
+
+def convertFile(inputFile, outputFolder, outputFormats=("obj",), glbPositionType="float32", chunkTriangles=DEFAULT_CHUNK_TRIANGLES, progress=None):
+  """Convert an STL file to every format in outputFormats, named after the input file,
+  and return the written files. progress(converted triangles, total triangles or None for ASCII STL)
+  is called after every chunk; raising from it stops the conversion.
+  """
+  for outputFormat in outputFormats:
+    if outputFormat not in OUTPUT_FORMATS:
+      raise ValueError("Unknown output format: " + str(outputFormat))
+  startTime = time.perf_counter()
+  fileBaseName = os.path.join(outputFolder, os.path.splitext(os.path.basename(inputFile))[0])
+  outputFiles = [fileBaseName + "." + outputFormat for outputFormat in outputFormats]
+  if os.path.abspath(inputFile) in [os.path.abspath(fileName) for fileName in outputFiles]:
+    raise ValueError("Output would overwrite the input file: " + inputFile)
+
+  totalTriangles = binaryTriangleCount(inputFile) if isBinaryStl(inputFile) else None
+  objFile = open(fileBaseName + ".obj", "w") if "obj" in outputFormats else None
+  stlFile = open(fileBaseName + ".stl", "wb") if "stl" in outputFormats else None
+  welder = VertexWelder()
+  glbTriangles = []
+  triangleCount = 0
+  try:
+    if objFile:
+      objFile.write("# InnovateVisualizer STL2OBJ\n")
+    if stlFile:
+      # The triangle count is filled in at the end, ASCII input is not counted in advance
+      stlFile.write(b"InnovateVisualizer STL2OBJ".ljust(STL_HEADER_SIZE, b"\0"))
+    for triangleVertices in triangleChunks(inputFile, chunkTriangles):
+      triangleCount += len(triangleVertices)
+      if stlFile:
+        writeStlChunk(stlFile, triangleVertices)
+      if objFile or "glb" in outputFormats:
+        newPoints, triangles = welder.weld(triangleVertices)
+        if objFile:
+          writeObjChunk(objFile, newPoints, triangles)
+        if "glb" in outputFormats:
+          glbTriangles.append(triangles)
+      if progress:
+        progress(triangleCount, totalTriangles)
+    if triangleCount == 0:
+      raise ValueError("No triangles found in STL file " + inputFile)
+    if stlFile:
+      stlFile.seek(80)
+      stlFile.write(np.array([triangleCount], dtype="<u4").tobytes())
+
+    if "glb" in outputFormats:
+      from DICOM2OBJLib import MeshWriters
+      triangles = np.concatenate(glbTriangles) if glbTriangles else np.zeros((0, 3), dtype=np.int64)
+      with open(fileBaseName + ".glb", "wb") as glbFile:
+        glbFile.write(MeshWriters.glbFromArrays(welder.points, triangles, glbPositionType))
+  except Exception:
+    # Partly written files would look like finished conversions
+    for outputFile in [objFile, stlFile]:
+      if outputFile:
+        outputFile.close()
+    for fileName in outputFiles:
+      if os.path.exists(fileName):
+        os.remove(fileName)
+    raise
+  finally:
+    for outputFile in [objFile, stlFile]:
+      if outputFile:
+        outputFile.close()
+
+  logging.info("Converted {0} ({1} triangles, {2} vertices) in {3:.2f}s".format(inputFile, triangleCount, len(welder.points), time.perf_counter() - startTime))
+  return outputFiles